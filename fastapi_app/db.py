@@ -1,13 +1,15 @@
 
 import os
 import json
+import asyncio
 from decimal import Decimal
 from datetime import datetime
 from boto3.dynamodb.conditions import Key, Attr
-from awscrt import mqtt
-from awsiot import mqtt_connection_builder
 import numpy as np
 
+from mqtt_utils import publisher
+from services.command_tracker import command_tracker
+
 from utils.dynamodb_setup import (
     dynamodb,
     DATA_TABLE_NAME,
@@ -15,14 +17,6 @@ from utils.dynamodb_setup import (
     THRESHOLDS_TABLE_NAME,
 )
 
-# =====================================================
-#  Configuración AWS IoT
-# =====================================================
-AWS_IOT_ENDPOINT = os.getenv("AWS_IOT_ENDPOINT", "")
-ROOT_CA_PATH = os.getenv("AWS_ROOT_CA_PATH", "")
-CERT_PATH = os.getenv("AWS_CERT_PATH", "")
-KEY_PATH = os.getenv("AWS_KEY_PATH", "")
-
 
 def sanitize_for_dynamodb(value):
     """Convierte tipos no compatibles (como np.bool_) a tipos nativos de Python."""
@@ -218,41 +212,69 @@ async def save_thresholds(device_id: str, limits: dict):
 
 
 # =====================================================
-#  AWS IoT Publish (SDK oficial)
+#  AWS IoT Publish (publisher MQTT persistente)
 # =====================================================
 async def send_command(device_id: str, command: dict):
-    """Publica un comando MQTT en AWS IoT Core con mTLS."""
+    """
+    Publica un comando MQTT en AWS IoT Core.
+    Reutiliza la conexión mTLS del publisher global (sin handshake por comando)
+    y espera el PUBACK (QoS1).
+    El comando lleva un `cmd_id` para emparejar el ACK del dispositivo
+    (ver services/command_tracker.py).
+    """
+    cmd_id = None
     try:
-        if not all([AWS_IOT_ENDPOINT, CERT_PATH, KEY_PATH, ROOT_CA_PATH]):
-            raise ValueError("Certificados AWS IoT no configurados correctamente")
-
         topic = f"{device_id}/commands"
+        command = command_tracker.register(device_id, command)
+        cmd_id = command["cmd_id"]
         print(f"📡 Enviando comando a {device_id} → {topic}")
         print(f"📦 Payload: {command}")
 
-        mqtt_connection = mqtt_connection_builder.mtls_from_path(
-            endpoint=AWS_IOT_ENDPOINT,
-            cert_filepath=CERT_PATH,
-            pri_key_filepath=KEY_PATH,
-            ca_filepath=ROOT_CA_PATH,
-            client_id=f"fastapi_{device_id}",
-            clean_session=False,
-            keep_alive_secs=30,
-        )
+        await publisher.publish(topic, command, qos=1)
 
-        connect_future = mqtt_connection.connect()
-        connect_future.result(timeout=10)
-        print(f"✅ Conectado a AWS IoT → publicando en {topic}")
-
-        message = json.dumps(command)
-        mqtt_connection.publish(topic=topic, payload=message, qos=mqtt.QoS.AT_LEAST_ONCE)
-        print(f"📤 Mensaje publicado en {topic}: {message}")
-
-        mqtt_connection.disconnect()
-        print("🔌 Conexión MQTT cerrada correctamente")
-
-        return {"status": "ok", "device_id": device_id, "command": command}
+        return {"status": "ok", "device_id": device_id, "command": command, "cmd_id": cmd_id}
 
     except Exception as e:
+        if cmd_id:
+            command_tracker.discard(cmd_id)
         print(f"❌ Error enviando comando a {device_id}: {e}")
         return {"status": "error", "error": str(e)}
+
+
+async def send_commands(commands: dict, timeout: float = 10):
+    """
+    Publica comandos a muchos dispositivos en paralelo (device_id → [payloads]).
+    Todos se encolan en la misma conexión del publisher y se esperan juntos.
+    Devuelve device_id → {"status": "ok", "cmd_ids"} | {"status": "error", "error": ...}
+    """
+    # Una copia por dispositivo, cada una con su propio cmd_id
+    tagged = {
+        device_id: [command_tracker.register(device_id, cmd) for cmd in cmds]
+        for device_id, cmds in commands.items()
+    }
+    cmd_ids = {device_id: [cmd["cmd_id"] for cmd in cmds] for device_id, cmds in tagged.items()}
+    futures = {
+        device_id: [publisher.submit(f"{device_id}/commands", cmd, qos=1) for cmd in cmds]
+        for device_id, cmds in tagged.items()
+    }
+    print(f"📡 Enviando {sum(len(f) for f in futures.values())} comandos a {len(futures)} dispositivos")
+
+    async def wait_device(futs):
+        await asyncio.wait_for(asyncio.gather(*futs), timeout=timeout)
+
+    device_ids = list(futures)
+    outcomes = await asyncio.gather(
+        *(wait_device(futures[d]) for d in device_ids),
+        return_exceptions=True,
+    )
+
+    results = {}
+    for device_id, outcome in zip(device_ids, outcomes):
+        if isinstance(outcome, BaseException):
+            for cmd_id in cmd_ids[device_id]:
+                command_tracker.discard(cmd_id)
+            print(f"❌ Error enviando comando a {device_id}: {outcome!r}")
+            results[device_id] = {"status": "error", "error": str(outcome) or type(outcome).__name__}
+        else:
+            results[device_id] = {"status": "ok", "cmd_ids": cmd_ids[device_id]}
+    return results
@@ -4,6 +4,9 @@
 const token = localStorage.getItem("token");
 if (!token) location.href = "index.html";
 
+const PAGE_SIZE = 50;
+let nextCursor = null;   // cursor de la próxima página (null = no hay más)
+
 document.addEventListener("DOMContentLoaded", () => {
   const userEmail = localStorage.getItem("user_email");
   const userInfo = document.getElementById("userInfo");
@@ -24,6 +27,7 @@ document.addEventListener("DOMContentLoaded", () => {
   loadAlarms();
 
   document.getElementById("btnFilter").onclick = () => loadAlarms();
+  document.getElementById("btnMore").onclick = () => loadAlarms(true);
   document.getElementById("btnClear").onclick = clearFilters;
 });
 
@@ -106,7 +110,7 @@ function clearFilters() {
 // =======================================================
 // CARGAR ALARMAS
 // =======================================================
-async function loadAlarms() {
+async function loadAlarms(append = false) {
   const device = document.getElementById("deviceSelect").value;
   const since = document.getElementById("dateFrom").value;
   const until = document.getElementById("dateTo").value;
@@ -116,6 +120,8 @@ async function loadAlarms() {
   if (device) url.searchParams.append("device_id", device);
   if (since) url.searchParams.append("since", since);
   if (until) url.searchParams.append("until", until);
+  url.searchParams.append("page_size", PAGE_SIZE);
+  if (append && nextCursor) url.searchParams.append("cursor", nextCursor);
 
   try {
     const res = await fetch(url, {
@@ -124,25 +130,31 @@ async function loadAlarms() {
 
     if (!res.ok) {
       console.error("Error /api/alarms:", await res.text());
-      renderAlarms([]);
+      if (!append) renderAlarms([]);
       return;
     }
 
     const data = await res.json();
-    // asumo que tu endpoint devuelve { items: [...] }
-    renderAlarms(data.items || data);
+    // { items: [...], next_cursor }
+    nextCursor = data.next_cursor || null;
+    renderAlarms(data.items || data, append);
+    document.getElementById("btnMore").style.display = nextCursor ? "" : "none";
 
   } catch (err) {
     console.error("Error cargando alarmas:", err);
-    renderAlarms([]);
+    if (!append) renderAlarms([]);
   }
 }
 
 // =======================================================
 // RENDERIZAR ALARMAS EN TABLA
 // =======================================================
-function renderAlarms(alarms) {
+function renderAlarms(alarms, append = false) {
   const body = document.getElementById("alarmsBody");
+  if (append) {
+    alarms.forEach(a => body.appendChild(alarmRow(a)));
+    return;
+  }
   body.innerHTML = "";
 
   if (!alarms || alarms.length === 0) {
@@ -150,29 +162,31 @@ function renderAlarms(alarms) {
     return;
   }
 
-  alarms.forEach(a => {
-    const tr = document.createElement("tr");
-
-    const date = new Date(a.timestamp).toLocaleString("es-AR", {
-      day: "2-digit",
-      month: "2-digit",
-      year: "2-digit",
-      hour: "2-digit",
-      minute: "2-digit",
-      second: "2-digit"
-    });
+  alarms.forEach(a => body.appendChild(alarmRow(a)));
+}
 
-    tr.innerHTML = `
-      <td>${date}</td>
-      <td>${a.device_id}</td>
-      <td class="${colorAlarm(a.type)}">${a.type}</td>
-      <td>${a.value}</td>
-      <td>${a.threshold}</td>
-      <td>${a.sent_email ? "📧 Sí" : "—"}</td>
-    `;
+function alarmRow(a) {
+  const tr = document.createElement("tr");
 
-    body.appendChild(tr);
+  const date = new Date(a.timestamp).toLocaleString("es-AR", {
+    day: "2-digit",
+    month: "2-digit",
+    year: "2-digit",
+    hour: "2-digit",
+    minute: "2-digit",
+    second: "2-digit"
   });
+
+  tr.innerHTML = `
+    <td>${date}</td>
+    <td>${a.device_id}</td>
+    <td class="${colorAlarm(a.type)}">${a.type}</td>
+    <td>${a.value}</td>
+    <td>${a.threshold}</td>
+    <td>${a.sent_email ? "📧 Sí" : "—"}</td>
+  `;
+
+  return tr;
 }
 
 // =======================================================
@@ -33,20 +33,24 @@ document.addEventListener("DOMContentLoaded", async () => {
   }
 
   // -------------------------------------------
-  //  2) Cargar resumen de un dispositivo
-  // -------------------------------------------
-  async function loadDeviceSummary(deviceId) {
-    try {
-      const res = await fetch(`${API}/devices/${deviceId}`, {
-        headers: { Authorization: `Bearer ${token}` },
-      });
-
-      if (!res.ok) return null;
-
-      return await res.json();
-    } catch (e) {
-      console.error("❌ Error cargando summary:", e);
-      return null;
+  //  2) Snapshot inicial (llega por WS al conectar)
+  // -------------------------------------------
+  let lastSnapshot = null;
+
+  function applySnapshot(snap) {
+    if (!snap) return;
+    for (const [deviceId, state] of Object.entries(snap.devices || {})) {
+      const last = (state.readings || []).slice(-1)[0];
+      if (last) updateDeviceData(deviceId, last);
+
+      if (state.status) {
+        updateDeviceStatus(deviceId, state.status);
+        const el = document.getElementById(`conn-${deviceId}`);
+        if (el && state.status.online === false)
+          el.innerHTML = `<span class="dot red"></span> <span>Desconectado</span>`;
+        else if (el)
+          el.innerHTML = `<span class="dot green"></span> <span>Conectado</span>`;
+      }
     }
   }
 
@@ -144,16 +148,22 @@ document.addEventListener("DOMContentLoaded", async () => {
     const tempEl = document.getElementById(`temp-${deviceId}`);
     const humEl = document.getElementById(`hum-${deviceId}`);
 
-    if (tempEl && values.temperature !== undefined)
-      tempEl.textContent = values.temperature.toFixed(1);
+    if (tempEl && values.temperature != null)
+      tempEl.textContent = Number(values.temperature).toFixed(1);
 
-    if (humEl && values.humidity !== undefined)
-      humEl.textContent = values.humidity.toFixed(1);
+    if (humEl && values.humidity != null)
+      humEl.textContent = Number(values.humidity).toFixed(1);
   }
 
   // -------------------------------------------
   //  WSClient → Escuchar eventos globales
   // -------------------------------------------
+  WSClient.on("snapshot", (msg) => {
+    // { type:"snapshot", devices:{ esp32_1:{ status:{...}, readings:[...] } } }
+    lastSnapshot = msg;
+    applySnapshot(msg);
+  });
+
   WSClient.on("data", (msg) => {
     // { type:"data", device_id:"esp32_1", values:{...} }
     updateDeviceData(msg.device_id, msg.values);
@@ -192,13 +202,13 @@ document.addEventListener("DOMContentLoaded", async () => {
 
   const deviceIds = [];
 
+  // Las cards se arman con el perfil; los valores llegan en el snapshot WS
+  // (sin un GET /api/devices/{id} por dispositivo)
   for (const d of profile.allowed_devices) {
-    const dev = await loadDeviceSummary(d.device_id);
-    if (dev) {
-      renderDevice(dev);
-      deviceIds.push(d.device_id);
-    }
+    renderDevice({ device_id: d.device_id });
+    deviceIds.push(d.device_id);
   }
+  applySnapshot(lastSnapshot);
 
   // if (deviceIds.length > 0) {
   //   connectWS(deviceIds);
@@ -9,11 +9,20 @@ const WSClient = (() => {
   let ws = null;
   let reconnectTimer = null;
 
+  // Posición en el stream del servidor (para reanudar tras un corte)
+  let stream = null;
+  let lastSeq = null;
+
   function connect() {
     const protocol = location.protocol === "https:" ? "wss" : "ws";
 
     //  RUTA PARA EL BACKEND
-    const url = `${protocol}://${location.host}/api/ws?token=${token}`;
+    //  1ra conexión → snapshot=1 (estado actual)
+    //  reconexión   → stream + last_seq (solo lo perdido, o snapshot si es tarde)
+    let url = `${protocol}://${location.host}/api/ws?token=${token}`;
+    url += stream && lastSeq !== null
+      ? `&stream=${stream}&last_seq=${lastSeq}`
+      : "&snapshot=1";
 
     ws = new WebSocket(url);
 
@@ -62,6 +71,31 @@ const WSClient = (() => {
   //  Despachar evento
   // ------------------------------
   function dispatch(msg) {
+    // Frames agrupados (cliente con throttle)
+    if (msg.type === "batch") {
+      (msg.messages || []).forEach(dispatch);
+      return;
+    }
+
+    if (msg.type === "hello") {
+      // Stream distinto (otro worker / reinicio) → se toma la nueva posición
+      if (msg.stream !== stream) {
+        stream = msg.stream;
+        lastSeq = msg.seq;
+      }
+      return;
+    }
+
+    if (typeof msg.seq === "number" && (lastSeq === null || msg.seq > lastSeq)) {
+      lastSeq = msg.seq;
+    }
+
+    // Heartbeat del servidor
+    if (msg.type === "ping") {
+      send({ type: "pong" });
+      return;
+    }
+
     if (!msg.type) {
       console.warn("Mensaje WS sin 'type':", msg);
       return;
@@ -1,17 +1,23 @@
 
 # iot_mqtt.py
 import os, ssl, json, asyncio
-import numpy as np
 from aiomqtt import Client
 from datetime import datetime
 
-from db import save_sensor_data, save_status, get_thresholds
-from utils.ml_utils import update_and_predict
+from db import save_sensor_data, save_status, get_thresholds, send_command
+from utils.ml_utils import update_and_predict, dynamic_thresholds
 from utils.ws_manager import manager  # broadcast WS
 
 #  Alarmas + Cache de usuarios por dispositivo
-from services.alarm_service import check_user_threshold_alarms
-from services.device_user_cache import get_users_for_device
+from services.alarm_rules import check_device_alarms
+from services.shadow_service import (
+    update_reported,
+    shadow_cache,
+    compute_delta,
+    commands_from_delta,
+    is_online,
+)
+from services.command_tracker import command_tracker
 
 # ============================================================
 # AWS IoT Config
@@ -30,34 +36,6 @@ if AWS_ROOT_CA_PATH and AWS_CERT_PATH and AWS_KEY_PATH:
     ssl_context.load_verify_locations(AWS_ROOT_CA_PATH)
     ssl_context.load_cert_chain(certfile=AWS_CERT_PATH, keyfile=AWS_KEY_PATH)
 
-# ============================================================
-# Buffers por dispositivo
-# ============================================================
-buffers = {}  # device_id → última N lecturas
-
-
-# ============================================================
-# Cálculo de umbrales dinámicos (media ± 3*std)
-# ============================================================
-def compute_dynamic_thresholds(device_id):
-    readings = buffers.get(device_id, [])
-    if len(readings) < 5:
-        return None
-
-    temps = np.array([r.get("temperature") for r in readings if "temperature" in r])
-    hums = np.array([r.get("humidity") for r in readings if "humidity" in r])
-
-    if temps.size == 0 or hums.size == 0:
-        return None
-
-    return {
-        "temp_min": float(np.mean(temps) - 3 * np.std(temps)),
-        "temp_max": float(np.mean(temps) + 3 * np.std(temps)),
-        "hum_min": float(np.mean(hums) - 3 * np.std(hums)),
-        "hum_max": float(np.mean(hums) + 3 * np.std(hums)),
-    }
-
-
 # ============================================================
 # Listener principal MQTT
 # ============================================================
@@ -119,7 +97,7 @@ async def start_mqtt_listener(broadcast_callback=None):
 
                             # --- Umbrales configurados en DB ---
                             thresholds_db = await get_thresholds(device_id)
-                            thresholds_dyn = compute_dynamic_thresholds(device_id)
+                            thresholds_dyn = dynamic_thresholds(device_id)
 
                             # Merge: DB override, dinámico fallback
                             thresholds = {
@@ -139,11 +117,7 @@ async def start_mqtt_listener(broadcast_callback=None):
                                 hum_anom = not (thresholds["hum_min"] <= hum <= thresholds["hum_max"])
 
                             # --- ML Predictivo ---
-                            ml_results = update_and_predict(temp, hum)
-
-                            # --- Buffer para umbrales dinámicos ---
-                            buffers.setdefault(device_id, []).append(payload)
-                            buffers[device_id] = buffers[device_id][-100:]
+                            ml_results = update_and_predict(device_id, temp, hum)
 
                             # --- Registro final ---
                             record = {
@@ -177,21 +151,11 @@ async def start_mqtt_listener(broadcast_callback=None):
                             # ====================================================
                             #  PROCESAR ALARMAS POR USUARIO
                             # ====================================================
-                            users = get_users_for_device(device_id)
-
-                            if users:
-                                for user in users:
-                                    try:
-                                        check_user_threshold_alarms(
-                                            user=user,
-                                            device_id=device_id,
-                                            value_temp=temp,
-                                            value_hum=hum
-                                        )
-                                    except Exception as e:
-                                        print(f"⚠️ Error en alarmas de {user.get('email')}: {e}")
-                            else:
-                                print(f"ℹ️ No hay usuarios asignados a {device_id}")
+                            # Reglas compiladas: todos los usuarios en una pasada
+                            try:
+                                check_device_alarms(device_id, temp, hum)
+                            except Exception as e:
+                                print(f"⚠️ Error evaluando alarmas de {device_id}: {e}")
 
                         # ====================================================
                         #   STATUS (LEDs, botón, online/offline)
@@ -199,9 +163,26 @@ async def start_mqtt_listener(broadcast_callback=None):
                         elif msg_type == "status":
                             print(f"🟢 [STATUS] Estado de {device_id}: {payload}")
 
+                            # --- ACK de comando (cmd_id devuelto por el dispositivo) ---
+                            command_tracker.resolve(device_id, payload)
+
                             await save_status(payload)
                             print(f"📝 [DB] Guardado estado → {device_id}")
 
+                            # --- Shadow: sección reported ---
+                            prev = (shadow_cache.get(device_id) or {}).get("reported") or {}
+                            shadow = await update_reported(device_id, {
+                                "led_red": payload.get("led_red"),
+                                "led_green": payload.get("led_green"),
+                                "online": payload.get("online", True),
+                            })
+
+                            # --- Reconexión: re-entregar lo pedido mientras no estaba ---
+                            if shadow and is_online(payload.get("online", True)) and not is_online(prev.get("online")):
+                                for cmd in commands_from_delta(compute_delta(shadow)):
+                                    print(f"🔁 [DELTA] Re-entregando a {device_id}: {cmd}")
+                                    await send_command(device_id, cmd)
+
                             await broadcast({
                                 "type": "status",
                                 "device_id": device_id,
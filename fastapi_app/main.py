@@ -27,10 +27,16 @@ from routes.alarms import router as alarms_router
 from utils.security import get_current_user
 from utils.dynamodb_setup import ensure_all_tables_exist
 from utils.ws_manager import manager
+from utils.ws_bus import InProcessBus
 from services.device_user_cache import build_device_user_cache
+from services.alarm_service import warm_cooldowns
+from utils.ml_utils import shutdown_training, run_state_saver, save_all_states
+from services.live_state_cache import live_state, SNAPSHOT_READINGS, MAX_SNAPSHOT_READINGS
 
 # MQTT
 from iot_mqtt import start_mqtt_listener
+from mqtt_utils import publisher
+from utils.email_service import notifier
 
 # JWT
 from jose import jwt, JWTError
@@ -38,6 +44,14 @@ from jose import jwt, JWTError
 SECRET_KEY = os.getenv("JWT_SECRET", "supersecreto123")
 ALGORITHMS = ["HS256"]
 
+# Con varios workers/nodos solo UNO debe consumir MQTT; el resto recibe
+# los eventos por el bus WS (WS_BUS_URL):
+#   auto  → el worker que gana el lock del bus (con Redis, uno solo en todo el cluster)
+#   true  → este proceso siempre (proceso designado)
+#   false → nunca
+MQTT_LISTENER_ENABLED = os.getenv("MQTT_LISTENER_ENABLED", "auto").lower()
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))   # workers de uvicorn
+
 # ------------------------------------------------------------
 #  FastAPI App
 # ------------------------------------------------------------
@@ -101,7 +115,39 @@ def _decode_user_from_token(token: Optional[str]) -> Optional[dict]:
 async def startup_event():
     print("🚀 Startup: preparando backend y MQTT...")
     build_device_user_cache()
-    asyncio.create_task(start_mqtt_listener(manager.broadcast))
+    manager.add_observer(live_state.observe)
+    asyncio.create_task(live_state.warm_all())
+    asyncio.create_task(run_state_saver())
+    await publisher.start()
+    await notifier.start()
+    await manager.start()
+
+    async def run_listener():
+        warm_cooldowns()
+        await start_mqtt_listener(manager.broadcast)
+
+    if MQTT_LISTENER_ENABLED in ("1", "true", "yes"):
+        asyncio.create_task(run_listener())
+    elif MQTT_LISTENER_ENABLED == "auto" and isinstance(manager.bus, InProcessBus) and WEB_CONCURRENCY > 1:
+        # Sin bus compartido no hay forma de elegir UN worker
+        print("⚠️ Varios workers sin WS_BUS_URL: listener MQTT deshabilitado (designar uno con MQTT_LISTENER_ENABLED=true)")
+    elif MQTT_LISTENER_ENABLED == "auto":
+        asyncio.create_task(manager.bus.run_exclusive("mqtt", run_listener))
+    else:
+        print(f"ℹ️ Listener MQTT deshabilitado en este worker (MQTT_LISTENER_ENABLED={MQTT_LISTENER_ENABLED})")
+
+
+# ------------------------------------------------------------
+#  SHUTDOWN
+# ------------------------------------------------------------
+@app.on_event("shutdown")
+async def shutdown_event():
+    print("🛑 Shutdown: cerrando conexiones MQTT...")
+    await publisher.stop()
+    await notifier.stop()
+    await manager.stop()
+    shutdown_training()
+    save_all_states()
 
 
 # ------------------------------------------------------------
@@ -121,6 +167,12 @@ async def ws_endpoint(
     websocket: WebSocket,
     devices: Optional[str] = Query(default=None),
     token: Optional[str] = Query(default=None),
+    fmt: str = Query(default="json", alias="format"),   # json | msgpack
+    throttle_ms: int = Query(default=0, ge=0),           # máx. un frame cada X ms
+    snapshot: bool = Query(default=False),                # estado actual al conectar
+    snapshot_n: int = Query(default=SNAPSHOT_READINGS, ge=1, le=MAX_SNAPSHOT_READINGS),
+    stream: Optional[str] = Query(default=None),         # reanudar: stream del frame hello
+    last_seq: Optional[int] = Query(default=None, ge=0),  # reanudar: último seq recibido
 ):
     filt = _parse_devices_param(devices)
     user = _decode_user_from_token(token)
@@ -132,42 +184,35 @@ async def ws_endpoint(
         allowed = _allowed_set_from_user(user)
 
     try:
-        await manager.connect(
+        client = await manager.connect(
             websocket,
             filter_devices=filt,
             allowed_devices=allowed,
             email=email,
             role=role,
+            fmt=fmt,
+            throttle_ms=throttle_ms,
         )
         print(f"🔌 WS conectado | filtro={filt} | email={email} | role={role}")
 
-        while True:
-            try:
-                data_task = asyncio.create_task(websocket.receive_text())
-
-                done, pending = await asyncio.wait(
-                    {data_task},
-                    timeout=60,
-                    return_when=asyncio.FIRST_COMPLETED,
-                )
+        # Reconexión: reenviar solo lo perdido; si el hueco es muy viejo → snapshot
+        resumed = last_seq is not None and manager.replay(client, stream, last_seq)
+        if snapshot or (last_seq is not None and not resumed):
+            manager.send_to_client(client, await live_state.snapshot(client.device_scope(), snapshot_n))
 
-                if not done:
-                    await websocket.send_text(json.dumps({"type": "ping"}))
-                    continue
-
-                data = data_task.result()
-
-                if data.strip().lower() == "ping":
-                    continue
+        # Ping/inactividad los maneja el heartbeat central del manager:
+        # acá solo se leen los mensajes del cliente.
+        while True:
+            data = await websocket.receive_text()
+            manager.touch(client)
 
-                print(f"📩 WS data recibida: {data}")
+            if data.strip().lower() in ("ping", "pong"):
+                continue
 
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
-                print(f"⚠️ WS error interno: {e}")
-                break
+            await manager.handle_client_message(websocket, client, data)
 
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
         print(f"⚠️ Error WS general: {e}")
 
@@ -1,6 +1,7 @@
 import json
 import ssl
 import os
+import time
 from aiomqtt import Client
 import asyncio
 
@@ -35,24 +36,219 @@ else:
     print(f"   AWS_CERT_PATH={CERT_PATH}")
     print(f"   AWS_KEY_PATH={KEY_PATH}")
 
-async def mqtt_publish_message(topic: str, message: dict):
-    """Publica un mensaje JSON a AWS IoT Core."""
-    if not ssl_context or not AWS_IOT_ENDPOINT:
-        print("❌ Certificados AWS IoT no configurados correctamente, no se puede publicar mensaje")
-        return
+# ============================================================
+# Publisher MQTT persistente
+# ============================================================
+class MqttPublisher:
+    """
+    Conexión MQTT de larga duración para publicar comandos.
+
+    - Una sola sesión TLS para toda la app (se abre en el startup)
+    - Reconexión automática con backoff exponencial
+    - Cola de salida acotada: los mensajes esperan mientras no hay conexión
+    - QoS1: `publish()` se resuelve recién cuando llega el PUBACK
+    - Publicaciones en paralelo (pipelining) hasta `max_inflight`
+    """
+
+    def __init__(
+        self,
+        queue_size: int = 1000,
+        max_inflight: int = 20,
+        max_retries: int = 3,
+        publish_timeout: float = 10,
+    ):
+        self.queue_size = queue_size
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
+        self.publish_timeout = publish_timeout
+
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._inflight: set = set()
+        self._broken = asyncio.Event()
+        self.connected = False
+
+        self.stats = {
+            "published": 0,
+            "failed": 0,
+            "retried": 0,
+            "reconnects": 0,
+            "last_latency_ms": None,
+            "avg_latency_ms": None,
+        }
+
+    # ---------------------------------------------------------
+    # Ciclo de vida
+    # ---------------------------------------------------------
+    async def start(self):
+        if self._task:
+            return
+        if not ssl_context or not AWS_IOT_ENDPOINT:
+            print("⚠️ Publisher MQTT deshabilitado: AWS IoT no configurado")
+            return
+
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._task = asyncio.create_task(self._run())
+        print("🚀 Publisher MQTT iniciado")
+
+    async def stop(self):
+        if not self._task:
+            return
+
+        self._task.cancel()
+        for task in list(self._inflight):
+            task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        # Fallar lo que quedó pendiente
+        while self._queue and not self._queue.empty():
+            *_, fut, _ = self._queue.get_nowait()
+            if not fut.done():
+                fut.set_exception(ConnectionError("Publisher MQTT detenido"))
+
+        print("🛑 Publisher MQTT detenido")
+
+    # ---------------------------------------------------------
+    # API pública
+    # ---------------------------------------------------------
+    def submit(self, topic: str, message, qos: int = 1) -> asyncio.Future:
+        """
+        Encola un mensaje y devuelve un future que se resuelve con el PUBACK.
+        No espera: permite encolar muchos mensajes y esperarlos juntos.
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+
+        if not self._task or self._queue is None:
+            fut.set_exception(ConnectionError("Publisher MQTT no iniciado"))
+            return fut
+
+        payload = message if isinstance(message, (str, bytes)) else json.dumps(message)
+        try:
+            self._queue.put_nowait((topic, payload, qos, 0, fut, time.perf_counter()))
+        except asyncio.QueueFull:
+            fut.set_exception(ConnectionError("Cola MQTT llena"))
+        return fut
+
+    async def publish(self, topic: str, message, qos: int = 1, timeout: float = 10) -> None:
+        """Publica y espera la confirmación (PUBACK en QoS1)."""
+        await asyncio.wait_for(self.submit(topic, message, qos), timeout=timeout)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
 
+    # ---------------------------------------------------------
+    # Loop de conexión
+    # ---------------------------------------------------------
+    async def _run(self):
+        backoff = 1
+        slots = asyncio.Semaphore(self.max_inflight)
+
+        while True:
+            try:
+                async with Client(
+                    hostname=AWS_IOT_ENDPOINT,
+                    port=PORT,
+                    tls_context=ssl_context,
+                    keepalive=60,
+                ) as client:
+                    self.connected = True
+                    backoff = 1
+                    print(f"✅ Publisher MQTT conectado a {AWS_IOT_ENDPOINT}")
+
+                    # Se dispara cuando un publish falla → forzar reconexión
+                    self._broken = asyncio.Event()
+                    broken = asyncio.create_task(self._broken.wait())
+                    try:
+                        while True:
+                            getter = asyncio.create_task(self._queue.get())
+                            await asyncio.wait({getter, broken}, return_when=asyncio.FIRST_COMPLETED)
+
+                            if broken.done():
+                                if not getter.cancel():
+                                    # ya había sacado un mensaje de la cola → devolverlo
+                                    self._requeue(getter.result())
+                                raise ConnectionError("conexión MQTT perdida")
+
+                            item = getter.result()
+                            await slots.acquire()
+                            task = asyncio.create_task(self._publish_one(client, item, slots))
+                            self._inflight.add(task)
+                            task.add_done_callback(self._inflight.discard)
+                    finally:
+                        broken.cancel()
+
+            except asyncio.CancelledError:
+                self.connected = False
+                raise
+            except Exception as e:
+                self.connected = False
+                self.stats["reconnects"] += 1
+                print(f"⚠️ Publisher MQTT desconectado: {e} → reintento en {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    def _requeue(self, item) -> bool:
+        """
+        Devuelve un mensaje a la cola sin esperar (nunca bloquea contra los
+        productores). Si la cola está llena se descarta y falla su future.
+        """
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            topic, *_, fut, _ = item
+            self.stats["failed"] += 1
+            print(f"⚠️ Cola MQTT llena, se descarta el mensaje a {topic}")
+            if not fut.done():
+                fut.set_exception(ConnectionError("Cola MQTT llena"))
+            return False
+
+    async def _publish_one(self, client: Client, item, slots: asyncio.Semaphore):
+        topic, payload, qos, attempts, fut, t0 = item
+        error = None
+        try:
+            await client.publish(topic, payload, qos=qos, timeout=self.publish_timeout)
+        except Exception as e:
+            error = e
+        finally:
+            # El slot se libera ANTES de reencolar
+            slots.release()
+
+        if error is not None:
+            self._broken.set()
+            if attempts + 1 < self.max_retries and not fut.done():
+                # Se reencola: sale cuando vuelva la conexión
+                if self._requeue((topic, payload, qos, attempts + 1, fut, t0)):
+                    self.stats["retried"] += 1
+            else:
+                self.stats["failed"] += 1
+                if not fut.done():
+                    fut.set_exception(error)
+            return
+
+        latency_ms = (time.perf_counter() - t0) * 1000
+        self.stats["published"] += 1
+        self.stats["last_latency_ms"] = round(latency_ms, 2)
+        prev = self.stats["avg_latency_ms"]
+        self.stats["avg_latency_ms"] = round(latency_ms if prev is None else 0.9 * prev + 0.1 * latency_ms, 2)
+
+        if not fut.done():
+            fut.set_result(None)
+        print(f"📤 Mensaje publicado en {topic} ({latency_ms:.1f} ms)")
+
+
+# Instancia global (la arranca/detiene main.py)
+publisher = MqttPublisher()
+
+
+async def mqtt_publish_message(topic: str, message: dict):
+    """Publica un mensaje JSON a AWS IoT Core usando el publisher persistente."""
     try:
-        async with Client(
-            hostname=AWS_IOT_ENDPOINT,
-            port=PORT,
-            #ssl=ssl_context
-            tls_context=ssl_context,
-            keepalive=60
-        ) as client:
-            payload = json.dumps(message)
-            print(f"📡 Conectado a AWS IoT ({AWS_IOT_ENDPOINT}) → publicando en {topic}")
-            await client.publish(topic, payload, qos=1)  # QoS asegura entrega
-            await asyncio.sleep(0.5)  # 🔹 Espera medio segundo antes de cerrar
-            print(f"📤 Mensaje publicado en {topic}: {payload}")
+        await publisher.publish(topic, message, qos=1)
     except Exception as e:
         print(f"❌ Error enviando mensaje a AWS IoT Core: {e}")
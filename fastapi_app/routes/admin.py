@@ -1,11 +1,19 @@
 
+import time
+import asyncio
+from datetime import datetime, timedelta
 from fastapi import APIRouter, Depends, HTTPException
 from utils.security import get_current_user, get_password_hash
 from utils.permissions import require_admin
-from utils.dynamodb_setup import dynamodb, USERS_TABLE_NAME
+from boto3.dynamodb.conditions import Key
+from utils.dynamodb_setup import dynamodb, USERS_TABLE_NAME, sensor_table
 from typing import List, Optional
 from pydantic import BaseModel
 from services.device_user_cache import refresh_user_entry
+from services.command_tracker import command_tracker
+from utils.ws_manager import manager
+from utils.email_service import notifier
+from utils.ml_utils import registry as ml_registry, set_detector, detectors_info, rebuild_state
 
 router = APIRouter(prefix="/api/admin", tags=["admin"])
 
@@ -35,6 +43,11 @@ class DevicePermission(BaseModel):
     thresholds: Optional[dict] = None
 
 
+class DetectorSelection(BaseModel):
+    detector: str
+    device_id: Optional[str] = None   # None = detector global
+
+
 class UserCreate(BaseModel):
     email: str
     password: str
@@ -369,6 +382,92 @@ def update_user_notifications(email: str, device_id: str, payload: dict, user=De
     return {"msg": "Notificaciones actualizadas correctamente"}
 
 
+# ---------------------------------------------------------
+# Latencia de comandos por dispositivo
+# ---------------------------------------------------------
+@router.get("/commands/latency")
+def get_commands_latency(user=Depends(get_current_user)):
+    """Latencia comando → ACK y timeouts de todos los dispositivos (detectar equipos lentos)."""
+    require_admin(user)
+    return command_tracker.stats()
+
+
+# ---------------------------------------------------------
+# Estado de las conexiones WebSocket
+# ---------------------------------------------------------
+@router.get("/ws/stats")
+def get_ws_stats(user=Depends(get_current_user)):
+    """Profundidad de cola, descartes y latencia de envío por cliente WS."""
+    require_admin(user)
+    return manager.stats()
+
+
+@router.get("/email/stats")
+def get_email_stats(user=Depends(get_current_user)):
+    """Cola de notificaciones por mail: profundidad, envíos, reintentos y latencia."""
+    require_admin(user)
+    return notifier.get_stats()
+
+
+@router.get("/ml/stats")
+def get_ml_stats(user=Depends(get_current_user)):
+    """Dispositivos con estado ML en memoria, uso estimado y descartes LRU."""
+    require_admin(user)
+    return ml_registry.stats()
+
+
+@router.get("/ml/detectors")
+def get_ml_detectors(user=Depends(get_current_user)):
+    require_admin(user)
+    return detectors_info()
+
+
+@router.put("/ml/detector")
+def put_ml_detector(body: DetectorSelection, user=Depends(get_current_user)):
+    """Elige el detector de anomalías global o de un dispositivo (en memoria)."""
+    require_admin(user)
+    try:
+        set_detector(body.detector, body.device_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return detectors_info()
+
+
+def _load_history(device_id: str, since: str):
+    temps, hums = [], []
+    kwargs = {
+        "KeyConditionExpression": Key("device_id").eq(device_id) & Key("timestamp").gte(since),
+        "ProjectionExpression": "temperature, humidity",
+    }
+    while True:
+        resp = sensor_table.query(**kwargs)
+        for it in resp.get("Items", []):
+            t, h = it.get("temperature"), it.get("humidity")
+            temps.append(float(t) if t is not None else None)
+            hums.append(float(h) if h is not None else None)
+        if "LastEvaluatedKey" not in resp:
+            return temps, hums
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+
+@router.post("/ml/rebuild/{device_id}")
+async def post_ml_rebuild(device_id: str, hours: int = 168, user=Depends(get_current_user)):
+    """Reconstruye el estado ML de un dispositivo desde SensorData (default: última semana)."""
+    require_admin(user)
+    since = (datetime.utcnow() - timedelta(hours=hours)).isoformat()
+    temps, hums = await asyncio.to_thread(_load_history, device_id, since)
+    if not temps:
+        raise HTTPException(status_code=404, detail="Sin lecturas en el período")
+
+    t0 = time.perf_counter()
+    rebuild_state(device_id, temps, hums)
+    return {
+        "device_id": device_id,
+        "readings": len(temps),
+        "rebuild_ms": round((time.perf_counter() - t0) * 1000, 2),
+    }
+
+
 #################
 @router.get("/debug/cache")
 def debug_cache():
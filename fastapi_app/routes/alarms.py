@@ -1,9 +1,21 @@
+import json
+import base64
+from typing import Literal
 from fastapi import APIRouter, Depends, HTTPException, Query
 from utils.security import get_current_user
 from utils.permissions import require_admin
-from utils.dynamodb_setup import dynamodb, ALARM_LOG_TABLE
+from utils.dynamodb_setup import (
+    dynamodb,
+    index_active,
+    ALARM_LOG_TABLE,
+    ALARM_USER_INDEX,
+    ALARM_DEVICE_INDEX,
+    ALARM_TIME_INDEX,
+    ALARM_LOG_PARTITION,
+)
 from boto3.dynamodb.conditions import Key, Attr
-from services.alarm_service import set_cooldown_minutes, get_cooldown_minutes
+from botocore.exceptions import ClientError
+from services.alarm_service import set_cooldown_minutes, get_cooldown_minutes, reset_cooldowns
 from pydantic import BaseModel
 from utils.email_service import send_email
 
@@ -11,10 +23,106 @@ router = APIRouter(prefix="/api", tags=["alarms"])
 
 alarm_table = dynamodb.Table(ALARM_LOG_TABLE)
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_PAGE_READS = 20   # lecturas de DynamoDB por página cuando hay FilterExpression
+
+# Atributos de clave del cursor según el índice (None = tabla base, vía scan)
+KEY_ATTRS = {
+    None: ("alarm_id",),
+    ALARM_USER_INDEX: ("alarm_id", "user_email", "timestamp"),
+    ALARM_DEVICE_INDEX: ("alarm_id", "device_id", "timestamp"),
+    ALARM_TIME_INDEX: ("alarm_id", "log", "timestamp"),
+}
+
 class CooldownConfig(BaseModel):
     minutes: int
 
 
+# =====================================================
+# Paginación (cursor = LastEvaluatedKey en base64)
+# =====================================================
+def _encode_cursor(last_key: dict | None) -> str | None:
+    if not last_key:
+        return None
+    raw = json.dumps(last_key, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def _decode_cursor(cursor: str | None, key_attrs: tuple) -> dict | None:
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        # Debe ser exactamente la clave de la tabla/índice que se consulta
+        if not isinstance(key, dict) or sorted(key) != sorted(key_attrs):
+            raise ValueError
+        if not all(isinstance(v, str) for v in key.values()):
+            raise ValueError
+        return key
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+
+def _time_range(key_cond, since: str | None, until: str | None):
+    ts = Key("timestamp")
+    if since and until:
+        return key_cond & ts.between(since, until)
+    if since:
+        return key_cond & ts.gte(since)
+    if until:
+        return key_cond & ts.lte(until)
+    return key_cond
+
+
+def _attr_range(filter_exp, since: str | None, until: str | None):
+    """Rango temporal como FilterExpression (para el camino por scan)."""
+    for exp in (since and Attr("timestamp").gte(since), until and Attr("timestamp").lte(until)):
+        if exp:
+            filter_exp = exp if filter_exp is None else (filter_exp & exp)
+    return filter_exp
+
+
+def _page(method, kwargs: dict, page_size: int, cursor: str | None) -> dict:
+    """
+    Arma una página de query/scan con next_cursor.
+    Limit se aplica ANTES del FilterExpression, así que se sigue leyendo
+    hasta juntar page_size ítems, agotar la tabla o llegar a MAX_PAGE_READS.
+    Lo que sobra se descarta y el cursor apunta al último ítem devuelto.
+    """
+    key_attrs = KEY_ATTRS[kwargs.get("IndexName")]
+    start = _decode_cursor(cursor, key_attrs)
+    if start:
+        kwargs["ExclusiveStartKey"] = start
+
+    items = []
+    last_key = None
+    kwargs["Limit"] = page_size
+    for _ in range(MAX_PAGE_READS):
+        try:
+            resp = method(**kwargs)
+        except ClientError as e:
+            # ExclusiveStartKey que no corresponde a la tabla/índice
+            if start and e.response.get("Error", {}).get("Code") == "ValidationException":
+                raise HTTPException(status_code=400, detail="Cursor inválido")
+            raise
+        items.extend(resp.get("Items", []))
+        last_key = resp.get("LastEvaluatedKey")
+        if not last_key or len(items) >= page_size:
+            break
+        kwargs["ExclusiveStartKey"] = last_key
+
+    if len(items) > page_size:
+        items = items[:page_size]
+        last_key = {k: items[-1][k] for k in key_attrs}
+
+    return {
+        "count": len(items),
+        "items": items,
+        "next_cursor": _encode_cursor(last_key),
+    }
+
+
 # =====================================================
 # Usuario → ver SUS alarmas
 # =====================================================
@@ -23,30 +131,41 @@ def get_user_alarms(
     device_id: str | None = None,
     since: str | None = None,
     until: str | None = None,
+    page_size: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    order: Literal["desc", "asc"] = "desc",
     user = Depends(get_current_user)
 ):
     email = user["email"]
-
-    # Query base: Buscar alarmas del usuario
-    filter_exp = Attr("user_email").eq(email)
+    index = ALARM_DEVICE_INDEX if device_id else ALARM_USER_INDEX
+
+    # Índice todavía construyéndose → scan filtrado (orden solo dentro de la página)
+    if not index_active(ALARM_LOG_TABLE, index):
+        filter_exp = Attr("user_email").eq(email)
+        if device_id:
+            filter_exp = filter_exp & Attr("device_id").eq(device_id)
+        kwargs = {"FilterExpression": _attr_range(filter_exp, since, until)}
+        page = _page(alarm_table.scan, kwargs, page_size, cursor)
+        page["items"].sort(key=lambda x: x["timestamp"], reverse=(order == "desc"))
+        return page
 
     if device_id:
-        filter_exp = filter_exp & Attr("device_id").eq(device_id)
-
-    if since:
-        filter_exp = filter_exp & Attr("timestamp").gte(since)
-
-    if until:
-        filter_exp = filter_exp & Attr("timestamp").lte(until)
-
-    resp = alarm_table.scan(
-        FilterExpression=filter_exp
-    )
-
-    alarms = resp.get("Items", [])
-    alarms.sort(key=lambda x: x["timestamp"], reverse=True)
+        # Query por índice (device_id, timestamp), filtrando las del usuario
+        kwargs = {
+            "IndexName": ALARM_DEVICE_INDEX,
+            "KeyConditionExpression": _time_range(Key("device_id").eq(device_id), since, until),
+            "FilterExpression": Attr("user_email").eq(email),
+            "ScanIndexForward": order == "asc",
+        }
+    else:
+        # Query por índice (user_email, timestamp): solo lee las alarmas del usuario
+        kwargs = {
+            "IndexName": ALARM_USER_INDEX,
+            "KeyConditionExpression": _time_range(Key("user_email").eq(email), since, until),
+            "ScanIndexForward": order == "asc",
+        }
 
-    return {"count": len(alarms), "items": alarms}
+    return _page(alarm_table.query, kwargs, page_size, cursor)
 
 
 # =====================================================
@@ -57,32 +176,41 @@ def admin_list_alarms(
     device_id: str | None = None,
     since: str | None = None,
     until: str | None = None,
+    page_size: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    order: Literal["desc", "asc"] = "desc",
     user = Depends(get_current_user)
 ):
+    """
+    Todas las alarmas (o las de un dispositivo) en orden temporal entre
+    páginas. Mientras el índice necesario se está construyendo el listado
+    sale de un scan: SIN orden global (solo dentro de cada página).
+    """
     require_admin(user)
 
-    filter_exp = None
-
+    # Con dispositivo → índice (device_id, timestamp); sin él → (log, timestamp)
     if device_id:
-        filter_exp = Attr("device_id").eq(device_id)
-
-    if since:
-        exp = Attr("timestamp").gte(since)
-        filter_exp = exp if filter_exp is None else (filter_exp & exp)
-
-    if until:
-        exp = Attr("timestamp").lte(until)
-        filter_exp = exp if filter_exp is None else (filter_exp & exp)
-
-    if filter_exp:
-        resp = alarm_table.scan(FilterExpression=filter_exp)
+        index, key_cond = ALARM_DEVICE_INDEX, Key("device_id").eq(device_id)
     else:
-        resp = alarm_table.scan()
+        index, key_cond = ALARM_TIME_INDEX, Key("log").eq(ALARM_LOG_PARTITION)
+
+    if index_active(ALARM_LOG_TABLE, index):
+        kwargs = {
+            "IndexName": index,
+            "KeyConditionExpression": _time_range(key_cond, since, until),
+            "ScanIndexForward": order == "asc",
+        }
+        return _page(alarm_table.query, kwargs, page_size, cursor)
 
-    alarms = resp.get("Items", [])
-    alarms.sort(key=lambda x: x["timestamp"], reverse=True)
+    # Índice construyéndose: scan paginado (orden temporal solo dentro de cada página)
+    kwargs = {}
+    filter_exp = _attr_range(Attr("device_id").eq(device_id) if device_id else None, since, until)
+    if filter_exp is not None:
+        kwargs["FilterExpression"] = filter_exp
 
-    return {"count": len(alarms), "items": alarms}
+    page = _page(alarm_table.scan, kwargs, page_size, cursor)
+    page["items"].sort(key=lambda x: x["timestamp"], reverse=(order == "desc"))
+    return page
 
 
 # =====================================================
@@ -102,6 +230,7 @@ def reset_all_alarms(user=Depends(get_current_user)):
 
         for item in items:
             table.delete_item(Key={"alarm_id": item["alarm_id"]})
+        reset_cooldowns()
 
         return {"msg": f"🧹 {len(items)} alarmas eliminadas correctamente"}
     except Exception as e:
@@ -2,7 +2,7 @@
 
 from db import (
     send_command,
-    get_status,
+    send_commands,
     get_sensor_data,
     get_thresholds,
     save_thresholds,
@@ -13,14 +13,28 @@ from db import (
 from utils.dynamodb_setup import dynamodb, USERS_TABLE_NAME
 from fastapi import APIRouter, Depends, HTTPException, Query
 from utils.security import get_current_user
-from utils.permissions import check_device_permission
+from utils.permissions import check_device_permission, filter_permitted_devices
 from utils.ws_manager import manager
+from services.command_tracker import command_tracker
+from services.shadow_service import (
+    get_shadow,
+    update_desired,
+    current_value,
+    compute_delta,
+    commands_from_delta,
+    digital_state,
+    needs_status_history,
+    is_online,
+    update_desired_many,
+    list_shadow_device_ids,
+)
 from boto3.dynamodb.conditions import Key
 from pydantic import BaseModel
 from decimal import Decimal
 from datetime import datetime, timezone
 import os, sys, asyncio
-from typing import Optional
+from fnmatch import fnmatch
+from typing import Optional, List
 
 # Forzar que use el mqtt_utils.py real de la raíz
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -46,6 +60,13 @@ class ThresholdsUpdate(BaseModel):
     hum_min: Optional[float] = None
     hum_max: Optional[float] = None
 
+class BulkCommand(BaseModel):
+    device_ids: Optional[List[str]] = None   # lista explícita de dispositivos
+    selector: Optional[str] = None           # patrón glob sobre los permitidos ("*", "esp32_lab*")
+    led: Optional[str] = None                # "rojo" / "verde"
+    action: Optional[str] = None             # "on" / "off"
+    command: Optional[dict] = None           # comando MQTT libre (requiere write_data)
+
 
 # ==========================================================
 #  Utils
@@ -56,17 +77,6 @@ def to_float_safe(value):
     return value
 
 
-def is_online(value):
-    """Normaliza el campo 'online' para distintos formatos"""
-    if isinstance(value, bool):
-        return value
-    if isinstance(value, (int, float)):
-        return value != 0
-    if isinstance(value, str):
-        return value.strip().lower() in ("true", "1", "yes", "on")
-    return False
-
-
 # ==========================================================
 #  Obtener último estado de LED
 # ==========================================================
@@ -90,56 +100,224 @@ async def get_last_led_state(device_id: str, led_color: str) -> bool:
         return False
 
 
+# ==========================================================
+#  Estado digital (online + LEDs)
+# ==========================================================
+async def get_digital_state(device_id: str):
+    """
+    Devuelve (online, led_red, led_green).
+    Lee el shadow con un único get_item; los campos que el dispositivo
+    todavía no reportó en el shadow se toman del historial de DeviceStatus.
+    Se muestra lo REPORTADO por el dispositivo (no el estado pedido):
+    desired solo se usa si el dispositivo nunca informó ese LED.
+    """
+    shadow = await get_shadow(device_id)
+    if not needs_status_history(shadow):
+        return digital_state(shadow, [])
+
+    items = []
+    try:
+        status_table = dynamodb.Table(DEVICE_STATUS_TABLE)
+        resp = status_table.query(
+            KeyConditionExpression=Key("device_id").eq(device_id),
+            ScanIndexForward=False,
+            Limit=20,
+        )
+        items = resp.get("Items", [])
+    except Exception as e:
+        print(f"⚠️ Error leyendo DeviceStatus {device_id}: {e}")
+
+    return digital_state(shadow, items)
+
+
 # ==========================================================
 #  Toggle LED
 # ==========================================================
 @router.post("/api/devices/{device_id}/led/{color}")
-async def toggle_led(device_id: str, color: str, user=Depends(get_current_user)):
+async def toggle_led(
+    device_id: str,
+    color: str,
+    state: Optional[str] = Query(None, description="on/off; si se omite alterna el estado actual"),
+    wait_ack: bool = Query(False, description="Esperar la confirmación del dispositivo"),
+    ack_timeout: float = Query(5.0, gt=0, le=30, description="Segundos máximos de espera del ACK"),
+    user=Depends(get_current_user),
+):
     LED_MAP = {"rojo": "led_red", "verde": "led_green"}
-    COLOR_MAP = {"rojo": "red", "verde": "green"}
 
     led_key = LED_MAP.get(color)
-    mqtt_color = COLOR_MAP.get(color)
-    if not led_key or not mqtt_color:
+    if not led_key:
         raise HTTPException(status_code=400, detail=f"Color '{color}' no soportado")
+    if state is not None and state not in ("on", "off"):
+        raise HTTPException(status_code=400, detail="state debe ser 'on' u 'off'")
 
     print(f"🔍 Verificando permisos para {user['email']} → {device_id}/{led_key}")
     check_device_permission(user, device_id, led_key)
 
-    # Estado previo
-    record = await get_status(device_id)
-    prev_state = record.get("status", {}).get(led_key, False) if record else False
-    new_state = not prev_state
-    action = "on" if new_state else "off"
-    print(f"🔁 [DECIDE] {led_key}: {prev_state} → {new_state}")
+    # Shadow: escritura condicional sobre la versión (reintenta si hay conflicto)
+    def compute_changes(shadow):
+        if state is not None:
+            return {led_key: state == "on"}
+        return {led_key: not bool(current_value(shadow, led_key))}
 
-    # MQTT
-    payload = {"command": "led_control", "led": mqtt_color, "action": action}
-    await send_command(device_id, payload)
+    result = await update_desired(device_id, compute_changes)
+    if result is None:
+        raise HTTPException(status_code=409, detail="No se pudo actualizar el estado del dispositivo, reintentá")
 
-    # Actualizar DeviceStatus
-    try:
-        table = dynamodb.Table(DEVICE_STATUS_TABLE)
-        table.put_item(
-            Item={
-                "device_id": device_id,
-                "timestamp": datetime.utcnow().isoformat(),
-                "status": {"thing": device_id, "online": True, led_key: new_state},
-            }
-        )
-    except Exception as e:
-        print(f"⚠️ Error actualizando DeviceStatus: {e}")
-
-    # Broadcast WS
+    new_state = result["changes"][led_key]
+    action = "on" if new_state else "off"
+    print(f"🔁 [DECIDE] {led_key} → {new_state} (v{result['shadow'].get('version')})")
+
+    # MQTT: solo la clave recién cambiada (siempre, puede haber otro comando
+    # en vuelo). Lo pendiente de otros LEDs se re-entrega al reconectar.
+    cmd_id = None
+    for payload in commands_from_delta(result["changes"]):
+        sent = await send_command(device_id, payload)
+        cmd_id = sent.get("cmd_id")
+
+    # ACK opcional del dispositivo
+    ack = None
+    if wait_ack and cmd_id:
+        ack = await command_tracker.wait(cmd_id, ack_timeout)
+        if ack is None:
+            raise HTTPException(status_code=504, detail=f"{device_id} no confirmó el comando a tiempo")
+
+    # Broadcast WS: hasta que llegue el ACK el estado es solo "pedido"
     try:
         await manager.broadcast_device_update(
             device_id,
-            {"estado": "activo", led_key: new_state, "last_update": datetime.utcnow().isoformat()},
+            {
+                "estado": "activo",
+                led_key: new_state,
+                "pending": ack is None,
+                "last_update": datetime.utcnow().isoformat(),
+            },
         )
     except Exception as e:
         print(f"⚠️ WS error: {e}")
 
-    return {"status": "ok", "device_id": device_id, "led": color, "action": action}
+    return {
+        "status": "ok",
+        "device_id": device_id,
+        "led": color,
+        "action": action,
+        "version": int(result["shadow"].get("version", 0)),
+        "cmd_id": cmd_id,
+        "acked": ack is not None,
+        "latency_ms": ack["latency_ms"] if ack else None,
+    }
+
+
+# ==========================================================
+#  Latencia de comandos (ida y vuelta)
+# ==========================================================
+@router.get("/api/devices/{device_id}/commands/latency")
+async def get_command_latency(device_id: str, user=Depends(get_current_user)):
+    """Histograma de latencia comando → ACK y cantidad de timeouts del dispositivo."""
+    check_device_permission(user, device_id, "read_data")
+    return {"device_id": device_id, **command_tracker.stats(device_id)}
+
+
+# ==========================================================
+#  Shadow del dispositivo
+# ==========================================================
+@router.get("/api/devices/{device_id}/shadow")
+async def get_device_shadow(device_id: str, user=Depends(get_current_user)):
+    """Devuelve el shadow (desired/reported/version) de un dispositivo."""
+    check_device_permission(user, device_id, "read_data")
+    shadow = await get_shadow(device_id)
+    return {
+        "device_id": device_id,
+        "version": int(shadow.get("version", 0)),
+        "desired": shadow.get("desired", {}),
+        "reported": shadow.get("reported", {}),
+        "delta": compute_delta(shadow),
+        "updated_at": shadow.get("updated_at"),
+    }
+
+
+# ==========================================================
+#  Comandos masivos (grupos de dispositivos)
+# ==========================================================
+BULK_MAX_DEVICES = 500
+
+@router.post("/api/devices/commands/bulk")
+async def bulk_command(req: BulkCommand, user=Depends(get_current_user)):
+    """
+    Envía el mismo comando a muchos dispositivos en una sola llamada:
+      - permisos chequeados en una pasada
+      - shadows (desired) escritos en lote
+      - comandos publicados en paralelo por la conexión MQTT compartida
+    Devuelve el resultado por dispositivo.
+    """
+    LED_MAP = {"rojo": "led_red", "verde": "led_green"}
+
+    # --- Validar comando ---
+    if (req.led is None) == (req.command is None):
+        raise HTTPException(status_code=400, detail="Indicá 'led' + 'action' o un 'command'")
+
+    if req.led is not None:
+        led_key = LED_MAP.get(req.led)
+        if not led_key:
+            raise HTTPException(status_code=400, detail=f"Color '{req.led}' no soportado")
+        if req.action not in ("on", "off"):
+            raise HTTPException(status_code=400, detail="action debe ser 'on' u 'off'")
+        permission_key = led_key
+    else:
+        led_key = None
+        permission_key = "write_data"
+
+    # --- Resolver dispositivos destino ---
+    if req.device_ids:
+        targets = list(dict.fromkeys(req.device_ids))
+    elif req.selector:
+        if user.get("role") == "admin":
+            universe = list_shadow_device_ids()
+        else:
+            universe = [d.get("device_id") for d in user.get("allowed_devices", []) if d.get("device_id")]
+        targets = sorted(d for d in universe if fnmatch(d, req.selector))
+    else:
+        raise HTTPException(status_code=400, detail="Indicá 'device_ids' o 'selector'")
+
+    if len(targets) > BULK_MAX_DEVICES:
+        raise HTTPException(status_code=400, detail=f"Máximo {BULK_MAX_DEVICES} dispositivos por llamada")
+
+    # --- Permisos (una sola pasada) ---
+    allowed, denied = filter_permitted_devices(user, targets, permission_key)
+    results = {d: {"status": "forbidden"} for d in denied}
+    print(f"📦 [BULK] {user['email']} → {len(allowed)} permitidos, {len(denied)} denegados")
+
+    # --- Shadow en lote + comandos derivados ---
+    commands = {}
+    if led_key:
+        new_state = req.action == "on"
+        shadows = await update_desired_many({d: {led_key: new_state} for d in allowed})
+        for dev_id in allowed:
+            res = shadows.get(dev_id)
+            if res is None:
+                results[dev_id] = {"status": "error", "error": "shadow"}
+                continue
+            commands[dev_id] = commands_from_delta(res["changes"])
+    else:
+        commands = {d: [req.command] for d in allowed}
+
+    # --- Publicación en paralelo ---
+    results.update(await send_commands(commands))
+
+    # --- Broadcast WS ---
+    if led_key:
+        now = datetime.utcnow().isoformat()
+        for dev_id in commands:
+            if results[dev_id]["status"] != "ok":
+                continue
+            try:
+                await manager.broadcast_device_update(
+                    dev_id, {"estado": "activo", led_key: new_state, "last_update": now}
+                )
+            except Exception as e:
+                print(f"⚠️ WS error: {e}")
+
+    ok = sum(1 for r in results.values() if r["status"] == "ok")
+    return {"status": "ok", "total": len(targets), "succeeded": ok, "results": results}
 
 
 # ==========================================================
@@ -153,7 +331,6 @@ async def list_user_devices(user=Depends(get_current_user)):
     """
 
     sensor_table = dynamodb.Table("SensorData")
-    status_table = dynamodb.Table("DeviceStatus")
 
     is_admin = user.get("role") == "admin"
     devices_result = []
@@ -206,30 +383,7 @@ async def list_user_devices(user=Depends(get_current_user)):
             ts = item.get("timestamp")
 
             # Estado digital
-            online = led_red = led_green = None
-            try:
-                resp = status_table.query(
-                    KeyConditionExpression=Key("device_id").eq(device_id),
-                    ScanIndexForward=False,
-                    Limit=20,
-                )
-                for s_item in resp.get("Items", []):
-                    s = s_item.get("status")
-                    if not isinstance(s, dict):
-                        continue
-
-                    if online is None and "online" in s:
-                        online = s["online"]
-                    if led_red is None and "led_red" in s:
-                        led_red = s["led_red"]
-                    if led_green is None and "led_green" in s:
-                        led_green = s["led_green"]
-
-                    if online is not None and led_red is not None and led_green is not None:
-                        break
-
-            except Exception as e:
-                print(f"⚠️ Error leyendo DeviceStatus {device_id}: {e}")
+            online, led_red, led_green = await get_digital_state(device_id)
 
             estado = "activo" if is_online(online) else "desconectado"
 
@@ -285,30 +439,7 @@ async def list_user_devices(user=Depends(get_current_user)):
             print(f"⚠️ Error leyendo SensorData {device_id}: {e}")
 
         # Estado digital
-        online = led_red = led_green = None
-        try:
-            resp2 = status_table.query(
-                KeyConditionExpression=Key("device_id").eq(device_id),
-                ScanIndexForward=False,
-                Limit=20,
-            )
-            for s_item in resp2.get("Items", []):
-                s = s_item.get("status", {})
-                if not isinstance(s, dict):
-                    continue
-
-                if online is None and "online" in s:
-                    online = s["online"]
-                if led_red is None and "led_red" in s:
-                    led_red = s["led_red"]
-                if led_green is None and "led_green" in s:
-                    led_green = s["led_green"]
-
-                if online is not None and led_red is not None and led_green is not None:
-                    break
-
-        except Exception as e:
-            print(f"⚠️ Error leyendo DeviceStatus {device_id}: {e}")
+        online, led_red, led_green = await get_digital_state(device_id)
 
         estado = "activo" if is_online(online) else "desconectado"
 
@@ -420,7 +551,6 @@ async def get_device_data(
 async def get_device_summary(device_id: str, user=Depends(get_current_user)):
     """Devuelve el resumen de un dispositivo (última lectura + estado + permisos)"""
     sensor_table = dynamodb.Table("SensorData")
-    status_table = dynamodb.Table("DeviceStatus")
 
     is_admin = user.get("role") == "admin"
 
@@ -447,23 +577,7 @@ async def get_device_summary(device_id: str, user=Depends(get_current_user)):
     except Exception as e:
         print(f"⚠️ Error leyendo SensorData {device_id}: {e}")
 
-    online = led_red = led_green = None
-    try:
-        resp2 = status_table.query(KeyConditionExpression=Key("device_id").eq(device_id), ScanIndexForward=False, Limit=20)
-        for s_item in resp2.get("Items", []):
-            s = s_item.get("status", {})
-            if not isinstance(s, dict):
-                continue
-            if online is None and "online" in s:
-                online = s["online"]
-            if led_red is None and "led_red" in s:
-                led_red = s["led_red"]
-            if led_green is None and "led_green" in s:
-                led_green = s["led_green"]
-            if online is not None and led_red is not None and led_green is not None:
-                break
-    except Exception as e:
-        print(f"⚠️ Error leyendo DeviceStatus {device_id}: {e}")
+    online, led_red, led_green = await get_digital_state(device_id)
 
     estado = "activo" if is_online(online) else "desconectado"
 
@@ -0,0 +1,138 @@
+# services/alarm_rules.py
+"""
+Reglas de alarma por umbral, compiladas por dispositivo:
+
+    alarm_rules._rules["esp32_01"] → DeviceRules
+        users   [u0, u1, ...]            (una fila por usuario)
+        lo      [[temp_min, hum_min], ...]   NaN = sin umbral
+        hi      [[temp_max, hum_max], ...]
+        notify  [[temp, hum], ...]           flags de notificación
+        email   [bool, ...]
+
+Cada lectura se evalúa contra TODOS los usuarios del dispositivo en una
+sola pasada de NumPy (NaN en umbral o valor nunca dispara). La tabla de
+un dispositivo se compila la primera vez que se usa y se invalida cuando
+cambia device_user_cache (listener), así nunca queda desactualizada.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from services.alarm_service import process_alarm
+from services.device_user_cache import add_cache_listener, get_users_for_device
+
+# Orden de columnas en la evaluación: (tipo, métrica 0=temp 1=hum, lado)
+ALARM_TYPES = (
+    ("TEMP_LOW", 0, "lo"),
+    ("TEMP_HIGH", 0, "hi"),
+    ("HUM_LOW", 1, "lo"),
+    ("HUM_HIGH", 1, "hi"),
+)
+
+
+def _as_float(v) -> float:
+    if v is None:
+        return np.nan
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class DeviceRules:
+    __slots__ = ("users", "lo", "hi", "notify", "email")
+
+    def __init__(self, device_id: str, users: List[dict]) -> None:
+        self.users: List[dict] = []
+        lo, hi, notify, email = [], [], [], []
+
+        for user in users:
+            # Primera entrada de allowed_devices para este device
+            dev = next((ad for ad in user.get("allowed_devices", []) if ad.get("device_id") == device_id), None)
+            if not dev:
+                continue
+
+            th = dev.get("thresholds") or {}
+            nt = dev.get("notifications") or {}
+            self.users.append(user)
+            lo.append((_as_float(th.get("temp_min")), _as_float(th.get("hum_min"))))
+            hi.append((_as_float(th.get("temp_max")), _as_float(th.get("hum_max"))))
+            notify.append((bool(nt.get("temp", True)), bool(nt.get("hum", True))))
+            email.append(bool(nt.get("email", False)))
+
+        n = len(self.users)
+        self.lo = np.array(lo, dtype=np.float64).reshape(n, 2)
+        self.hi = np.array(hi, dtype=np.float64).reshape(n, 2)
+        self.notify = np.array(notify, dtype=bool).reshape(n, 2)
+        self.email = np.array(email, dtype=bool)
+
+    def evaluate(self, temp, hum) -> List[Tuple[dict, str, float, float, bool]]:
+        """[(user, alarm_type, valor, umbral, enviar_email)] en orden usuario → tipo."""
+        if not self.users:
+            return []
+        values = np.array((_as_float(temp), _as_float(hum)))
+
+        with np.errstate(invalid="ignore"):
+            below = (values < self.lo) & self.notify
+            above = (values > self.hi) & self.notify
+        fired = np.stack((below[:, 0], above[:, 0], below[:, 1], above[:, 1]), axis=1)
+        if not fired.any():
+            return []
+
+        result = []
+        for row, col in zip(*np.nonzero(fired)):
+            alarm_type, metric, side = ALARM_TYPES[col]
+            th = (self.lo if side == "lo" else self.hi)[row, metric]
+            result.append((self.users[row], alarm_type, float(values[metric]), float(th), bool(self.email[row])))
+        return result
+
+
+class AlarmRuleTable:
+    def __init__(self) -> None:
+        self._rules: Dict[str, DeviceRules] = {}
+        self.compiled = 0
+
+    def invalidate(self, device_ids=None) -> None:
+        """Descarta las reglas compiladas (None = todas)."""
+        if device_ids is None:
+            self._rules = {}
+            return
+        for dev in device_ids:
+            self._rules.pop(dev, None)
+
+    def rules_for(self, device_id: str) -> DeviceRules:
+        rules = self._rules.get(device_id)
+        if rules is None:
+            rules = DeviceRules(device_id, list(get_users_for_device(device_id)))
+            self._rules[device_id] = rules
+            self.compiled += 1
+        return rules
+
+    def evaluate(self, device_id: str, temp, hum):
+        return self.rules_for(device_id).evaluate(temp, hum)
+
+
+# Instancia global (se invalida sola con los cambios del cache de usuarios)
+alarm_rules = AlarmRuleTable()
+add_cache_listener(alarm_rules.invalidate)
+
+
+# ============================================================
+#   Punto de entrada desde el listener MQTT
+# ============================================================
+def check_device_alarms(device_id: str, temp, hum, now: Optional[datetime] = None) -> int:
+    """Evalúa una lectura contra todos los usuarios del dispositivo; devuelve alarmas disparadas."""
+    rules = alarm_rules.rules_for(device_id)
+    if not rules.users:
+        print(f"ℹ️ No hay usuarios asignados a {device_id}")
+        return 0
+
+    now = now or datetime.utcnow()
+    fired = rules.evaluate(temp, hum)
+    for user, alarm_type, value, th, do_email in fired:
+        try:
+            process_alarm(user, device_id, alarm_type, value, th, do_email, now)
+        except Exception as e:
+            print(f"⚠️ Error en alarmas de {user.get('email')}: {e}")
+    return len(fired)
@@ -3,10 +3,11 @@ import uuid
 import asyncio
 from datetime import datetime, timedelta
 from decimal import Decimal
+from typing import Dict, Optional
 
-from boto3.dynamodb.conditions import Attr
-from utils.dynamodb_setup import dynamodb, ALARM_LOG_TABLE
-from utils.email_service import send_email
+from botocore.exceptions import ClientError
+from utils.dynamodb_setup import dynamodb, ALARM_LOG_TABLE, ALARM_LOG_PARTITION, alarm_cooldown_table
+from utils.email_service import notifier
 from utils.ws_manager import manager
 
 # ============================
@@ -33,22 +34,105 @@ def get_cooldown_minutes():
 
 
 def reset_alarm_log():
-    """Elimina todas las alarmas del AlarmLog."""
+    """Elimina todas las alarmas del AlarmLog (y los cooldowns vigentes)."""
     scan = alarm_table.scan()
     items = scan.get("Items", [])
 
     for it in items:
         alarm_table.delete_item(Key={"alarm_id": it["alarm_id"]})
+    reset_cooldowns()
 
     print("🧹 AlarmLog reseteado (todos los registros eliminados)")
     return len(items)
 
 
+# ============================
+#  Cooldowns
+# ============================
+# Índice en memoria "email#device_id#type" → cooldown_until. La tabla
+# AlarmCooldown (un ítem por clave) es la fuente de verdad entre procesos:
+# tomar el cooldown es un put condicional, sin leer el AlarmLog.
+cooldown_index: Dict[str, datetime] = {}
+
+
+def _cooldown_key(user_email: str, device_id: str, alarm_type: str) -> str:
+    return f"{user_email}#{device_id}#{alarm_type}"
+
+
+def _is_conditional_failure(e: ClientError) -> bool:
+    return e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException"
+
+
+def warm_cooldowns() -> int:
+    """Carga al índice los cooldowns todavía vigentes (al iniciar)."""
+    now = datetime.utcnow()
+    kwargs = {}
+    loaded = 0
+    try:
+        while True:
+            resp = alarm_cooldown_table.scan(**kwargs)
+            for it in resp.get("Items", []):
+                until = datetime.fromisoformat(it["cooldown_until"])
+                if until > now:
+                    cooldown_index[it["cooldown_key"]] = until
+                    loaded += 1
+            if "LastEvaluatedKey" not in resp:
+                break
+            kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+    except Exception as e:
+        print(f"⚠️ No se pudieron precargar cooldowns: {e}")
+    print(f"⏳ Cooldowns vigentes cargados: {loaded}")
+    return loaded
+
+
+def reset_cooldowns() -> None:
+    cooldown_index.clear()
+    kwargs = {"ProjectionExpression": "cooldown_key"}
+    while True:
+        resp = alarm_cooldown_table.scan(**kwargs)
+        for it in resp.get("Items", []):
+            alarm_cooldown_table.delete_item(Key={"cooldown_key": it["cooldown_key"]})
+        if "LastEvaluatedKey" not in resp:
+            break
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+
+def acquire_cooldown(user_email: str, device_id: str, alarm_type: str, now: datetime) -> Optional[str]:
+    """
+    Intenta abrir un cooldown nuevo para la clave. Devuelve cooldown_until
+    (ISO) si la alarma debe dispararse, None si hay un cooldown activo
+    (propio, visto en memoria, o de otro proceso, visto por la condición).
+    """
+    key = _cooldown_key(user_email, device_id, alarm_type)
+    until = cooldown_index.get(key)
+    if until is not None and until > now:
+        return None
+
+    new_until = now + timedelta(minutes=COOLDOWN_MINUTES)
+    try:
+        alarm_cooldown_table.put_item(
+            Item={"cooldown_key": key, "cooldown_until": new_until.isoformat()},
+            ConditionExpression="attribute_not_exists(cooldown_key) OR cooldown_until < :now",
+            ExpressionAttributeValues={":now": now.isoformat()},
+        )
+    except ClientError as e:
+        if not _is_conditional_failure(e):
+            raise
+        # Otro proceso lo tomó: traer su vencimiento para no volver a intentar
+        item = alarm_cooldown_table.get_item(Key={"cooldown_key": key}).get("Item")
+        if item:
+            cooldown_index[key] = datetime.fromisoformat(item["cooldown_until"])
+        return None
+
+    cooldown_index[key] = new_until
+    return new_until.isoformat()
+
+
 # ============================
 #  Envío de alarmas por WS
 # ============================
 async def send_alarm_ws(user_email, device_id, alarm_type, value, threshold):
-    """Envía una alarma por WebSocket."""
+    """Envía una alarma por WebSocket solo al usuario dueño (y a los admins)."""
     msg = {
         "type": "alarm",
         "device_id": device_id,
@@ -62,8 +146,8 @@ async def send_alarm_ws(user_email, device_id, alarm_type, value, threshold):
     }
 
     try:
-        await manager.broadcast(msg)
-        print(f"📡 [WS] Alarma enviada → {device_id} ({alarm_type})")
+        await manager.send_to_user(user_email, msg, device_id=device_id)
+        print(f"📡 [WS] Alarma enviada → {user_email} | {device_id} ({alarm_type})")
     except Exception as e:
         print(f"⚠️ Error enviando alarma WS: {e}")
 
@@ -71,9 +155,52 @@ async def send_alarm_ws(user_email, device_id, alarm_type, value, threshold):
 # ============================
 #  Procesar alarmas
 # ============================
+def process_alarm(user, device_id, alarm_type, value, th, do_email, now=None):
+    """Registra y notifica UNA alarma (si no hay cooldown activo para esa clave)."""
+    now = now or datetime.utcnow()
+
+    # Chequear / tomar cooldown (índice en memoria + put condicional)
+    cooldown_until = acquire_cooldown(user["email"], device_id, alarm_type, now)
+    if cooldown_until is None:
+        print(f"⏳ Cooldown activo: {alarm_type} → {user['email']}")
+        return
+
+    # Registrar en tabla
+    alarm_id = str(uuid.uuid4())
+
+    alarm_table.put_item(Item={
+        "alarm_id": alarm_id,
+        "device_id": device_id,
+        "user_email": user["email"],
+        "type": alarm_type,
+        "value": Decimal(str(value)),
+        "threshold": Decimal(str(th)),
+        "timestamp": now.isoformat(),
+        "cooldown_until": cooldown_until,
+        "sent_email": bool(do_email),
+        "log": ALARM_LOG_PARTITION,      # índice de orden temporal global
+    })
+
+    print(f"📢 Alarma registrada: {alarm_type} | {device_id} | {user['email']}")
+
+    # Enviar email (si configurado) → cola en segundo plano, no bloquea la ingesta
+    if do_email:
+        notifier.submit(
+            user["email"],
+            f"⚠️ Alarma IoT en {device_id}: {alarm_type}",
+            f"Se detectó una alarma:<br><b>Valor:</b> {value}<br><b>Umbral:</b> {th}"
+        )
+
+    # Enviar por WebSocket siempre
+    asyncio.create_task(
+        send_alarm_ws(user["email"], device_id, alarm_type, value, th)
+    )
+
+
 def check_user_threshold_alarms(user, device_id, value_temp, value_hum):
     """
-    Revisa umbrales por usuario/dispositivo.
+    Revisa umbrales de UN usuario/dispositivo (el listener MQTT usa las
+    reglas compiladas de services/alarm_rules.py para todos a la vez).
     NOTA:
       - notifications.email → si enviar mail
       - cooldown siempre se aplica para NO spamear
@@ -98,73 +225,17 @@ def check_user_threshold_alarms(user, device_id, value_temp, value_hum):
 
     now = datetime.utcnow()
 
-    # ------------------------------------------
-    # Auxiliar para procesar una alarma puntual
-    # ------------------------------------------
-    def process_alarm(alarm_type, value, th, do_email):
-        # Chequear cooldown
-        resp = alarm_table.scan(
-            FilterExpression=(
-                Attr("device_id").eq(device_id)
-                & Attr("user_email").eq(user["email"])
-                & Attr("type").eq(alarm_type)
-            )
-        )
-
-        recent = resp.get("Items", [])
-        for r in recent:
-            cooldown = r.get("cooldown_until")
-            if cooldown:
-                try:
-                    dt = datetime.fromisoformat(cooldown)
-                    if dt > now:
-                        print(f"⏳ Cooldown activo: {alarm_type} → {user['email']}")
-                        return
-                except:
-                    pass
-
-        # Registrar en tabla
-        alarm_id = str(uuid.uuid4())
-        cooldown_until = (now + timedelta(minutes=COOLDOWN_MINUTES)).isoformat()
-
-        alarm_table.put_item(Item={
-            "alarm_id": alarm_id,
-            "device_id": device_id,
-            "user_email": user["email"],
-            "type": alarm_type,
-            "value": Decimal(str(value)),
-            "threshold": Decimal(str(th)),
-            "timestamp": now.isoformat(),
-            "cooldown_until": cooldown_until,
-            "sent_email": bool(do_email),
-        })
-
-        print(f"📢 Alarma registrada: {alarm_type} | {device_id} | {user['email']}")
-
-        # Enviar email (si configurado)
-        if do_email:
-            send_email(
-                user["email"],
-                f"⚠️ Alarma IoT en {device_id}: {alarm_type}",
-                f"Se detectó una alarma:<br><b>Valor:</b> {value}<br><b>Umbral:</b> {th}"
-            )
-
-        # Enviar por WebSocket siempre
-        asyncio.create_task(
-            send_alarm_ws(user["email"], device_id, alarm_type, value, th)
-        )
-
     # ============================
     #  TEMP
     # ============================
     if value_temp is not None:
         if thresholds.get("temp_min") is not None and value_temp < thresholds["temp_min"]:
             if notify_temp:
-                process_alarm("TEMP_LOW", value_temp, thresholds["temp_min"], notify_email)
+                process_alarm(user, device_id, "TEMP_LOW", value_temp, thresholds["temp_min"], notify_email, now)
 
         if thresholds.get("temp_max") is not None and value_temp > thresholds["temp_max"]:
             if notify_temp:
-                process_alarm("TEMP_HIGH", value_temp, thresholds["temp_max"], notify_email)
+                process_alarm(user, device_id, "TEMP_HIGH", value_temp, thresholds["temp_max"], notify_email, now)
 
     # ============================
     #  HUM
@@ -172,8 +243,8 @@ def check_user_threshold_alarms(user, device_id, value_temp, value_hum):
     if value_hum is not None:
         if thresholds.get("hum_min") is not None and value_hum < thresholds["hum_min"]:
             if notify_hum:
-                process_alarm("HUM_LOW", value_hum, thresholds["hum_min"], notify_email)
+                process_alarm(user, device_id, "HUM_LOW", value_hum, thresholds["hum_min"], notify_email, now)
 
         if thresholds.get("hum_max") is not None and value_hum > thresholds["hum_max"]:
             if notify_hum:
-                process_alarm("HUM_HIGH", value_hum, thresholds["hum_max"], notify_email)
+                process_alarm(user, device_id, "HUM_HIGH", value_hum, thresholds["hum_max"], notify_email, now)
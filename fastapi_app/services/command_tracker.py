@@ -0,0 +1,196 @@
+# services/command_tracker.py
+"""
+Seguimiento de comandos enviados a los dispositivos.
+
+Cada comando publicado lleva un `cmd_id` (correlation id). El firmware
+debe devolverlo en el siguiente mensaje de `<device_id>/status`:
+
+    {"device_id": "esp32_01", "led_red": true, "cmd_id": "a1b2c3d4e5f6"}
+
+El listener MQTT llama a `command_tracker.resolve()` con cada status:
+si el cmd_id coincide con un comando pendiente se registra la latencia
+ida y vuelta y se despierta a quien esté esperando el ACK.
+Los comandos sin respuesta expiran a los COMMAND_ACK_TIMEOUT segundos
+y cuentan como timeout del dispositivo.
+"""
+import os
+import time
+import uuid
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+COMMAND_ACK_TIMEOUT = float(os.getenv("COMMAND_ACK_TIMEOUT", "10"))
+RECENT_RESULTS = 1000   # ACKs recientes que se recuerdan para `wait()` tardíos
+
+# Límites superiores (ms) de los buckets del histograma
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+@dataclass
+class PendingCommand:
+    device_id: str
+    command: dict
+    sent_at: float
+    future: asyncio.Future
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+@dataclass
+class DeviceLatency:
+    sent: int = 0
+    acked: int = 0
+    timeouts: int = 0
+    sum_ms: float = 0.0
+    max_ms: float = 0.0
+    buckets: list = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS_MS) + 1))
+
+    def observe(self, ms: float):
+        self.acked += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        for i, limit in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= limit:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Percentil aproximado (límite superior del bucket)."""
+        if not self.acked:
+            return None
+        target = q * self.acked
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self) -> dict:
+        labels = [f"<={b}" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}"]
+        return {
+            "sent": self.sent,
+            "acked": self.acked,
+            "timeouts": self.timeouts,
+            "avg_ms": round(self.sum_ms / self.acked, 2) if self.acked else None,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "max_ms": round(self.max_ms, 2) if self.acked else None,
+            "histogram_ms": dict(zip(labels, self.buckets)),
+        }
+
+
+class CommandTracker:
+    def __init__(self, timeout: float = COMMAND_ACK_TIMEOUT) -> None:
+        self.timeout = timeout
+        self._pending: Dict[str, PendingCommand] = {}
+        self._latency: Dict[str, DeviceLatency] = {}
+        self._recent: "OrderedDict[str, Optional[dict]]" = OrderedDict()
+
+    # ---------------------------------------------------------
+    # Registro (antes de publicar)
+    # ---------------------------------------------------------
+    def register(self, device_id: str, command: dict) -> dict:
+        """
+        Deja pendiente el comando y devuelve una COPIA del payload con su
+        cmd_id (el dict original no se toca: en envíos masivos lo comparten
+        todos los dispositivos). Publicar siempre la copia devuelta.
+        """
+        loop = asyncio.get_running_loop()
+        cmd_id = uuid.uuid4().hex[:12]
+        command = {**command, "cmd_id": cmd_id}
+
+        pending = PendingCommand(
+            device_id=device_id,
+            command=command,
+            sent_at=time.perf_counter(),
+            future=loop.create_future(),
+        )
+        pending.timer = loop.call_later(self.timeout, self._expire, cmd_id)
+        self._pending[cmd_id] = pending
+        self._latency.setdefault(device_id, DeviceLatency()).sent += 1
+        return command
+
+    def discard(self, cmd_id: str):
+        """Olvida un comando que no llegó a publicarse (no cuenta como timeout)."""
+        pending = self._pending.pop(cmd_id, None)
+        if not pending:
+            return
+        if pending.timer:
+            pending.timer.cancel()
+        self._latency[pending.device_id].sent -= 1
+        if not pending.future.done():
+            pending.future.set_result(None)
+
+    def _finish(self, cmd_id: str, pending: PendingCommand, result: Optional[dict]):
+        self._recent[cmd_id] = result
+        if len(self._recent) > RECENT_RESULTS:
+            self._recent.popitem(last=False)
+        if not pending.future.done():
+            pending.future.set_result(result)
+
+    def _expire(self, cmd_id: str):
+        pending = self._pending.pop(cmd_id, None)
+        if not pending:
+            return
+        self._latency[pending.device_id].timeouts += 1
+        self._finish(cmd_id, pending, None)
+        print(f"⌛ Comando {cmd_id} sin ACK de {pending.device_id}")
+
+    # ---------------------------------------------------------
+    # ACK (desde el listener MQTT /status)
+    # ---------------------------------------------------------
+    def resolve(self, device_id: str, payload: dict) -> Optional[float]:
+        """
+        Empareja un status con su comando pendiente.
+        Devuelve la latencia en ms, o None si no correspondía a ningún comando.
+        """
+        cmd_id = payload.get("cmd_id")
+        if not cmd_id:
+            return None
+
+        pending = self._pending.get(cmd_id)
+        if not pending or pending.device_id != device_id:
+            return None
+        del self._pending[cmd_id]
+
+        if pending.timer:
+            pending.timer.cancel()
+
+        ms = (time.perf_counter() - pending.sent_at) * 1000
+        self._latency[device_id].observe(ms)
+        self._finish(cmd_id, pending, {"latency_ms": round(ms, 2), "status": payload})
+
+        print(f"✅ ACK {cmd_id} de {device_id} en {ms:.1f} ms")
+        return ms
+
+    # ---------------------------------------------------------
+    # Espera opcional del ACK (API)
+    # ---------------------------------------------------------
+    async def wait(self, cmd_id: str, timeout: Optional[float] = None) -> Optional[dict]:
+        """
+        Espera el ACK de un comando. Devuelve {"latency_ms", "status"}
+        o None si no llegó a tiempo (el comando sigue pendiente hasta
+        su expiración global).
+        """
+        pending = self._pending.get(cmd_id)
+        if not pending:
+            return self._recent.get(cmd_id)
+        try:
+            return await asyncio.wait_for(asyncio.shield(pending.future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    # ---------------------------------------------------------
+    # Métricas
+    # ---------------------------------------------------------
+    def stats(self, device_id: Optional[str] = None) -> dict:
+        if device_id is not None:
+            return (self._latency.get(device_id) or DeviceLatency()).to_dict()
+        return {dev: lat.to_dict() for dev, lat in self._latency.items()}
+
+
+# Instancia global
+command_tracker = CommandTracker()
@@ -1,12 +1,28 @@
 # services/device_user_cache.py
 from utils.dynamodb_setup import users_table
-from typing import Dict, List
+from typing import Callable, Dict, Iterable, List, Optional
 import threading
 
 # Cache global: device_id → lista de usuarios completos
 device_user_cache: Dict[str, List[dict]] = {}
 lock = threading.Lock()
 
+# Callbacks a avisar cuando cambia el cache (ej: reglas de alarma compiladas).
+# Reciben los device_id afectados, o None si cambió todo.
+_listeners: List[Callable[[Optional[Iterable[str]]], None]] = []
+
+
+def add_cache_listener(callback: Callable[[Optional[Iterable[str]]], None]):
+    _listeners.append(callback)
+
+
+def _notify(device_ids: Optional[Iterable[str]]):
+    for cb in _listeners:
+        try:
+            cb(device_ids)
+        except Exception as e:
+            print(f"⚠️ Error notificando cambio de device_user_cache: {e}")
+
 
 # ============================================================
 #   Construcción inicial del cache
@@ -38,6 +54,7 @@ def build_device_user_cache():
     # actualizar cache global
     with lock:
         device_user_cache = new_cache
+    _notify(None)
 
     print(f"✅ Cache armado: {len(device_user_cache)} dispositivos cargados.")
 
@@ -77,10 +94,14 @@ def refresh_user_entry(user: dict):
         print("❌ refresh_user_entry fue llamado sin email")
         return
 
+    affected = set()
     with lock:
         # borrar usuario viejo en todas las listas
-        for dev_list in device_user_cache.values():
-            dev_list[:] = [u for u in dev_list if u.get("email") != email]
+        for dev_id, dev_list in device_user_cache.items():
+            kept = [u for u in dev_list if u.get("email") != email]
+            if len(kept) != len(dev_list):
+                affected.add(dev_id)
+            dev_list[:] = kept
 
         # agregar usuario en cada device permitido
         for dev in user.get("allowed_devices", []):
@@ -89,5 +110,7 @@ def refresh_user_entry(user: dict):
                 continue
 
             device_user_cache.setdefault(dev_id, []).append(user)
+            affected.add(dev_id)
 
+    _notify(affected)
     print(f"♻️ Cache actualizado para {email}")
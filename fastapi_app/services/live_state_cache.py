@@ -0,0 +1,203 @@
+# services/live_state_cache.py
+"""
+Último estado conocido de cada dispositivo, en memoria:
+
+    live_state._status["esp32_01"]   → {"timestamp", "led_red", "led_green", "online"}
+    live_state._readings["esp32_01"] → deque con las últimas N lecturas
+
+Se alimenta de los mismos eventos que se reparten por WebSocket
+(observer del manager), así cada worker lo tiene al día aunque el
+listener MQTT corra en otro proceso.
+
+Al conectar, el dashboard recibe un único frame `snapshot` armado desde
+acá en lugar de pedir /api/devices/{id} por cada dispositivo. Los
+dispositivos que todavía no tienen nada en memoria (ej: recién
+arrancado el proceso) se cargan UNA vez desde DynamoDB, en hilos
+(boto3 es síncrono) para no frenar el loop; al arrancar se precargan
+todos en segundo plano.
+"""
+import os
+import asyncio
+from collections import deque
+from decimal import Decimal
+from typing import Deque, Dict, Iterable, Optional, Set
+
+from boto3.dynamodb.conditions import Key
+from utils.dynamodb_setup import sensor_table, status_table, shadow_table
+from services.shadow_service import digital_state, is_online, needs_status_history, list_shadow_device_ids
+import services.device_user_cache as device_users
+
+SNAPSHOT_READINGS = int(os.getenv("WS_SNAPSHOT_READINGS", "20"))
+MAX_SNAPSHOT_READINGS = 200
+
+READING_FIELDS = ("temperature", "humidity", "temp_anomaly", "hum_anomaly")
+STATUS_HISTORY = 20     # ítems de DeviceStatus a revisar si el shadow no alcanza
+WARM_CONCURRENCY = 8    # dispositivos precargados a la vez (hilos de boto3)
+
+
+def _plain(v):
+    """Decimal de DynamoDB → float (para JSON/MessagePack)."""
+    return float(v) if isinstance(v, Decimal) else v
+
+
+class LiveStateCache:
+    def __init__(self, max_readings: int = MAX_SNAPSHOT_READINGS) -> None:
+        self.max_readings = max_readings
+        self._status: Dict[str, dict] = {}
+        self._readings: Dict[str, Deque[dict]] = {}
+        self._warmed: set = set()
+        self._warming: Dict[str, asyncio.Future] = {}
+        self._known: Optional[Set[str]] = None     # universo admin (se lista una vez)
+        self._warm_sem = asyncio.Semaphore(WARM_CONCURRENCY)
+
+    # ---------------------------------------------------------
+    # Alimentación (eventos WS)
+    # ---------------------------------------------------------
+    def observe(self, message: dict) -> None:
+        device_id = message.get("device_id")
+        if not device_id:
+            return
+
+        msg_type = message.get("type")
+        if msg_type == "data":
+            values = message.get("values") or {}
+            self._readings_for(device_id).append({
+                "timestamp": message.get("timestamp"),
+                **{k: values.get(k) for k in READING_FIELDS},
+            })
+        elif msg_type == "status":
+            self._status[device_id] = {
+                "timestamp": message.get("timestamp"),
+                **(message.get("status") or {}),
+            }
+
+    def _readings_for(self, device_id: str) -> Deque[dict]:
+        buf = self._readings.get(device_id)
+        if buf is None:
+            buf = self._readings[device_id] = deque(maxlen=self.max_readings)
+        return buf
+
+    # ---------------------------------------------------------
+    # Carga inicial desde DynamoDB (una vez por dispositivo)
+    # ---------------------------------------------------------
+    def _load(self, device_id: str, n: int, need_readings: bool, need_status: bool):
+        """
+        Lecturas y estado de un dispositivo desde DynamoDB (boto3 síncrono:
+        corre en un hilo, nunca en el loop). Devuelve (readings, status).
+        """
+        readings = status = None
+        try:
+            if need_readings:
+                resp = sensor_table.query(
+                    KeyConditionExpression=Key("device_id").eq(device_id),
+                    ScanIndexForward=False,
+                    Limit=n,
+                )
+                readings = [
+                    {"timestamp": it.get("timestamp"), **{k: _plain(it.get(k)) for k in READING_FIELDS}}
+                    for it in reversed(resp.get("Items", []))
+                ]
+
+            if need_status:
+                # Misma resolución que /api/devices/{id}: shadow y, para lo
+                # que no reportó, los campos anidados en `status` de DeviceStatus
+                shadow = shadow_table.get_item(Key={"device_id": device_id}).get("Item") or {}
+                items = []
+                if needs_status_history(shadow):
+                    items = status_table.query(
+                        KeyConditionExpression=Key("device_id").eq(device_id),
+                        ScanIndexForward=False,
+                        Limit=STATUS_HISTORY,
+                    ).get("Items", [])
+
+                if shadow.get("version") or items:
+                    online, led_red, led_green = digital_state(shadow, items)
+                    status = {
+                        "timestamp": shadow.get("updated_at") if shadow.get("version") else items[0].get("timestamp"),
+                        "led_red": _plain(led_red),
+                        "led_green": _plain(led_green),
+                        "online": is_online(online),   # igual que `estado` en /api/devices/{id}
+                    }
+        except Exception as e:
+            print(f"⚠️ No se pudo precargar estado de {device_id}: {e}")
+        return readings, status
+
+    async def _warm(self, device_id: str, n: int) -> None:
+        async with self._warm_sem:
+            readings, status = await asyncio.to_thread(
+                self._load, device_id, n, device_id not in self._readings, device_id not in self._status
+            )
+        # Se aplica en el loop: lo que llegó en vivo mientras tanto gana
+        if readings is not None and device_id not in self._readings:
+            self._readings_for(device_id).extend(readings)
+        if status is not None and device_id not in self._status:
+            self._status[device_id] = status
+
+    async def _ensure_warm(self, device_ids: Iterable[str], n: int) -> None:
+        """Precarga (en paralelo y una sola vez) los dispositivos que no están en memoria."""
+        pending = []
+        for dev in device_ids:
+            task = self._warming.get(dev)
+            if task is None and dev not in self._warmed and (dev not in self._status or dev not in self._readings):
+                self._warmed.add(dev)
+                task = self._warming[dev] = asyncio.ensure_future(self._warm(dev, n))
+                task.add_done_callback(lambda _t, d=dev: self._warming.pop(d, None))
+            if task is not None:
+                pending.append(task)
+        if pending:
+            await asyncio.gather(*pending)
+
+    @staticmethod
+    def _list_device_ids() -> Set[str]:
+        """Mismos dispositivos que /api/devices para admin (SensorData) + shadows."""
+        ids = set(list_shadow_device_ids())
+        kwargs = {"ProjectionExpression": "device_id"}
+        while True:
+            resp = sensor_table.scan(**kwargs)
+            ids.update(it["device_id"] for it in resp.get("Items", []))
+            if "LastEvaluatedKey" not in resp:
+                return ids
+            kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+    async def _all_device_ids(self) -> Set[str]:
+        """Universo de dispositivos (caso admin); se lista una vez por proceso."""
+        if self._known is None:
+            try:
+                ids = await asyncio.to_thread(self._list_device_ids)
+            except Exception as e:
+                print(f"⚠️ No se pudo listar dispositivos para el snapshot: {e}")
+                return set(self._status) | set(self._readings)
+            self._known = ids | set(device_users.device_user_cache)
+        return self._known | set(self._status) | set(self._readings)
+
+    async def warm_all(self, n: int = SNAPSHOT_READINGS) -> None:
+        """Precarga en segundo plano todos los dispositivos (al arrancar)."""
+        device_ids = await self._all_device_ids()
+        await self._ensure_warm(device_ids, n)
+        print(f"🔥 Estado vivo precargado: {len(device_ids)} dispositivos")
+
+    # ---------------------------------------------------------
+    # Snapshot
+    # ---------------------------------------------------------
+    async def snapshot(self, device_ids: Optional[Iterable[str]], n: int = SNAPSHOT_READINGS) -> dict:
+        """
+        Frame `snapshot` para los dispositivos indicados
+        (None = todos los del sistema, caso admin).
+        """
+        n = max(1, min(int(n), self.max_readings))
+        if device_ids is None:
+            device_ids = await self._all_device_ids()
+        await self._ensure_warm(device_ids, n)
+
+        devices = {}
+        for dev in device_ids:
+            readings = self._readings.get(dev)
+            devices[dev] = {
+                "status": self._status.get(dev),
+                "readings": list(readings)[-n:] if readings else [],
+            }
+        return {"type": "snapshot", "devices": devices}
+
+
+# Instancia global
+live_state = LiveStateCache()
@@ -0,0 +1,374 @@
+# services/shadow_service.py
+"""
+Shadow por dispositivo (mismo modelo que AWS IoT Device Shadow):
+
+    {
+      "device_id": "esp32_01",
+      "version": 7,
+      "desired":  {"led_red": True},
+      "reported": {"led_red": False, "led_green": False, "online": True},
+      "updated_at": "2025-01-01T12:00:00"
+    }
+
+- `desired`  → lo que pidió el usuario desde la API
+- `reported` → lo que informó el dispositivo por MQTT (/status)
+- `version`  → se incrementa en cada escritura; las escrituras de desired
+               son condicionales sobre la versión, así dos clicks
+               concurrentes nunca se pisan.
+
+Se mantiene un cache en memoria con la última versión conocida de cada
+shadow: en régimen normal un toggle es UNA sola escritura condicional
+(sin lectura previa). Si otro proceso modificó el shadow, la condición
+falla, se relee y se reintenta.
+"""
+from datetime import datetime
+from typing import Dict, Optional
+
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+from utils.dynamodb_setup import dynamodb, client, shadow_table, SHADOW_TABLE_NAME
+
+MAX_RETRIES = 5
+BATCH_GET_CHUNK = 100      # límite de BatchGetItem
+TRANSACT_CHUNK = 25        # límite de TransactWriteItems (DynamoDB Local)
+
+_serializer = TypeSerializer()
+
+# Cache global: device_id → último shadow conocido
+shadow_cache: Dict[str, dict] = {}
+
+
+# ============================================================
+#   Helpers
+# ============================================================
+def _empty_shadow(device_id: str) -> dict:
+    return {"device_id": device_id, "version": 0, "desired": {}, "reported": {}}
+
+
+def _is_conditional_failure(e: ClientError) -> bool:
+    return e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException"
+
+
+def compute_delta(shadow: dict) -> dict:
+    """Claves de desired cuyo valor difiere de reported."""
+    desired = shadow.get("desired") or {}
+    reported = shadow.get("reported") or {}
+    return {k: v for k, v in desired.items() if reported.get(k) != v}
+
+
+def current_value(shadow: dict, key: str, default=False):
+    """Valor vigente de una clave: desired si existe, si no reported."""
+    desired = shadow.get("desired") or {}
+    if key in desired:
+        return desired[key]
+    return (shadow.get("reported") or {}).get(key, default)
+
+
+def is_online(value):
+    """Normaliza el campo 'online' para distintos formatos"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value != 0
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "1", "yes", "on")
+    return False
+
+
+DIGITAL_FIELDS = ("online", "led_red", "led_green")
+
+
+def needs_status_history(shadow: dict) -> bool:
+    """True si a `reported` le falta algún campo digital (hay que mirar DeviceStatus)."""
+    reported = shadow.get("reported") or {}
+    return any(reported.get(f) is None for f in DIGITAL_FIELDS)
+
+
+def digital_state(shadow: dict, status_items: list):
+    """
+    (online, led_red, led_green) a mostrar para un dispositivo, campo por campo:
+    lo REPORTADO en el shadow; si falta (ej: shadow creado por un toggle,
+    solo con desired), el valor más reciente del historial de DeviceStatus
+    (`status_items` ordenados del más nuevo al más viejo). Para los LEDs,
+    desired solo si el dispositivo nunca informó ese LED.
+    """
+    reported = shadow.get("reported") or {}
+    found = {f: reported[f] for f in DIGITAL_FIELDS if reported.get(f) is not None}
+
+    for s_item in status_items:
+        if len(found) == len(DIGITAL_FIELDS):
+            break
+        s = s_item.get("status", {})
+        if not isinstance(s, dict):
+            continue
+        for f in DIGITAL_FIELDS:
+            if f not in found and s.get(f) is not None:
+                found[f] = s[f]
+
+    desired = shadow.get("desired") or {}
+    return (
+        found.get("online"),
+        found.get("led_red", desired.get("led_red")),
+        found.get("led_green", desired.get("led_green")),
+    )
+
+
+def commands_from_delta(delta: dict) -> list:
+    """Traduce un delta de LEDs a payloads MQTT `led_control`."""
+    commands = []
+    for key, value in delta.items():
+        if not key.startswith("led_"):
+            continue
+        commands.append({
+            "command": "led_control",
+            "led": key[len("led_"):],
+            "action": "on" if value else "off",
+        })
+    return commands
+
+
+# ============================================================
+#   Lectura
+# ============================================================
+async def get_shadow(device_id: str, use_cache: bool = False) -> dict:
+    """Obtiene el shadow con un único get_item (consistente)."""
+    if use_cache and device_id in shadow_cache:
+        return shadow_cache[device_id]
+
+    try:
+        res = shadow_table.get_item(Key={"device_id": device_id}, ConsistentRead=True)
+        shadow = res.get("Item") or _empty_shadow(device_id)
+    except Exception as e:
+        print(f"❌ Error leyendo shadow de {device_id}: {e}")
+        return _empty_shadow(device_id)
+
+    shadow_cache[device_id] = shadow
+    return shadow
+
+
+# ============================================================
+#   Escritura condicional de una sección
+# ============================================================
+def _write_section(device_id: str, section: str, changes: dict, expected_version: Optional[int]) -> dict:
+    """
+    Escribe `changes` en shadow[section] incrementando la versión.
+    expected_version:
+      · None → escritura incondicional (reported)
+      · 0    → el shadow no debe existir todavía
+      · N    → la versión guardada debe ser N
+    Lanza ClientError(ConditionalCheckFailed) si la condición no se cumple.
+    """
+    now = datetime.utcnow().isoformat()
+
+    if expected_version == 0:
+        item = _empty_shadow(device_id)
+        item[section] = dict(changes)
+        item["version"] = 1
+        item["updated_at"] = now
+        shadow_table.put_item(
+            Item=item,
+            ConditionExpression="attribute_not_exists(device_id)",
+        )
+        return item
+
+    names = {"#sec": section}
+    values = {":one": 1, ":ts": now}
+    sets = []
+    for i, (k, v) in enumerate(changes.items()):
+        names[f"#k{i}"] = k
+        values[f":v{i}"] = v
+        sets.append(f"#sec.#k{i} = :v{i}")
+
+    sets.append("version = version + :one")
+    sets.append("updated_at = :ts")
+
+    kwargs = {
+        "Key": {"device_id": device_id},
+        "UpdateExpression": "SET " + ", ".join(sets),
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": values,
+        "ReturnValues": "ALL_NEW",
+    }
+    if expected_version is None:
+        kwargs["ConditionExpression"] = "attribute_exists(device_id)"
+    else:
+        kwargs["ConditionExpression"] = "version = :expected"
+        values[":expected"] = expected_version
+
+    return shadow_table.update_item(**kwargs)["Attributes"]
+
+
+# ============================================================
+#   desired (API)
+# ============================================================
+async def update_desired(device_id: str, compute_changes) -> Optional[dict]:
+    """
+    Actualiza desired con control de concurrencia optimista.
+
+    `compute_changes(shadow) -> dict` recibe el shadow vigente y devuelve
+    las claves a escribir (ej: toggle de un LED). Se vuelve a invocar si
+    hubo un conflicto de versión.
+
+    Devuelve {"shadow", "changes", "delta"} o None si no se pudo escribir.
+    """
+    shadow = await get_shadow(device_id, use_cache=True)
+
+    for attempt in range(MAX_RETRIES):
+        changes = compute_changes(shadow)
+        try:
+            new_shadow = _write_section(device_id, "desired", changes, int(shadow.get("version", 0)))
+        except ClientError as e:
+            if not _is_conditional_failure(e):
+                print(f"❌ Error escribiendo shadow de {device_id}: {e}")
+                return None
+            print(f"🔁 Conflicto de versión en shadow {device_id} (intento {attempt + 1}), releyendo...")
+            shadow = await get_shadow(device_id)
+            continue
+        except Exception as e:
+            print(f"❌ Error escribiendo shadow de {device_id}: {e}")
+            return None
+
+        shadow_cache[device_id] = new_shadow
+        print(f"🪞 [SHADOW] {device_id} desired={changes} v{new_shadow.get('version')}")
+        return {"shadow": new_shadow, "changes": changes, "delta": compute_delta(new_shadow)}
+
+    print(f"⛔ Shadow {device_id}: demasiados conflictos de versión")
+    return None
+
+
+# ============================================================
+#   reported (MQTT /status)
+# ============================================================
+async def update_reported(device_id: str, reported: dict) -> Optional[dict]:
+    """Guarda lo informado por el dispositivo (sin condición de versión)."""
+    reported = {k: v for k, v in reported.items() if v is not None}
+    if not reported:
+        return shadow_cache.get(device_id)
+
+    try:
+        try:
+            new_shadow = _write_section(device_id, "reported", reported, None)
+        except ClientError as e:
+            if not _is_conditional_failure(e):
+                raise
+            # Primer reporte del dispositivo → crear el documento
+            try:
+                new_shadow = _write_section(device_id, "reported", reported, 0)
+            except ClientError as e2:
+                if not _is_conditional_failure(e2):
+                    raise
+                new_shadow = _write_section(device_id, "reported", reported, None)
+    except Exception as e:
+        print(f"❌ Error actualizando reported de {device_id}: {e}")
+        return None
+
+    shadow_cache[device_id] = new_shadow
+    return new_shadow
+
+
+# ============================================================
+#   desired en lote (comandos masivos)
+# ============================================================
+def _batch_get_shadows(device_ids: list) -> Dict[str, dict]:
+    """Lee muchos shadows con BatchGetItem (100 claves por llamada)."""
+    found = {}
+    for i in range(0, len(device_ids), BATCH_GET_CHUNK):
+        request = {
+            SHADOW_TABLE_NAME: {
+                "Keys": [{"device_id": d} for d in device_ids[i:i + BATCH_GET_CHUNK]],
+                "ConsistentRead": True,
+            }
+        }
+        while request:
+            resp = dynamodb.batch_get_item(RequestItems=request)
+            for item in resp.get("Responses", {}).get(SHADOW_TABLE_NAME, []):
+                found[item["device_id"]] = item
+            request = resp.get("UnprocessedKeys") or None
+    return found
+
+
+async def update_desired_many(changes_by_device: Dict[str, dict]) -> Dict[str, Optional[dict]]:
+    """
+    Actualiza desired de muchos dispositivos en lote:
+      1) BatchGetItem de los shadows actuales
+      2) TransactWriteItems condicional sobre la versión (25 por transacción)
+    Si una transacción se cancela por conflicto de versión, ese grupo
+    se resuelve dispositivo por dispositivo con `update_desired`.
+
+    Devuelve device_id → {"shadow", "changes", "delta"} (o None si falló).
+    """
+    device_ids = list(changes_by_device)
+    results: Dict[str, Optional[dict]] = {}
+
+    try:
+        current = _batch_get_shadows(device_ids)
+    except Exception as e:
+        print(f"❌ Error leyendo shadows en lote: {e}")
+        current = {}
+
+    now = datetime.utcnow().isoformat()
+
+    for i in range(0, len(device_ids), TRANSACT_CHUNK):
+        chunk = device_ids[i:i + TRANSACT_CHUNK]
+        new_shadows = {}
+        transact = []
+
+        for dev_id in chunk:
+            shadow = current.get(dev_id) or _empty_shadow(dev_id)
+            version = int(shadow.get("version", 0))
+            new_shadow = {
+                **shadow,
+                "desired": {**(shadow.get("desired") or {}), **changes_by_device[dev_id]},
+                "version": version + 1,
+                "updated_at": now,
+            }
+            new_shadows[dev_id] = new_shadow
+
+            put = {
+                "TableName": SHADOW_TABLE_NAME,
+                "Item": {k: _serializer.serialize(v) for k, v in new_shadow.items()},
+            }
+            if version == 0:
+                put["ConditionExpression"] = "attribute_not_exists(device_id)"
+            else:
+                put["ConditionExpression"] = "version = :expected"
+                put["ExpressionAttributeValues"] = {":expected": {"N": str(version)}}
+            transact.append({"Put": put})
+
+        try:
+            client.transact_write_items(TransactItems=transact)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            print(f"🔁 Lote de shadows cancelado ({code}), reintentando uno por uno...")
+            for dev_id in chunk:
+                changes = changes_by_device[dev_id]
+                results[dev_id] = await update_desired(dev_id, lambda _sh, c=changes: c)
+            continue
+        except Exception as e:
+            print(f"❌ Error escribiendo shadows en lote: {e}")
+            for dev_id in chunk:
+                results[dev_id] = None
+            continue
+
+        for dev_id, new_shadow in new_shadows.items():
+            shadow_cache[dev_id] = new_shadow
+            results[dev_id] = {
+                "shadow": new_shadow,
+                "changes": changes_by_device[dev_id],
+                "delta": compute_delta(new_shadow),
+            }
+
+    print(f"🪞 [SHADOW] desired actualizado en lote para {len(device_ids)} dispositivos")
+    return results
+
+
+def list_shadow_device_ids() -> list:
+    """Todos los device_id con shadow (universo de dispositivos para admin)."""
+    ids = []
+    kwargs = {"ProjectionExpression": "device_id"}
+    while True:
+        resp = shadow_table.scan(**kwargs)
+        ids.extend(it["device_id"] for it in resp.get("Items", []))
+        if "LastEvaluatedKey" not in resp:
+            return ids
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
@@ -0,0 +1,6 @@
+# tests/conftest.py
+# Los módulos de la app se importan desde fastapi_app/ (igual que main.py)
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,104 @@
+# tests/test_email_notifier.py
+"""
+EmailNotifier (utils/email_service.py) contra un smtplib.SMTP de mentira:
+reintentos diferidos sin frenar la cola y digest por destinatario.
+"""
+import asyncio
+import email
+import smtplib
+from email.header import decode_header, make_header
+
+import pytest
+
+from utils import email_service
+from utils.email_service import EmailNotifier
+
+
+class StubSMTP:
+    """Servidor SMTP en memoria; `refuse` = destinatarios que fallan N veces."""
+
+    sent = []
+    refuse = {}
+    connects = 0
+
+    def __init__(self, host, port, timeout=None):
+        StubSMTP.connects += 1
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def sendmail(self, from_addr, to_addr, msg):
+        if StubSMTP.refuse.get(to_addr, 0) > 0:
+            StubSMTP.refuse[to_addr] -= 1
+            raise smtplib.SMTPRecipientsRefused({to_addr: (450, b"mailbox busy")})
+        subject = str(make_header(decode_header(email.message_from_string(msg)["Subject"])))
+        StubSMTP.sent.append((to_addr, subject))
+
+    def quit(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def stub_smtp(monkeypatch):
+    StubSMTP.sent = []
+    StubSMTP.refuse = {}
+    StubSMTP.connects = 0
+    monkeypatch.setattr(email_service.smtplib, "SMTP", StubSMTP)
+    monkeypatch.setattr(email_service, "SMTP_SERVER", "smtp.test")
+    monkeypatch.setattr(email_service, "SMTP_FROM", "iot@test")
+    return StubSMTP
+
+
+def test_failed_send_is_deferred_without_blocking_queue():
+    StubSMTP.refuse = {"bad@test": 1}
+
+    async def main():
+        notifier = EmailNotifier(retry_base=0.3, max_retries=3)
+        await notifier.start()
+        notifier.submit("bad@test", "alarma 0", "b")
+        for i in range(1, 4):
+            notifier.submit("ok@test", f"alarma {i}", "b")
+
+        # Dentro del backoff de bad@test el resto ya salió
+        await asyncio.sleep(0.1)
+        during = list(StubSMTP.sent)
+        pending = notifier.get_stats()["pending_retries"]
+
+        await notifier.stop()
+        return during, pending, notifier.get_stats()
+
+    during, pending, stats = asyncio.run(main())
+    assert during == [("ok@test", f"alarma {i}") for i in range(1, 4)]
+    assert pending == 1
+    assert StubSMTP.sent[-1] == ("bad@test", "alarma 0")
+    assert stats["sent"] == 4
+    assert stats["retried"] == 1
+    assert stats["failed"] == 0
+    # Un error del destinatario no obliga a reconectar
+    assert StubSMTP.connects == 1
+
+
+def test_digest_merges_alarms_inside_window():
+    async def main():
+        notifier = EmailNotifier(digest_seconds=0.2)
+        await notifier.start()
+        for i in range(3):
+            notifier.submit("user@test", f"alarma {i}", "b")
+        notifier.submit("other@test", "sola", "b")
+
+        await asyncio.sleep(0.05)
+        before_window = list(StubSMTP.sent)
+        await asyncio.sleep(0.35)
+        after_window = list(StubSMTP.sent)
+
+        await notifier.stop()
+        return before_window, after_window, notifier.get_stats()
+
+    before_window, after_window, stats = asyncio.run(main())
+    assert before_window == []
+    assert sorted(after_window) == [("other@test", "sola"), ("user@test", "⚠️ 3 alarmas IoT")]
+    assert stats["digests"] == 1
+    assert stats["sent"] == 4
@@ -0,0 +1,176 @@
+# tests/test_ws_bus.py
+"""
+Bus de broadcast entre workers (utils/ws_bus.py) contra un stand-in de
+Redis en memoria: mismo canal compartido por dos ConnectionManager, como
+dos workers de uvicorn.
+"""
+import asyncio
+import json
+
+import pytest
+
+from utils import ws_bus
+from utils.ws_bus import BroadcastBus, InProcessBus, RedisBus
+from utils.ws_manager import ConnectionManager
+
+
+# ============================================================
+#   Stand-ins
+# ============================================================
+class FakeWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.frames.append(json.loads(text))
+
+    def messages(self, msg_type):
+        flat = [m for f in self.frames for m in (f.get("messages") or [f])]
+        return [m for m in flat if m.get("type") == msg_type]
+
+
+class FakePubSub:
+    def __init__(self, server):
+        self.server = server
+        self.queue = asyncio.Queue()
+        self.channels = set()
+
+    async def subscribe(self, channel):
+        self.channels.add(channel)
+        self.server.subscribers.append(self)
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+    async def aclose(self):
+        if self in self.server.subscribers:
+            self.server.subscribers.remove(self)
+
+
+class FakeRedis:
+    """Lo mínimo de redis.asyncio que usa RedisBus: pub/sub, SET NX PX y los scripts del lock."""
+
+    def __init__(self):
+        self.subscribers = []
+        self.keys = {}
+
+    async def publish(self, channel, data):
+        for sub in list(self.subscribers):
+            if channel in sub.channels:
+                sub.queue.put_nowait({"type": "message", "data": data})
+        return len(self.subscribers)
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+    async def set(self, key, value, nx=False, px=None):
+        if nx and key in self.keys:
+            return None
+        self.keys[key] = value
+        return True
+
+    async def eval(self, script, numkeys, key, token, *args):
+        if self.keys.get(key) != token:
+            return 0
+        if script == ws_bus._RELEASE_SCRIPT:
+            del self.keys[key]
+        return 1
+
+    async def aclose(self):
+        pass
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0.01)
+
+
+# ============================================================
+#   Tests
+# ============================================================
+def test_broadcast_bus_is_abstract():
+    with pytest.raises(TypeError):
+        BroadcastBus()
+
+    class NoPublish(BroadcastBus):
+        pass
+
+    with pytest.raises(TypeError):
+        NoPublish()
+
+
+def test_in_process_bus_reaches_local_clients():
+    async def main():
+        manager = ConnectionManager()
+        await manager.start(InProcessBus())
+        a, b = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(a)
+        await manager.connect(b)
+
+        await manager.broadcast({"type": "data", "device_id": "esp32_01", "v": 1})
+        await _settle()
+        await manager.stop()
+        return a, b
+
+    a, b = asyncio.run(main())
+    assert [m["v"] for m in a.messages("data")] == [1]
+    assert [m["v"] for m in b.messages("data")] == [1]
+
+
+def test_redis_bus_fans_out_to_every_manager():
+    async def main():
+        server = FakeRedis()
+        workers = [ConnectionManager(), ConnectionManager()]
+        sockets = []
+        for manager in workers:
+            await manager.start(RedisBus("redis://fake", client=server))
+            ws = FakeWebSocket()
+            await manager.connect(ws)
+            sockets.append(ws)
+        await _settle()
+
+        # Un único publish desde el primer worker
+        await workers[0].broadcast({"type": "data", "device_id": "esp32_01", "v": 7})
+        await _settle()
+        for manager in workers:
+            await manager.stop()
+        return sockets
+
+    for ws in asyncio.run(main()):
+        assert [m["v"] for m in ws.messages("data")] == [7]
+
+
+def test_redis_bus_runs_exclusive_task_once(monkeypatch):
+    monkeypatch.setattr(ws_bus, "WS_LEADER_TTL", 0.06)
+
+    async def main():
+        server = FakeRedis()
+        buses = [RedisBus("redis://fake", client=server) for _ in range(3)]
+        running = []
+
+        def factory(i):
+            async def run():
+                running.append(i)
+                await asyncio.Event().wait()
+            return run
+
+        tasks = [asyncio.create_task(bus.run_exclusive("mqtt", factory(i))) for i, bus in enumerate(buses)]
+        await asyncio.sleep(0.2)
+        assert len(running) == 1
+
+        # El líder se detiene → libera el lock y otro worker toma el relevo
+        leader = running[0]
+        tasks[leader].cancel()
+        await asyncio.sleep(0.2)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return leader, running
+
+    leader, running = asyncio.run(main())
+    assert len(running) == 2
+    assert running[1] != leader
@@ -0,0 +1,260 @@
+# tools/ml_eval.py
+"""
+Evaluación offline de los detectores de anomalías sobre historia real.
+
+Carga las lecturas de un dispositivo desde SensorData (o desde un archivo
+exportado), las reproduce por `update_and_predict` con cada detector y
+genera un reporte JSON con:
+  · muestras/s y CPU por muestra
+  · memoria (pico de tracemalloc durante el replay)
+  · reentrenamientos: cantidad, motivos y tiempo total
+  · acuerdo con los flags guardados (temp_anomaly, hum_anomaly,
+    ml_temp_anomaly, ml_hum_anomaly)
+
+Uso (desde fastapi_app/):
+    python -m tools.ml_eval --device esp32_01 --out report.json
+    python -m tools.ml_eval --device esp32_01 --export esp32_01.jsonl
+    python -m tools.ml_eval --file esp32_01.jsonl --detectors iforest,ewma
+"""
+import sys
+import csv
+import json
+import time
+import argparse
+import contextlib
+import tracemalloc
+from decimal import Decimal
+
+from utils import ml_utils
+
+FLAG_FIELDS = ("temp_anomaly", "hum_anomaly", "ml_temp_anomaly", "ml_hum_anomaly")
+
+
+# ============================================================
+#   Carga de datos
+# ============================================================
+def _plain(v):
+    if isinstance(v, Decimal):
+        return float(v)
+    return v
+
+
+def _normalize(item: dict) -> dict:
+    row = {k: _plain(item.get(k)) for k in ("timestamp", "temperature", "humidity", *FLAG_FIELDS)}
+    for k in ("temperature", "humidity"):
+        if row[k] in ("", None):
+            row[k] = None
+        else:
+            row[k] = float(row[k])
+    for k in FLAG_FIELDS:
+        v = row[k]
+        if isinstance(v, str):
+            v = v.strip().lower()
+            row[k] = None if v == "" else v in ("1", "true", "yes")
+    return row
+
+
+def load_from_dynamodb(device_id: str, limit=None) -> list:
+    from boto3.dynamodb.conditions import Key
+    from utils.dynamodb_setup import sensor_table
+
+    rows = []
+    kwargs = {"KeyConditionExpression": Key("device_id").eq(device_id), "ScanIndexForward": True}
+    while True:
+        resp = sensor_table.query(**kwargs)
+        rows.extend(_normalize(it) for it in resp.get("Items", []))
+        if limit and len(rows) >= limit:
+            return rows[:limit]
+        if "LastEvaluatedKey" not in resp:
+            return rows
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+
+def load_from_file(path: str, limit=None) -> list:
+    """JSON (lista), JSON lines o CSV con columnas timestamp,temperature,humidity,..."""
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            items = list(csv.DictReader(f))
+        else:
+            text = f.read().strip()
+            if text.startswith("["):
+                items = json.loads(text)
+            else:
+                items = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    rows = sorted((_normalize(it) for it in items), key=lambda r: r["timestamp"] or "")
+    return rows[:limit] if limit else rows
+
+
+def export_rows(rows: list, path: str) -> None:
+    with open(path, "w") as f:
+        for r in rows:
+            f.write(json.dumps(r) + "\n")
+
+
+# ============================================================
+#   Replay
+# ============================================================
+def _replay(device_id: str, rows: list) -> list:
+    return [ml_utils.update_and_predict(device_id, r["temperature"], r["humidity"]) for r in rows]
+
+
+def _agreement(rows: list, outputs: list) -> dict:
+    """Acuerdo de las etiquetas del detector con cada flag guardado."""
+    pairs = {
+        "temp_anomaly": "ml_temp_anomaly",
+        "ml_temp_anomaly": "ml_temp_anomaly",
+        "hum_anomaly": "ml_hum_anomaly",
+        "ml_hum_anomaly": "ml_hum_anomaly",
+    }
+    result = {}
+    for stored, produced in pairs.items():
+        tp = fp = fn = same = n = 0
+        for r, out in zip(rows, outputs):
+            ref = r.get(stored)
+            if ref is None:
+                continue
+            got = bool(out[produced])
+            n += 1
+            same += got == bool(ref)
+            tp += got and ref
+            fp += got and not ref
+            fn += (not got) and ref
+        if n:
+            result[stored] = {
+                "n": n,
+                "agreement": round(same / n, 4),
+                "precision": round(tp / (tp + fp), 3) if tp + fp else None,
+                "recall": round(tp / (tp + fn), 3) if tp + fn else None,
+            }
+    return result
+
+
+def evaluate(detector: str, rows: list, measure_memory: bool = True) -> dict:
+    # Dispositivos sintéticos: no tocan el estado real ni el disco
+    device_id = f"__eval__{detector}"
+    ml_utils.set_detector(detector, device_id)
+    ml_utils.registry.remove(device_id)
+
+    reasons_before = dict(ml_utils.train_stats["reasons"])
+    completed_before = ml_utils.train_stats["completed"]
+    train_ms = 0.0
+
+    # Tiempo de reentrenamiento: se acumula envolviendo el job (sin loop corre en línea)
+    original_job = ml_utils._train_job
+
+    def timed_job(values):
+        nonlocal train_ms
+        model, ms = original_job(values)
+        train_ms += ms
+        return model, ms
+
+    ml_utils._train_job = timed_job
+    try:
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        outputs = _replay(device_id, rows)
+        wall = time.perf_counter() - wall0
+        cpu = time.process_time() - cpu0
+    finally:
+        ml_utils._train_job = original_job
+
+    dev = ml_utils.registry.peek(device_id)
+    state_bytes = dev.nbytes() if dev else 0
+    reasons = {
+        k: v - reasons_before.get(k, 0)
+        for k, v in ml_utils.train_stats["reasons"].items()
+        if v - reasons_before.get(k, 0)
+    }
+    retrains = ml_utils.train_stats["completed"] - completed_before
+    ml_utils.registry.remove(device_id)
+
+    peak = None
+    if measure_memory:
+        mem_id = device_id + "_mem"
+        ml_utils.set_detector(detector, mem_id)
+        tracemalloc.start()
+        _replay(mem_id, rows)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        ml_utils.registry.remove(mem_id)
+
+    n = len(rows)
+    return {
+        "samples": n,
+        "samples_per_s": round(n / wall, 1) if wall else None,
+        "cpu_us_per_sample": round(cpu / n * 1e6, 2) if n else None,
+        "peak_memory_bytes": peak,
+        "state_bytes": state_bytes,
+        "retrains": retrains,
+        "retrain_reasons": reasons,
+        "retrain_ms_total": round(train_ms, 2),
+        "flagged_temp": sum(bool(o["ml_temp_anomaly"]) for o in outputs),
+        "flagged_hum": sum(bool(o["ml_hum_anomaly"]) for o in outputs),
+        "agreement": _agreement(rows, outputs),
+    }
+
+
+# ============================================================
+#   CLI
+# ============================================================
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Evaluación offline de detectores de anomalías")
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument("--device", help="device_id a leer desde SensorData")
+    src.add_argument("--file", help="historia exportada (.jsonl, .json o .csv)")
+    ap.add_argument("--detectors", default=",".join(ml_utils.DETECTORS),
+                    help="lista separada por comas (default: todos)")
+    ap.add_argument("--limit", type=int, help="máximo de lecturas a usar")
+    ap.add_argument("--export", help="guardar la historia cargada como JSON lines y salir")
+    ap.add_argument("--no-memory", action="store_true", help="omitir la pasada con tracemalloc")
+    ap.add_argument("--out", help="archivo del reporte JSON (default: stdout)")
+    args = ap.parse_args(argv)
+
+    # Nunca leer ni escribir snapshots de estado reales
+    ml_utils.ML_STATE_DIR = ""
+
+    rows = load_from_dynamodb(args.device, args.limit) if args.device else load_from_file(args.file, args.limit)
+    if args.export:
+        export_rows(rows, args.export)
+        print(f"💾 {len(rows)} lecturas exportadas a {args.export}", file=sys.stderr)
+        return 0
+    if not rows:
+        print("⚠️ No hay lecturas para evaluar", file=sys.stderr)
+        return 1
+
+    detectors = [d.strip() for d in args.detectors.split(",") if d.strip()]
+    unknown = [d for d in detectors if d not in ml_utils.DETECTORS]
+    if unknown:
+        ap.error(f"detectores desconocidos: {unknown}")
+
+    report = {
+        "source": {"device": args.device} if args.device else {"file": args.file},
+        "samples": len(rows),
+        "first_timestamp": rows[0]["timestamp"],
+        "last_timestamp": rows[-1]["timestamp"],
+        "config": {
+            "retrain_min_samples": ml_utils.RETRAIN_MIN_SAMPLES,
+            "retrain_max_samples": ml_utils.RETRAIN_MAX_SAMPLES,
+            "max_buf": ml_utils.MAX_BUF,
+            "alpha": ml_utils.ALPHA,
+        },
+        "detectors": {},
+    }
+    # Los logs de ml_utils van a stderr: stdout queda solo para el reporte
+    with contextlib.redirect_stdout(sys.stderr):
+        for name in detectors:
+            print(f"▶️ Evaluando {name} sobre {len(rows)} lecturas...")
+            report["detectors"][name] = evaluate(name, rows, measure_memory=not args.no_memory)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+        print(f"💾 Reporte guardado en {args.out}", file=sys.stderr)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,7 @@
 ########
 
 import os
+import time
 import boto3
 
 # =====================================================
@@ -19,24 +20,123 @@ DATA_TABLE_NAME = os.getenv("DATA_TABLE_NAME", "SensorData")
 STATUS_TABLE_NAME = os.getenv("STATUS_TABLE_NAME", "DeviceStatus")
 THRESHOLDS_TABLE_NAME = os.getenv("THRESHOLDS_TABLE_NAME", "Thresholds")
 ALARM_LOG_TABLE = os.getenv("ALARM_LOG_TABLE", "AlarmLog")
+SHADOW_TABLE_NAME = os.getenv("SHADOW_TABLE_NAME", "DeviceShadow")
+ALARM_COOLDOWN_TABLE = os.getenv("ALARM_COOLDOWN_TABLE", "AlarmCooldown")
+
+# Índices del AlarmLog
+ALARM_USER_INDEX = "user_email-timestamp-index"
+ALARM_DEVICE_INDEX = "device_id-timestamp-index"
+# Orden temporal global (listado admin): partición constante + timestamp
+ALARM_TIME_INDEX = "log-timestamp-index"
+ALARM_LOG_PARTITION = "ALL"
+
+# Espera (al arrancar) a que un GSI nuevo termine el backfill y quede ACTIVE
+GSI_WAIT_SECONDS = float(os.getenv("GSI_WAIT_SECONDS", "120"))
+GSI_POLL_SECONDS = 5
+INDEX_RECHECK_SECONDS = 30   # cada cuánto se vuelve a consultar un índice que no está ACTIVE
 
 # =====================================================
 #  Helper para crear tablas
 # =====================================================
-def ensure_table_exists(table_name: str, key_schema, attr_definitions):
-    """Crea una tabla si no existe."""
+def ensure_table_exists(table_name: str, key_schema, attr_definitions, gsis=None) -> list:
+    """
+    Crea una tabla si no existe (y sus GSI si faltan en una tabla existente).
+    Devuelve los GSI agregados a una tabla que ya existía.
+    """
     existing_tables = [t.name for t in dynamodb.tables.all()]
     if table_name not in existing_tables:
         print(f"🧱 Creando tabla '{table_name}'...")
+        kwargs = {}
+        if gsis:
+            kwargs["GlobalSecondaryIndexes"] = gsis
         dynamodb.create_table(
             TableName=table_name,
             KeySchema=key_schema,
             AttributeDefinitions=attr_definitions,
             BillingMode="PAY_PER_REQUEST",
+            **kwargs,
         )
         print(f"✅ Tabla '{table_name}' creada correctamente.")
-    else:
-        print(f"ℹ️ Tabla '{table_name}' ya existe.")
+        return []
+
+    print(f"ℹ️ Tabla '{table_name}' ya existe.")
+    if gsis:
+        return ensure_gsis_exist(table_name, attr_definitions, gsis)
+    return []
+
+
+def ensure_gsis_exist(table_name: str, attr_definitions, gsis) -> list:
+    """Agrega a una tabla existente los GSI que le falten (uno por update_table)."""
+    desc = client.describe_table(TableName=table_name)["Table"]
+    existing = {g["IndexName"] for g in desc.get("GlobalSecondaryIndexes", [])}
+    created = []
+
+    for gsi in gsis:
+        if gsi["IndexName"] in existing:
+            continue
+        print(f"🧱 Creando índice '{gsi['IndexName']}' en '{table_name}'...")
+        try:
+            client.update_table(
+                TableName=table_name,
+                AttributeDefinitions=attr_definitions,
+                GlobalSecondaryIndexUpdates=[{"Create": gsi}],
+            )
+            created.append(gsi["IndexName"])
+            # table_exists vuelve con la tabla ACTIVE aunque el índice siga CREATING
+            if wait_index_active(table_name, gsi["IndexName"]):
+                print(f"✅ Índice '{gsi['IndexName']}' activo.")
+            else:
+                print(f"⏳ Índice '{gsi['IndexName']}' sigue construyéndose (se completa en segundo plano).")
+        except Exception as e:
+            # Ej: otro índice todavía construyéndose → se reintenta en el próximo arranque
+            print(f"⚠️ No se pudo crear el índice '{gsi['IndexName']}': {e}")
+    return created
+
+
+# =====================================================
+#  Estado de los GSI
+# =====================================================
+_active_indexes: set = set()            # (tabla, índice) ya ACTIVE: no vuelve a cambiar
+_index_checked_at: dict = {}            # (tabla, índice) → último describe_table sin éxito
+
+
+def _refresh_indexes(table_name: str):
+    desc = client.describe_table(TableName=table_name)["Table"]
+    for g in desc.get("GlobalSecondaryIndexes", []):
+        if g.get("IndexStatus") == "ACTIVE":
+            _active_indexes.add((table_name, g["IndexName"]))
+
+
+def index_active(table_name: str, index_name: str) -> bool:
+    """
+    True si el GSI existe y está ACTIVE. Mientras se construye, los
+    endpoints deben usar el camino por scan. El resultado positivo se
+    cachea; el negativo se vuelve a consultar cada INDEX_RECHECK_SECONDS.
+    """
+    key = (table_name, index_name)
+    if key in _active_indexes:
+        return True
+    now = time.monotonic()
+    if now - _index_checked_at.get(key, -INDEX_RECHECK_SECONDS) < INDEX_RECHECK_SECONDS:
+        return False
+    _index_checked_at[key] = now
+    try:
+        _refresh_indexes(table_name)
+    except Exception as e:
+        print(f"⚠️ No se pudo consultar el índice '{index_name}': {e}")
+    return key in _active_indexes
+
+
+def wait_index_active(table_name: str, index_name: str, timeout: float = GSI_WAIT_SECONDS) -> bool:
+    """Hace polling de describe_table hasta que el índice esté ACTIVE (o vence el timeout)."""
+    deadline = time.monotonic() + timeout
+    while True:
+        _refresh_indexes(table_name)
+        if (table_name, index_name) in _active_indexes:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(GSI_POLL_SECONDS)
 
 # =====================================================
 #  Users
@@ -97,11 +197,95 @@ def ensure_alarm_log_table_exists():
     """
     Tabla para registrar alarmas enviadas al usuario.
     Clave primaria: alarm_id (UUID)
+    GSI: (user_email, timestamp) y (device_id, timestamp) para listar
+    alarmas por usuario / dispositivo en orden temporal sin scan, y
+    (log, timestamp) con log = ALARM_LOG_PARTITION en todas las alarmas
+    para el listado admin completo en orden temporal.
     """
-    ensure_table_exists(
+    def gsi(name, hash_key):
+        return {
+            "IndexName": name,
+            "KeySchema": [
+                {"AttributeName": hash_key, "KeyType": "HASH"},
+                {"AttributeName": "timestamp", "KeyType": "RANGE"},
+            ],
+            "Projection": {"ProjectionType": "ALL"},
+        }
+
+    created = ensure_table_exists(
         ALARM_LOG_TABLE,
         key_schema=[{"AttributeName": "alarm_id", "KeyType": "HASH"}],
-        attr_definitions=[{"AttributeName": "alarm_id", "AttributeType": "S"}],
+        attr_definitions=[
+            {"AttributeName": "alarm_id", "AttributeType": "S"},
+            {"AttributeName": "user_email", "AttributeType": "S"},
+            {"AttributeName": "device_id", "AttributeType": "S"},
+            {"AttributeName": "timestamp", "AttributeType": "S"},
+            {"AttributeName": "log", "AttributeType": "S"},
+        ],
+        gsis=[
+            gsi(ALARM_USER_INDEX, "user_email"),
+            gsi(ALARM_DEVICE_INDEX, "device_id"),
+            gsi(ALARM_TIME_INDEX, "log"),
+        ],
+    )
+    if ALARM_TIME_INDEX in created:
+        backfill_alarm_log_partition()
+
+
+def backfill_alarm_log_partition():
+    """Completa `log` en las alarmas anteriores al índice (el GSI es disperso)."""
+    table = dynamodb.Table(ALARM_LOG_TABLE)
+    kwargs = {
+        "ProjectionExpression": "alarm_id",
+        "FilterExpression": "attribute_not_exists(#log)",
+        "ExpressionAttributeNames": {"#log": "log"},
+    }
+    updated = 0
+    while True:
+        resp = table.scan(**kwargs)
+        for it in resp.get("Items", []):
+            try:
+                table.update_item(
+                    Key={"alarm_id": it["alarm_id"]},
+                    UpdateExpression="SET #log = :p",
+                    ConditionExpression="attribute_exists(alarm_id)",
+                    ExpressionAttributeNames={"#log": "log"},
+                    ExpressionAttributeValues={":p": ALARM_LOG_PARTITION},
+                )
+                updated += 1
+            except Exception as e:
+                print(f"⚠️ No se pudo completar 'log' en {it['alarm_id']}: {e}")
+        if "LastEvaluatedKey" not in resp:
+            break
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+    print(f"🧱 {updated} alarmas existentes agregadas a '{ALARM_TIME_INDEX}'")
+
+# =====================================================
+#  AlarmCooldown
+# =====================================================
+def ensure_alarm_cooldown_table_exists():
+    """
+    Un ítem por (usuario, dispositivo, tipo de alarma) con su cooldown_until.
+    Clave primaria: cooldown_key = "email#device_id#type"
+    """
+    ensure_table_exists(
+        ALARM_COOLDOWN_TABLE,
+        key_schema=[{"AttributeName": "cooldown_key", "KeyType": "HASH"}],
+        attr_definitions=[{"AttributeName": "cooldown_key", "AttributeType": "S"}],
+    )
+
+# =====================================================
+#  DeviceShadow
+# =====================================================
+def ensure_shadow_table_exists():
+    """
+    Documento único por dispositivo con secciones desired/reported
+    y un número de versión para escrituras condicionales.
+    """
+    ensure_table_exists(
+        SHADOW_TABLE_NAME,
+        key_schema=[{"AttributeName": "device_id", "KeyType": "HASH"}],
+        attr_definitions=[{"AttributeName": "device_id", "AttributeType": "S"}],
     )
 
 # =====================================================
@@ -115,6 +299,8 @@ def ensure_all_tables_exist():
     ensure_status_table_exists()
     ensure_thresholds_table_exists()
     ensure_alarm_log_table_exists()
+    ensure_alarm_cooldown_table_exists()
+    ensure_shadow_table_exists()
 
     print("✅ Todas las tablas están disponibles.")
 
@@ -126,6 +312,8 @@ sensor_table = dynamodb.Table(DATA_TABLE_NAME)
 status_table = dynamodb.Table(STATUS_TABLE_NAME)
 thresholds_table = dynamodb.Table(THRESHOLDS_TABLE_NAME)
 alarm_log_table = dynamodb.Table(ALARM_LOG_TABLE)
+alarm_cooldown_table = dynamodb.Table(ALARM_COOLDOWN_TABLE)
+shadow_table = dynamodb.Table(SHADOW_TABLE_NAME)
 
 # =====================================================
 #  Ejecución automática al iniciar contenedor
@@ -3,11 +3,35 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import os
+import time
+import asyncio
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 SMTP_SERVER = os.getenv("SMTP_SERVER")
 SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
 SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASS = os.getenv("SMTP_PASS")
+SMTP_FROM = os.getenv("SMTP_FROM") or SMTP_USER
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() in ("1", "true", "yes")
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "15"))
+SMTP_IDLE_TIMEOUT = float(os.getenv("SMTP_IDLE_TIMEOUT", "120"))   # cerrar la sesión si no se usa
+
+EMAIL_QUEUE_SIZE = int(os.getenv("EMAIL_QUEUE_SIZE", "1000"))
+EMAIL_MAX_RETRIES = int(os.getenv("EMAIL_MAX_RETRIES", "4"))
+EMAIL_RETRY_BASE = float(os.getenv("EMAIL_RETRY_BASE", "2"))       # 2, 4, 8... segundos
+EMAIL_DIGEST_SECONDS = float(os.getenv("EMAIL_DIGEST_SECONDS", "0"))  # 0 = sin digest
+
+
+def _build_message(to_email: str, subject: str, body: str) -> MIMEMultipart:
+    msg = MIMEMultipart()
+    msg["From"] = SMTP_FROM
+    msg["To"] = to_email
+    msg["Subject"] = subject
+    msg.attach(MIMEText(body, "html"))
+    return msg
 
 def send_email(to_email: str, subject: str, body: str):
     print(f"📨 Preparando mail → {to_email}")
@@ -19,11 +43,7 @@ def send_email(to_email: str, subject: str, body: str):
         return False
 
     try:
-        msg = MIMEMultipart()
-        msg["From"] = SMTP_USER
-        msg["To"] = to_email
-        msg["Subject"] = subject
-        msg.attach(MIMEText(body, "html"))
+        msg = _build_message(to_email, subject, body)
 
         with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
             print("🔌 Conectando a SMTP...")
@@ -39,3 +59,309 @@ def send_email(to_email: str, subject: str, body: str):
     except Exception as e:
         print(f"❌ Error enviando mail a {to_email}: {e}")
         return False
+
+
+# ============================================================
+# Sesión SMTP persistente
+# ============================================================
+class SMTPSession:
+    """
+    Una conexión SMTP autenticada reutilizada entre envíos. Se usa SIEMPRE
+    desde el mismo hilo (el del EmailNotifier). Si el servidor la cortó,
+    se reconecta una vez; si estuvo ociosa más de SMTP_IDLE_TIMEOUT se
+    cierra antes de reusarla.
+    """
+
+    def __init__(self):
+        self._server: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+        self.connects = 0
+
+    def _connect(self):
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        if SMTP_STARTTLS:
+            server.starttls()
+        if SMTP_USER and SMTP_PASS:
+            server.login(SMTP_USER, SMTP_PASS)
+        self._server = server
+        self._last_used = time.monotonic()
+        self.connects += 1
+        print(f"🔌 Sesión SMTP abierta con {SMTP_SERVER}:{SMTP_PORT}")
+
+    def close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            pass
+        self._server = None
+
+    def send(self, to_email: str, subject: str, body: str):
+        if self._server is not None and time.monotonic() - self._last_used > SMTP_IDLE_TIMEOUT:
+            self.close()
+
+        msg = _build_message(to_email, subject, body).as_string()
+        for attempt in (0, 1):
+            if self._server is None:
+                self._connect()
+            try:
+                self._server.sendmail(SMTP_FROM, to_email, msg)
+                break
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+                if attempt:
+                    raise
+        self._last_used = time.monotonic()
+
+
+def _is_connection_error(e: Exception) -> bool:
+    """True si el fallo es de la conexión/servidor (afecta a todos los mails), no de uno en particular."""
+    if isinstance(e, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPAuthenticationError)):
+        return True
+    # SMTPException hereda de OSError: sólo cuentan los errores de socket "puros"
+    return isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
+
+
+# ============================================================
+# Cola de notificaciones en segundo plano
+# ============================================================
+class EmailNotifier:
+    """
+    Envío de mails fuera del loop de ingesta:
+
+    - `submit()` encola y vuelve enseguida (cola acotada; si está llena se descarta)
+    - Un único worker envía por una SMTPSession persistente en su propio hilo
+    - Reintentos con backoff exponencial ante errores SMTP: el mail fallido
+      vuelve a una cola diferida (heap por "no antes de") y el worker sigue
+      con el resto; sólo si falla la conexión se pausa toda la cola mientras
+      dura el backoff de reconexión
+    - Digest opcional por destinatario: con EMAIL_DIGEST_SECONDS > 0 los
+      mails de un mismo usuario dentro de la ventana salen en uno solo
+    """
+
+    def __init__(
+        self,
+        queue_size: int = EMAIL_QUEUE_SIZE,
+        max_retries: int = EMAIL_MAX_RETRIES,
+        retry_base: float = EMAIL_RETRY_BASE,
+        digest_seconds: float = EMAIL_DIGEST_SECONDS,
+    ):
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.digest_seconds = digest_seconds
+
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        self._session = SMTPSession()
+        # Reintentos diferidos: (no_antes_de, seq, (to_email, subject, body, t0, count, intento))
+        self._retries: List[Tuple[float, int, tuple]] = []
+        self._retry_seq = itertools.count()
+        self._paused_until = 0.0   # backoff de reconexión: no se envía nada hasta entonces
+        # destinatario → (vencimiento de la ventana, [(subject, body, t_encolado)])
+        self._digests: Dict[str, Tuple[float, List[Tuple[str, str, float]]]] = {}
+
+        self.stats = {
+            "queued": 0,
+            "sent": 0,
+            "failed": 0,
+            "dropped": 0,
+            "retried": 0,
+            "digests": 0,
+            "last_latency_ms": None,
+            "avg_latency_ms": None,
+            "last_send_ms": None,
+            "avg_send_ms": None,
+        }
+
+    # ---------------------------------------------------------
+    # Ciclo de vida
+    # ---------------------------------------------------------
+    async def start(self):
+        if self._task:
+            return
+        if not SMTP_SERVER or not SMTP_FROM:
+            print("⚠️ Notificaciones por mail deshabilitadas: SMTP no configurado")
+            return
+
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smtp")
+        self._task = asyncio.create_task(self._run())
+        print(f"🚀 Notificador de mails iniciado (digest={self.digest_seconds:g}s)")
+
+    async def stop(self, timeout: float = 10):
+        if not self._task:
+            return
+
+        # Vaciar lo pendiente (incluidos digests abiertos) con un límite de tiempo
+        try:
+            await asyncio.wait_for(self._drain(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Quedaron {self.queue_depth()} mails sin enviar al detener")
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._session.close)
+        self._executor.shutdown(wait=False)
+        self._executor = None
+        print("🛑 Notificador de mails detenido")
+
+    async def _drain(self):
+        while True:
+            await self._queue.join()
+            for to_email in list(self._digests):
+                await self._flush_digest(to_email)
+            if not self._retries:
+                return
+            # Los reintentos diferidos los despacha el worker al vencer
+            await asyncio.sleep(max(0.0, self._retries[0][0] - time.monotonic()) + 0.01)
+
+    # ---------------------------------------------------------
+    # API pública
+    # ---------------------------------------------------------
+    def submit(self, to_email: str, subject: str, body: str) -> bool:
+        """Encola un mail sin bloquear. False si no se pudo encolar."""
+        if not self._task or self._queue is None:
+            print(f"⚠️ Notificador de mails no iniciado, se descarta mail a {to_email}")
+            self.stats["dropped"] += 1
+            return False
+        try:
+            self._queue.put_nowait((to_email, subject, body, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            print(f"⚠️ Cola de mails llena, se descarta mail a {to_email}")
+            return False
+        self.stats["queued"] += 1
+        return True
+
+    def queue_depth(self) -> int:
+        return (self._queue.qsize() if self._queue else 0) + len(self._retries)
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "running": self._task is not None,
+            "queue_depth": self.queue_depth(),
+            "queue_size": self.queue_size,
+            "open_digests": len(self._digests),
+            "pending_retries": len(self._retries),
+            "paused_s": round(max(0.0, self._paused_until - time.monotonic()), 2),
+            "smtp_connects": self._session.connects,
+        }
+
+    # ---------------------------------------------------------
+    # Worker
+    # ---------------------------------------------------------
+    async def _run(self):
+        while True:
+            # Despertar con el próximo vencimiento: digest, reintento o fin de pausa
+            now = time.monotonic()
+            paused = self._paused_until > now
+            wake = [due for due, _ in self._digests.values()]
+            if self._retries:
+                wake.append(self._retries[0][0])
+            if paused:
+                wake.append(self._paused_until)
+            timeout = max(0.0, min(wake) - now) if wake else None
+
+            item = None
+            if paused:
+                # Backoff de reconexión: lo nuevo espera en la cola
+                await asyncio.sleep(timeout)
+            else:
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            if item is not None:
+                try:
+                    await self._handle(*item)
+                finally:
+                    self._queue.task_done()
+
+            # Reintentos vencidos (de a uno por vuelta si hay pausa de por medio)
+            while self._retries and self._retries[0][0] <= time.monotonic() and self._paused_until <= time.monotonic():
+                _, _, args = heapq.heappop(self._retries)
+                await self._deliver(*args)
+
+            now = time.monotonic()
+            if self._paused_until > now:
+                continue
+            for to_email in [k for k, (due, _) in self._digests.items() if due <= now]:
+                await self._flush_digest(to_email)
+
+    async def _handle(self, to_email: str, subject: str, body: str, t0: float):
+        if self.digest_seconds <= 0:
+            await self._deliver(to_email, subject, body, t0)
+            return
+
+        pending = self._digests.get(to_email)
+        if pending is None:
+            self._digests[to_email] = (time.monotonic() + self.digest_seconds, [(subject, body, t0)])
+        else:
+            pending[1].append((subject, body, t0))
+
+    async def _flush_digest(self, to_email: str):
+        pending = self._digests.pop(to_email, None)
+        if pending is None:
+            return
+        items = pending[1]
+        if len(items) == 1:
+            subject, body, t0 = items[0]
+            await self._deliver(to_email, subject, body, t0)
+            return
+
+        subject = f"⚠️ {len(items)} alarmas IoT"
+        body = "<br><hr><br>".join(f"<b>{s}</b><br>{b}" for s, b, _ in items)
+        self.stats["digests"] += 1
+        await self._deliver(to_email, subject, body, min(t for _, _, t in items), count=len(items))
+
+    async def _deliver(self, to_email: str, subject: str, body: str, t0: float, count: int = 1, attempt: int = 0):
+        """Un intento de envío; si falla se difiere al heap de reintentos (nunca duerme el worker)."""
+        loop = asyncio.get_running_loop()
+        t_send = time.perf_counter()
+        try:
+            await loop.run_in_executor(self._executor, self._session.send, to_email, subject, body)
+        except Exception as e:
+            if attempt + 1 >= self.max_retries:
+                self.stats["failed"] += count
+                print(f"❌ Error enviando mail a {to_email} (sin más reintentos): {e}")
+                return
+            delay = self.retry_base * (2 ** attempt)
+            not_before = time.monotonic() + delay
+            if _is_connection_error(e):
+                # Forzar conexión nueva y pausar la cola entera durante el backoff
+                await loop.run_in_executor(self._executor, self._session.close)
+                self._paused_until = max(self._paused_until, not_before)
+                print(f"⚠️ Falla la conexión SMTP: {e} → cola en pausa {delay:g}s")
+            else:
+                print(f"⚠️ Error enviando mail a {to_email}: {e} → reintento en {delay:g}s")
+            self.stats["retried"] += 1
+            heapq.heappush(
+                self._retries,
+                (not_before, next(self._retry_seq), (to_email, subject, body, t0, count, attempt + 1)),
+            )
+            return
+
+        now = time.perf_counter()
+        send_ms = (now - t_send) * 1000
+        latency_ms = (now - t0) * 1000
+        self.stats["sent"] += count
+        for key, value in (("send_ms", send_ms), ("latency_ms", latency_ms)):
+            prev = self.stats[f"avg_{key}"]
+            self.stats[f"last_{key}"] = round(value, 2)
+            self.stats[f"avg_{key}"] = round(value if prev is None else 0.9 * prev + 0.1 * value, 2)
+        print(f"📧 Email enviado a {to_email} ({send_ms:.0f} ms)")
+
+
+# Instancia global (la arranca/detiene main.py)
+notifier = EmailNotifier()
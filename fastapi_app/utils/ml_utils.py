@@ -1,56 +1,311 @@
 # ml_utils.py (esta implementación considera muestras cada 30 segundos)
+#
+# Estado de ML POR DISPOSITIVO: cada device_id tiene su propio buffer
+# circular, su EWMA/EWVAR y su IsolationForest por variable. Los
+# dispositivos se crean al llegar su primera lectura y, si el total
+# estimado supera ML_MEMORY_BUDGET_MB, se descartan los que llevan más
+# tiempo sin datos (LRU). Un dispositivo descartado vuelve a empezar de
+# cero la próxima vez que reporte.
+#
+# El reentrenamiento del IsolationForest corre fuera del event loop
+# (pool de procesos o de hilos, ML_TRAIN_EXECUTOR) sobre una copia del
+# buffer; mientras tanto el modelo anterior sigue puntuando y al terminar
+# se reemplaza de una sola asignación. Solo se reentrena si hay drift
+# (CUSUM del nivel, varianza suavizada sostenida o tasa de anomalías) o
+# pasó RETRAIN_MAX_SAMPLES.
+#
+# Puntuación: con una sola variable, el bosque entero es una función
+# escalonada de x (cada árbol parte la recta en intervalos). Al entrenar
+# se "compila" a umbrales ordenados + score por intervalo, y puntuar una
+# lectura pasa a ser un searchsorted, con el MISMO resultado que
+# score_samples/predict de sklearn.
+#
+# El detector es intercambiable (ML_DETECTOR o por dispositivo):
+# IsolationForest o alternativas de streaming O(1) por muestra
+# (z robusto mediana/MAD, límites EWMA, cuantiles P²).
+#
+# Persistencia: si ML_STATE_DIR está configurado, el estado de cada
+# dispositivo (buffers, EWMA, detector/modelo) se guarda periódicamente
+# en un archivo versionado por dispositivo (escritura atómica) y se
+# recupera la primera vez que el dispositivo vuelve a reportar.
+
+import os
+import time
+import pickle
+import asyncio
+import tempfile
+from abc import ABC, abstractmethod
+from urllib.parse import quote
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
+from scipy.signal import lfilter
 from sklearn.ensemble import IsolationForest
 
-# Modelos entrenados dinámicamente
-models = {
-    "temperature": None,
-    "humidity": None
-}
+VARIABLES = ("temperature", "humidity")
 
 # Buffers circulares (últimos ~150 minutos)
 MAX_BUF = 300
-buffers = {
-    "temperature": [],
-    "humidity": []
-}
-
-# Estadística incremental (EWMA + EWVAR)
-stats = {
-    "temperature": {"ewma": None, "ewvar": None},
-    "humidity": {"ewma": None, "ewvar": None}
-}
 
 ALPHA = 0.15           # suavizado
-RETRAIN_EVERY = 20     # cada 10 minutos
+# Reentrenamiento por drift, acotado entre un mínimo y un máximo de muestras
+RETRAIN_MIN_SAMPLES = int(os.getenv("ML_RETRAIN_MIN_SAMPLES", "20"))    # 10 minutos
+RETRAIN_MAX_SAMPLES = int(os.getenv("ML_RETRAIN_MAX_SAMPLES", "720"))   # 6 horas
+DRIFT_CUSUM_K = 0.5      # holgura por muestra (en std de entrenamiento) del CUSUM de nivel
+DRIFT_CUSUM_H = 8.0      # umbral del CUSUM de nivel
+DRIFT_VAR_SMOOTH = 0.02  # suavizado extra de la varianza EWMA (~50 muestras)
+DRIFT_VAR_RATIO = 2.0    # std suavizada ×2 o ÷2 respecto de la del entrenamiento...
+DRIFT_HOLD = 10          # ...sostenido durante tantas muestras seguidas
+SCORE_SHIFT_RATE = 0.06  # > 3× la contaminación esperada marcada como anómala
+
+# Presupuesto de memoria para todos los dispositivos
+ML_MEMORY_BUDGET_MB = float(os.getenv("ML_MEMORY_BUDGET_MB", "64"))
+
+# Reentrenamiento fuera del loop: "process" | "thread"
+ML_TRAIN_EXECUTOR = os.getenv("ML_TRAIN_EXECUTOR", "process")
+ML_TRAIN_WORKERS = int(os.getenv("ML_TRAIN_WORKERS", "2"))
+
+# Detector por defecto: "iforest" | "robust_z" | "ewma" | "quantile"
+ML_DETECTOR = os.getenv("ML_DETECTOR", "iforest")
+MIN_SAMPLES = 20       # muestras antes de empezar a marcar anomalías
+
+# Snapshots de estado en disco ("" = deshabilitado)
+ML_STATE_DIR = os.getenv("ML_STATE_DIR", "")
+ML_SNAPSHOT_INTERVAL = float(os.getenv("ML_SNAPSHOT_INTERVAL", "300"))
+STATE_VERSION = 1      # cambiar si cambia el formato del snapshot
+
+# Ventana de lecturas para los umbrales dinámicos (media ± 3·std)
+DYN_WINDOW = 100
+DYN_MIN_SAMPLES = 5
+
 
 ###############################################################
-# EWMA + varianza exponencial
+# Estado por variable / por dispositivo
 ###############################################################
-def ewma_update(name, x):
-    st = stats[name]
+class VarState:
+    """Buffer circular + EWMA/EWVAR + detector de UNA variable de un dispositivo."""
+    __slots__ = ("buf", "pos", "count", "samples", "ewma", "ewvar", "detector")
+
+    def __init__(self, detector: str = ML_DETECTOR) -> None:
+        self.buf = np.empty(MAX_BUF, dtype=np.float64)
+        self.pos = 0          # próxima posición a escribir
+        self.count = 0        # muestras válidas en el buffer (≤ MAX_BUF)
+        self.samples = 0      # total de muestras recibidas
+        self.ewma: Optional[float] = None
+        self.ewvar: Optional[float] = None
+        self.detector: "Detector" = make_detector(detector)
+
+    def append(self, x: float) -> None:
+        self.buf[self.pos] = x
+        self.pos = (self.pos + 1) % MAX_BUF
+        self.count = min(self.count + 1, MAX_BUF)
+        self.samples += 1
+
+    def values(self) -> np.ndarray:
+        """Contenido del buffer en orden cronológico (copia)."""
+        if self.count < MAX_BUF:
+            return self.buf[:self.count].copy()
+        return np.concatenate((self.buf[self.pos:], self.buf[:self.pos]))
+
+    def nbytes(self) -> int:
+        return self.buf.nbytes + 64 + self.detector.state_size()
+
+
+class DeviceML:
+    __slots__ = ("device_id", "vars", "last_used", "dirty")
+
+    def __init__(self, device_id: str) -> None:
+        self.device_id = device_id
+        detector = detector_for(device_id)
+        self.vars: Dict[str, VarState] = {v: VarState(detector) for v in VARIABLES}
+        self.last_used = time.time()
+        self.dirty = False     # cambios sin guardar en disco
+
+    def nbytes(self) -> int:
+        return sum(st.nbytes() for st in self.vars.values())
+
+
+###############################################################
+# Registro de dispositivos (LRU con presupuesto de memoria)
+###############################################################
+class ModelRegistry:
+    def __init__(self, budget_mb: float = ML_MEMORY_BUDGET_MB) -> None:
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self._devices: "OrderedDict[str, DeviceML]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self.total_bytes = 0
+        self.evicted = 0
+
+    def get(self, device_id: str) -> DeviceML:
+        """Devuelve (o crea) el estado del dispositivo y lo marca como reciente."""
+        dev = self._devices.get(device_id)
+        if dev is None:
+            dev = load_state(device_id) or DeviceML(device_id)
+            self._devices[device_id] = dev
+            self.account(dev)
+        else:
+            self._devices.move_to_end(device_id)
+        dev.last_used = time.time()
+        return dev
+
+    def peek(self, device_id: str) -> Optional[DeviceML]:
+        """Como get() pero sin crear ni alterar el orden LRU."""
+        return self._devices.get(device_id)
+
+    def account(self, dev: DeviceML) -> None:
+        """Recalcula el tamaño del dispositivo (ej: tras entrenar) y aplica el presupuesto."""
+        size = dev.nbytes()
+        self.total_bytes += size - self._sizes.get(dev.device_id, 0)
+        self._sizes[dev.device_id] = size
+        self._enforce_budget(keep=dev.device_id)
 
-    if st["ewma"] is None:
-        st["ewma"] = x
-        st["ewvar"] = 0.0
+    def _enforce_budget(self, keep: str) -> None:
+        while self.total_bytes > self.budget_bytes and len(self._devices) > 1:
+            device_id = next(iter(self._devices))
+            if device_id == keep:
+                self._devices.move_to_end(device_id)
+                continue
+            evicted = self._devices[device_id]
+            if evicted.dirty:
+                save_state(evicted)
+            self.remove(device_id)
+            self.evicted += 1
+            print(f"🧹 [ML] Estado de {device_id} descartado (presupuesto de memoria)")
+
+    def put(self, dev: DeviceML) -> None:
+        """Reemplaza (o agrega) el estado completo de un dispositivo."""
+        self.remove(dev.device_id)
+        self._devices[dev.device_id] = dev
+        self.account(dev)
+
+    def device_ids(self) -> list:
+        return list(self._devices)
+
+    def remove(self, device_id: str) -> None:
+        self._devices.pop(device_id, None)
+        self.total_bytes -= self._sizes.pop(device_id, 0)
+
+    def stats(self) -> dict:
+        return {
+            "devices": len(self._devices),
+            "memory_mb": round(self.total_bytes / (1024 * 1024), 2),
+            "budget_mb": round(self.budget_bytes / (1024 * 1024), 2),
+            "evicted": self.evicted,
+            "training": {**train_stats, "reasons": dict(train_stats["reasons"]), "inflight": len(_inflight)},
+            "scoring": dict(score_stats),
+            "persistence": {**persist_stats, "dir": ML_STATE_DIR or None},
+        }
+
+
+registry = ModelRegistry()
+
+
+###############################################################
+# EWMA + varianza exponencial
+###############################################################
+def ewma_update(st: VarState, x: float):
+    if st.ewma is None:
+        st.ewma = x
+        st.ewvar = 0.0
     else:
-        prev_mean = st["ewma"]
-        st["ewma"] = ALPHA * x + (1 - ALPHA) * st["ewma"]
-        st["ewvar"] = (1 - ALPHA) * (st["ewvar"] + ALPHA * (x - prev_mean) ** 2)
+        # d * d (no ** 2): mismo redondeo que la versión por lotes
+        d = x - st.ewma
+        st.ewma = ALPHA * x + (1 - ALPHA) * st.ewma
+        st.ewvar = (1 - ALPHA) * (st.ewvar + ALPHA * (d * d))
 
-    mean = st["ewma"]
-    std = np.sqrt(st["ewvar"]) if st["ewvar"] > 0 else 0.001
+    mean = st.ewma
+    std = np.sqrt(st.ewvar) if st.ewvar > 0 else 0.001
     return mean, std
 
+
+###############################################################
+# EWMA / umbrales por lotes (backfill, reconstrucción de estado)
+###############################################################
+# Las recurrencias se resuelven con lfilter (filtro IIR de un polo):
+#   media:     m_t = A·x_t + (1−A)·m_{t−1}
+#   varianza:  s_t = A·d_t² + (1−A)·s_{t−1},  v_t = (1−A)·s_t
+# (s_t = v_{t−1} + A·d_t², d_t = x_t − m_{t−1}). Cada paso hace las mismas
+# operaciones IEEE que ewma_update, así el resultado es idéntico bit a bit.
+def ewma_batch(values, mean0: Optional[float] = None, var0: Optional[float] = None):
+    """
+    EWMA/EWVAR de toda una serie: (means, variances), igual que llamar
+    ewma_update muestra a muestra partiendo de (mean0, var0).
+    """
+    x = np.asarray(values, dtype=np.float64)
+    means = np.empty(len(x))
+    variances = np.empty(len(x))
+    if len(x) == 0:
+        return means, variances
+
+    start = 0
+    if mean0 is None:
+        means[0], variances[0] = x[0], 0.0
+        mean0, var0 = x[0], 0.0
+        start = 1
+    rest = x[start:]
+    if len(rest) == 0:
+        return means, variances
+
+    den = (1.0, -(1 - ALPHA))
+    means[start:], _ = lfilter((ALPHA,), den, rest, zi=((1 - ALPHA) * mean0,))
+
+    prev = np.empty(len(rest))
+    prev[0] = mean0
+    prev[1:] = means[start:-1]
+    d = rest - prev
+    s, _ = lfilter((1.0,), den, ALPHA * (d * d), zi=(var0 or 0.0,))
+    variances[start:] = (1 - ALPHA) * s
+    return means, variances
+
+
+def ewma_bands_batch(values) -> Dict[str, np.ndarray]:
+    """mean/std/dyn_min/dyn_max por lectura, como los que devuelve update_and_predict."""
+    means, variances = ewma_batch(values)
+    std = np.where(variances > 0, np.sqrt(np.maximum(variances, 0.0)), 0.001)
+    return {
+        "mean": means,
+        "std": std,
+        "dyn_min": means - 3 * std,
+        "dyn_max": means + 3 * std,
+    }
+
+
+def rolling_thresholds(values, window: int = DYN_WINDOW) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (min, max) de media ± 3·std sobre las últimas `window` lecturas en cada
+    posición, como dynamic_thresholds() tras recibir esa lectura (NaN
+    mientras haya menos de DYN_MIN_SAMPLES).
+    """
+    x = np.asarray(values, dtype=np.float64)
+    window = min(window, MAX_BUF)
+    lo = np.full(len(x), np.nan)
+    hi = np.full(len(x), np.nan)
+
+    # Ventanas parciales del arranque
+    for i in range(DYN_MIN_SAMPLES - 1, min(window - 1, len(x))):
+        w = x[:i + 1]
+        mean, std = np.mean(w), np.std(w)
+        lo[i], hi[i] = mean - 3 * std, mean + 3 * std
+
+    # Ventanas completas, todas de una vez
+    if len(x) >= window:
+        views = np.lib.stride_tricks.sliding_window_view(x, window)
+        mean = views.mean(axis=1)
+        std = views.std(axis=1)
+        lo[window - 1:] = mean - 3 * std
+        hi[window - 1:] = mean + 3 * std
+    return lo, hi
+
 ###############################################################
 # Isolation Forest
 ###############################################################
-def train_iforest(var_name: str, values: list[float]):
+def train_iforest(values):
     if len(values) < 20:
         return None
 
-    X = np.array(values).reshape(-1, 1)
+    X = np.asarray(values, dtype=np.float64).reshape(-1, 1)
 
     model = IsolationForest(
         n_estimators=150,
@@ -59,42 +314,787 @@ def train_iforest(var_name: str, values: list[float]):
         random_state=42
     )
     model.fit(X)
-    models[var_name] = model
     return model
 
-def predict_anomaly(var_name: str, value: float):
-    model = models.get(var_name)
-    if model is None:
-        return False, 0.0
+class CompiledForest:
+    """
+    IsolationForest de una variable compilado a función escalonada.
+
+    `thresholds` son todos los cortes de todos los árboles (ordenados) y
+    `scores[i]` el score_samples de cualquier x en (thresholds[i-1], thresholds[i]].
+    Los árboles de sklearn comparan en float32 (`x <= threshold` va a la
+    izquierda), por eso x se castea igual antes de buscar.
+    """
+    __slots__ = ("thresholds", "scores", "offset")
+
+    def __init__(self, thresholds: np.ndarray, scores: np.ndarray, offset: float) -> None:
+        self.thresholds = thresholds
+        self.scores = scores
+        self.offset = offset
+
+    @classmethod
+    def from_model(cls, model: IsolationForest) -> "CompiledForest":
+        t = np.unique(np.concatenate([
+            e.tree_.threshold[e.tree_.feature >= 0] for e in model.estimators_
+        ]))
+
+        # Un representante float32 por intervalo: el mayor float32 <= t[i]
+        reps = t.astype(np.float32)
+        over = reps.astype(np.float64) > t
+        reps[over] = np.nextafter(reps[over], np.float32(-np.inf))
+        last = np.float32(t[-1]) if len(t) else np.float32(0)
+        if len(t) and float(last) <= t[-1]:
+            last = np.nextafter(last, np.float32(np.inf))
+        reps = np.append(reps, last)
+
+        scores = model.score_samples(reps.reshape(-1, 1).astype(np.float64))
+        return cls(t, scores, float(model.offset_))
+
+    def score_many(self, values) -> np.ndarray:
+        x = np.asarray(values, dtype=np.float32).astype(np.float64)
+        return self.scores[np.searchsorted(self.thresholds, x, side="left")]
+
+    def predict(self, value: float) -> Tuple[bool, float]:
+        """(anomalía, score) — anomalía ⇔ score < offset_ (igual que predict())."""
+        score = float(self.score_many(value))
+        return bool(score < self.offset), score
+
+    def nbytes(self) -> int:
+        return self.thresholds.nbytes + self.scores.nbytes
+
+
+def _train_job(values):
+    """Se ejecuta en el pool: entrena, compila y mide cuánto tardó."""
+    t0 = time.perf_counter()
+    model = train_iforest(values)
+    compiled = CompiledForest.from_model(model) if model is not None else None
+    return compiled, (time.perf_counter() - t0) * 1000
+
+###############################################################
+# Detectores
+###############################################################
+class Detector(ABC):
+    """
+    Interfaz común de los detectores de anomalías de una variable:
+      · score(x)     → (anomalía, score) ANTES de incorporar x
+      · update(x)    → incorpora la muestra al estado
+      · state_size() → bytes aproximados del estado
+    El score es propio de cada detector (IsolationForest: score_samples,
+    menor = más anómalo; el resto: |z| o desvío normalizado, mayor = más anómalo).
+    """
+    name = ""
+
+    @abstractmethod
+    def update(self, x: float) -> None:
+        ...
+
+    @abstractmethod
+    def score(self, x: float) -> Tuple[bool, float]:
+        ...
+
+    def state_size(self) -> int:
+        return 64
+
+
+class IForestDetector(Detector):
+    """IsolationForest compilado; se reentrena en el pool con el buffer del VarState."""
+    name = "iforest"
+
+    # Referencia del último entrenamiento (para detectar drift).
+    # Como atributos de clase sirven de default para snapshots viejos.
+    trained_at = 0        # VarState.samples al agendar el entrenamiento
+    ref_mean = 0.0        # nivel (EWMA) al entrenar
+    ref_std = 0.0         # std del buffer entrenado
+    ref_ewstd = 0.0       # std EWMA suavizada en ese momento
+    scored = 0            # lecturas puntuadas / marcadas desde entonces
+    flagged = 0
+    # Estado del test de drift (se actualiza una vez por muestra)
+    cusum_pos = 0.0
+    cusum_neg = 0.0
+    ewvar_slow: Optional[float] = None
+    var_hold = 0
+
+    def __init__(self) -> None:
+        self.model: Optional[CompiledForest] = None
+
+    def update(self, x: float) -> None:
+        pass   # el buffer de entrenamiento vive en VarState
+
+    def score(self, x: float) -> Tuple[bool, float]:
+        if self.model is None:
+            return False, 0.0
+        anom, score = self.model.predict(x)
+        self.scored += 1
+        self.flagged += anom
+        return anom, score
+
+    def state_size(self) -> int:
+        return 64 + (self.model.nbytes() if self.model is not None else 0)
+
+
+class P2Quantile:
+    """Estimador P² (Jain & Chlamtac) de un cuantil: 5 marcadores, O(1) por muestra."""
+    __slots__ = ("p", "q", "n", "np_", "dn", "init")
+
+    def __init__(self, p: float) -> None:
+        self.p = p
+        self.init: list = []
+        self.q: Optional[list] = None
+
+    def add(self, x: float) -> None:
+        if self.q is None:
+            self.init.append(x)
+            if len(self.init) == 5:
+                p = self.p
+                self.q = sorted(self.init)
+                self.n = [0, 1, 2, 3, 4]
+                self.np_ = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+                self.dn = [0, p / 2, p, (1 + p) / 2, 1]
+                self.init = []
+            return
+
+        q, n = self.q, self.n
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.np_[i] += self.dn[i]
+
+        for i in (1, 2, 3):
+            d = self.np_[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                qp = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not q[i - 1] < qp < q[i + 1]:
+                    qp = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = qp
+                n[i] += d
+
+    def value(self) -> Optional[float]:
+        if self.q is not None:
+            return self.q[2]
+        if not self.init:
+            return None
+        vals = sorted(self.init)
+        return vals[int(self.p * (len(vals) - 1))]
+
+
+class RobustZDetector(Detector):
+    """z robusto = 0.6745·(x − mediana)/MAD, mediana y MAD por P²; anomalía si |z| > 3.5."""
+    name = "robust_z"
+    Z_LIMIT = 3.5
+
+    def __init__(self) -> None:
+        self.median = P2Quantile(0.5)
+        self.mad = P2Quantile(0.5)
+        self.n = 0
+
+    def update(self, x: float) -> None:
+        med = self.median.value()
+        self.median.add(x)
+        if med is not None:
+            self.mad.add(abs(x - med))
+        self.n += 1
+
+    def score(self, x: float) -> Tuple[bool, float]:
+        med, mad = self.median.value(), self.mad.value()
+        if self.n < MIN_SAMPLES or med is None or not mad:
+            return False, 0.0
+        z = abs(0.6745 * (x - med) / mad)
+        return bool(z > self.Z_LIMIT), float(z)
+
+    def state_size(self) -> int:
+        return 64 + 2 * 5 * 4 * 8
+
+
+class EWMADetector(Detector):
+    """Límites de control EWMA: anomalía si |x − media| > 3·σ (media/varianza exponenciales)."""
+    name = "ewma"
+    L = 3.0
+
+    def __init__(self) -> None:
+        self.mean: Optional[float] = None
+        self.var = 0.0
+        self.n = 0
+
+    def update(self, x: float) -> None:
+        if self.mean is None:
+            self.mean = x
+        else:
+            prev = self.mean
+            self.mean = ALPHA * x + (1 - ALPHA) * prev
+            d = x - prev
+            self.var = (1 - ALPHA) * (self.var + ALPHA * (d * d))
+        self.n += 1
+
+    def score(self, x: float) -> Tuple[bool, float]:
+        if self.n < MIN_SAMPLES or self.mean is None:
+            return False, 0.0
+        std = np.sqrt(self.var) if self.var > 0 else 0.001
+        z = abs(x - self.mean) / std
+        return bool(z > self.L), float(z)
+
+
+class QuantileDetector(Detector):
+    """Sketch P² de los cuantiles 1% y 99%: anomalía si x cae fuera de la banda."""
+    name = "quantile"
+    LOW, HIGH = 0.01, 0.99
+
+    def __init__(self) -> None:
+        self.low = P2Quantile(self.LOW)
+        self.high = P2Quantile(self.HIGH)
+        self.n = 0
+
+    def update(self, x: float) -> None:
+        self.low.add(x)
+        self.high.add(x)
+        self.n += 1
+
+    def score(self, x: float) -> Tuple[bool, float]:
+        lo, hi = self.low.value(), self.high.value()
+        if self.n < MIN_SAMPLES or lo is None or hi is None:
+            return False, 0.0
+        width = (hi - lo) or 0.001
+        excess = max(lo - x, x - hi, 0.0) / width
+        return bool(excess > 0), float(excess)
+
+    def state_size(self) -> int:
+        return 64 + 2 * 5 * 4 * 8
+
+
+DETECTORS = {
+    IForestDetector.name: IForestDetector,
+    RobustZDetector.name: RobustZDetector,
+    EWMADetector.name: EWMADetector,
+    QuantileDetector.name: QuantileDetector,
+}
+
+# device_id → detector (si no figura, se usa el global)
+detector_overrides: Dict[str, str] = {}
+_default_detector = ML_DETECTOR if ML_DETECTOR in DETECTORS else IForestDetector.name
 
-    pred = model.predict([[value]])[0]
-    score = model.score_samples([[value]])[0]
-    return pred == -1, float(score)
+
+def make_detector(name: str) -> Detector:
+    return DETECTORS.get(name, IForestDetector)()
+
+
+def detector_for(device_id: str) -> str:
+    return detector_overrides.get(device_id, _default_detector)
+
+
+def set_detector(name: str, device_id: Optional[str] = None) -> None:
+    """
+    Cambia el detector global (device_id=None) o el de un dispositivo.
+    Los dispositivos ya cargados afectados arrancan con un detector nuevo.
+    """
+    global _default_detector
+    if name not in DETECTORS:
+        raise ValueError(f"Detector desconocido: {name}")
+
+    if device_id is None:
+        _default_detector = name
+        affected = [d for d in registry.device_ids() if d not in detector_overrides]
+    else:
+        detector_overrides[device_id] = name
+        affected = [device_id]
+
+    for dev_id in affected:
+        dev = registry.peek(dev_id)
+        if dev is None:
+            continue
+        for st in dev.vars.values():
+            if st.detector.name != name:
+                st.detector = make_detector(name)
+        registry.account(dev)
+    print(f"🧠 [ML] Detector {name} → {device_id or 'global'}")
+
+
+def detectors_info() -> dict:
+    return {
+        "default": _default_detector,
+        "available": list(DETECTORS),
+        "overrides": dict(detector_overrides),
+    }
+
+
+###############################################################
+# Reentrenamiento asíncrono (pool + swap atómico)
+###############################################################
+_executor: Optional[Executor] = None
+_inflight: set = set()     # (device_id, variable) con un entrenamiento en curso
+
+train_stats = {
+    "scheduled": 0,
+    "completed": 0,
+    "failed": 0,
+    "deduped": 0,
+    "reasons": {},
+    "last_ms": None,
+    "avg_ms": None,
+    "max_ms": 0.0,
+}
+
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if ML_TRAIN_EXECUTOR == "process":
+            try:
+                _executor = ProcessPoolExecutor(max_workers=ML_TRAIN_WORKERS)
+            except (OSError, NotImplementedError) as e:
+                print(f"⚠️ [ML] Pool de procesos no disponible ({e}), usando hilos")
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=ML_TRAIN_WORKERS, thread_name_prefix="ml-train")
+        print(f"🧠 [ML] Reentrenamiento en {type(_executor).__name__} ({ML_TRAIN_WORKERS} workers)")
+    return _executor
+
+
+def shutdown_training() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _record_train_ms(ms: float) -> None:
+    train_stats["completed"] += 1
+    train_stats["last_ms"] = round(ms, 2)
+    prev = train_stats["avg_ms"]
+    train_stats["avg_ms"] = round(ms if prev is None else 0.9 * prev + 0.1 * ms, 2)
+    train_stats["max_ms"] = round(max(train_stats["max_ms"], ms), 2)
+
+
+def _drift_update(st: VarState) -> None:
+    """
+    Incorpora la última muestra del buffer a los estadísticos de drift:
+      · CUSUM de (x − nivel de entrenamiento)/std de entrenamiento: un
+        desvío chico pero persistente se acumula, el ruido (|z| < K) no;
+        una tendencia lenta tarda en llegar a H en vez de disparar cada
+        vez que la media de la ventana queda atrás
+      · varianza EWMA suavizada y cuántas muestras seguidas lleva fuera
+        de la banda ×/÷ DRIFT_VAR_RATIO respecto de la de entrenamiento
+    """
+    det = st.detector
+    if st.ewvar is not None:
+        prev = det.ewvar_slow
+        det.ewvar_slow = st.ewvar if prev is None else prev + DRIFT_VAR_SMOOTH * (st.ewvar - prev)
+
+    if det.trained_at == 0:
+        return
+
+    x = float(st.buf[(st.pos - 1) % MAX_BUF])
+    z = (x - det.ref_mean) / max(det.ref_std, 1e-3)
+    det.cusum_pos = max(0.0, det.cusum_pos + z - DRIFT_CUSUM_K)
+    det.cusum_neg = max(0.0, det.cusum_neg - z - DRIFT_CUSUM_K)
+
+    if det.ref_ewstd > 0 and det.ewvar_slow is not None:
+        ratio = max(np.sqrt(det.ewvar_slow), 1e-3) / det.ref_ewstd
+        outside = ratio > DRIFT_VAR_RATIO or ratio < 1 / DRIFT_VAR_RATIO
+        det.var_hold = det.var_hold + 1 if outside else 0
+
+
+def retrain_reason(st: VarState) -> Optional[str]:
+    """
+    Motivo para reentrenar el IsolationForest de una variable, o None:
+      initial · mean_shift · var_shift · score_shift · max_interval
+    Nunca antes de RETRAIN_MIN_SAMPLES desde el último entrenamiento.
+    Llamar UNA vez por muestra (actualiza los estadísticos de drift).
+    """
+    det = st.detector
+    _drift_update(st)
+    if det.model is None and det.trained_at == 0:
+        return "initial" if st.count >= MIN_SAMPLES else None
+
+    since = st.samples - det.trained_at
+    if since < RETRAIN_MIN_SAMPLES:
+        return None
+    if det.model is None:
+        return "initial"          # el intento anterior falló
+    if since >= RETRAIN_MAX_SAMPLES:
+        return "max_interval"
+
+    if max(det.cusum_pos, det.cusum_neg) > DRIFT_CUSUM_H:
+        return "mean_shift"
+
+    if det.var_hold >= DRIFT_HOLD:
+        return "var_shift"
+
+    if det.scored >= RETRAIN_MIN_SAMPLES and det.flagged / det.scored > SCORE_SHIFT_RATE:
+        return "score_shift"
+    return None
+
+
+def _mark_trained(st: VarState, snapshot: np.ndarray, reason: str) -> None:
+    """Nueva referencia de drift (al agendar, así no se vuelve a disparar)."""
+    det = st.detector
+    det.trained_at = st.samples
+    # Nivel ACTUAL (no la media de la ventana, que con tendencia queda atrás)
+    det.ref_mean = float(st.ewma) if st.ewma is not None else float(np.mean(snapshot))
+    det.ref_std = float(np.std(snapshot))
+    var = det.ewvar_slow if det.ewvar_slow is not None else st.ewvar
+    det.ref_ewstd = float(np.sqrt(var)) if var else 0.0
+    det.scored = det.flagged = 0
+    det.cusum_pos = det.cusum_neg = 0.0
+    det.var_hold = 0
+    reasons = train_stats["reasons"]
+    reasons[reason] = reasons.get(reason, 0) + 1
+
+
+def schedule_retrain(dev: "DeviceML", name: str, reason: str = "manual") -> None:
+    """
+    Reentrena el modelo de (dispositivo, variable) sin bloquear el loop.
+    Si ya hay un entrenamiento en curso para esa clave, no se agenda otro.
+    Sin event loop (scripts, herramientas) se entrena en línea.
+    """
+    st = dev.vars[name]
+    detector = st.detector
+    if not isinstance(detector, IForestDetector):
+        return
+    snapshot = st.values()
+    if len(snapshot) < MIN_SAMPLES:
+        return
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _mark_trained(st, snapshot, reason)
+        model, ms = _train_job(snapshot)
+        detector.model = model
+        _record_train_ms(ms)
+        registry.account(dev)
+        return
+
+    key = (dev.device_id, name)
+    if key in _inflight:
+        train_stats["deduped"] += 1
+        return
+
+    _inflight.add(key)
+    _mark_trained(st, snapshot, reason)
+    train_stats["scheduled"] += 1
+    future = loop.run_in_executor(_get_executor(), _train_job, snapshot)
+
+    def _done(fut: asyncio.Future) -> None:
+        _inflight.discard(key)
+        try:
+            model, ms = fut.result()
+        except Exception as e:
+            train_stats["failed"] += 1
+            print(f"❌ [ML] Error reentrenando {dev.device_id}/{name}: {e}")
+            return
+        # Swap atómico: el modelo anterior puntuó hasta este momento
+        detector.model = model
+        _record_train_ms(ms)
+        if registry.peek(dev.device_id) is dev:
+            registry.account(dev)
+
+    future.add_done_callback(_done)
+
+score_stats = {"count": 0, "avg_us": None, "max_us": 0.0}
+
+
+def predict_anomaly(detector: Detector, value: float):
+    t0 = time.perf_counter()
+    anom, score = detector.score(value)
+    us = (time.perf_counter() - t0) * 1e6
+
+    score_stats["count"] += 1
+    prev = score_stats["avg_us"]
+    score_stats["avg_us"] = round(us if prev is None else 0.99 * prev + 0.01 * us, 2)
+    score_stats["max_us"] = round(max(score_stats["max_us"], us), 2)
+    return anom, score
+
+def score_batch(items: List[Tuple[str, str, float]]) -> List[Tuple[bool, float]]:
+    """
+    Puntúa muchas lecturas [(device_id, variable, valor)] sin tocar el estado:
+    una llamada vectorizada por modelo IsolationForest (herramientas de
+    evaluación / replays); los demás detectores puntúan de a uno.
+    """
+    results: List[Tuple[bool, float]] = [(False, 0.0)] * len(items)
+    groups: Dict[int, Tuple[CompiledForest, list]] = {}
+    for i, (device_id, name, value) in enumerate(items):
+        dev = registry.peek(device_id)
+        if dev is None:
+            continue
+        detector = dev.vars[name].detector
+        model = getattr(detector, "model", None)
+        if model is not None:
+            groups.setdefault(id(model), (model, []))[1].append((i, value))
+        elif not isinstance(detector, IForestDetector):
+            results[i] = detector.score(value)
+
+    for model, rows in groups.values():
+        scores = model.score_many([v for _, v in rows])
+        for (i, _), sc in zip(rows, scores):
+            results[i] = (bool(sc < model.offset), float(sc))
+    return results
+
+###############################################################
+# Persistencia (snapshot por dispositivo en disco)
+###############################################################
+persist_stats = {
+    "saved": 0,
+    "restored": 0,
+    "failed": 0,
+    "last_save_ms": None,
+    "last_restore_ms": None,
+}
+
+
+def _state_path(device_id: str) -> str:
+    return os.path.join(ML_STATE_DIR, quote(device_id, safe="") + ".pkl")
+
+
+def _serialize(dev: DeviceML) -> bytes:
+    return pickle.dumps({
+        "version": STATE_VERSION,
+        "device_id": dev.device_id,
+        "saved_at": time.time(),
+        "vars": {
+            name: {
+                "values": st.values(),
+                "samples": st.samples,
+                "ewma": st.ewma,
+                "ewvar": st.ewvar,
+                "detector": st.detector,
+            }
+            for name, st in dev.vars.items()
+        },
+    }, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """tempfile en el mismo directorio + fsync + os.replace: nunca queda un archivo a medias."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def save_state(dev: DeviceML) -> bool:
+    if not ML_STATE_DIR:
+        return False
+    t0 = time.perf_counter()
+    try:
+        os.makedirs(ML_STATE_DIR, exist_ok=True)
+        _write_atomic(_state_path(dev.device_id), _serialize(dev))
+    except Exception as e:
+        persist_stats["failed"] += 1
+        print(f"❌ [ML] No se pudo guardar el estado de {dev.device_id}: {e}")
+        return False
+    dev.dirty = False
+    persist_stats["saved"] += 1
+    persist_stats["last_save_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+    return True
+
+
+def load_state(device_id: str) -> Optional[DeviceML]:
+    """Recupera el snapshot del dispositivo (None si no hay o es de otra versión)."""
+    if not ML_STATE_DIR:
+        return None
+    path = _state_path(device_id)
+    if not os.path.exists(path):
+        return None
+
+    t0 = time.perf_counter()
+    try:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("version") != STATE_VERSION or data.get("device_id") != device_id:
+            print(f"ℹ️ [ML] Snapshot de {device_id} ignorado (versión {data.get('version')})")
+            return None
+
+        dev = DeviceML(device_id)
+        wanted = detector_for(device_id)
+        for name, saved in data["vars"].items():
+            st = dev.vars.get(name)
+            if st is None:
+                continue
+            values = np.asarray(saved["values"], dtype=np.float64)[-MAX_BUF:]
+            st.buf[:len(values)] = values
+            st.count = len(values)
+            st.pos = len(values) % MAX_BUF
+            st.samples = int(saved["samples"])
+            st.ewma = saved["ewma"]
+            st.ewvar = saved["ewvar"]
+            if saved["detector"].name == wanted:
+                st.detector = saved["detector"]
+    except Exception as e:
+        persist_stats["failed"] += 1
+        print(f"❌ [ML] Snapshot de {device_id} ilegible: {e}")
+        return None
+
+    ms = (time.perf_counter() - t0) * 1000
+    persist_stats["restored"] += 1
+    persist_stats["last_restore_ms"] = round(ms, 2)
+    print(f"♻️ [ML] Estado de {device_id} restaurado en {ms:.1f} ms")
+    return dev
+
+
+def save_all_states(only_dirty: bool = True) -> int:
+    saved = 0
+    for device_id in registry.device_ids():
+        dev = registry.peek(device_id)
+        if dev is not None and (dev.dirty or not only_dirty) and save_state(dev):
+            saved += 1
+    return saved
+
+
+async def run_state_saver(interval: float = ML_SNAPSHOT_INTERVAL) -> None:
+    """
+    Guarda periódicamente los dispositivos con cambios. Se serializa en el
+    loop (foto consistente) y se escribe a disco en un hilo.
+    """
+    if not ML_STATE_DIR:
+        return
+    print(f"💾 [ML] Snapshots de estado en {ML_STATE_DIR} cada {interval:.0f}s")
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        t0 = time.perf_counter()
+        pending = []
+        for device_id in registry.device_ids():
+            dev = registry.peek(device_id)
+            if dev is not None and dev.dirty:
+                pending.append((dev, _serialize(dev)))
+                dev.dirty = False
+
+        def _write_all():
+            os.makedirs(ML_STATE_DIR, exist_ok=True)
+            for dev, data in pending:
+                try:
+                    _write_atomic(_state_path(dev.device_id), data)
+                    persist_stats["saved"] += 1
+                except Exception as e:
+                    dev.dirty = True
+                    persist_stats["failed"] += 1
+                    print(f"❌ [ML] No se pudo guardar el estado de {dev.device_id}: {e}")
+
+        if pending:
+            await loop.run_in_executor(None, _write_all)
+            persist_stats["last_save_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+            print(f"💾 [ML] {len(pending)} snapshots guardados en {persist_stats['last_save_ms']} ms")
+
+
+###############################################################
+# Umbrales dinámicos (media ± 3·std de las últimas lecturas)
+###############################################################
+def dynamic_thresholds(device_id: str, window: int = DYN_WINDOW) -> Optional[dict]:
+    dev = registry.get(device_id)
+    temps = dev.vars["temperature"].values()[-window:]
+    hums = dev.vars["humidity"].values()[-window:]
+    if len(temps) < DYN_MIN_SAMPLES or len(hums) < DYN_MIN_SAMPLES:
+        return None
+
+    return {
+        "temp_min": float(np.mean(temps) - 3 * np.std(temps)),
+        "temp_max": float(np.mean(temps) + 3 * np.std(temps)),
+        "hum_min": float(np.mean(hums) - 3 * np.std(hums)),
+        "hum_max": float(np.mean(hums) + 3 * np.std(hums)),
+    }
+
+
+###############################################################
+# Reconstrucción de estado desde la historia (vectorizada)
+###############################################################
+def rebuild_state(device_id: str, temps, hums) -> DeviceML:
+    """
+    Arma el estado de un dispositivo desde sus lecturas históricas (orden
+    cronológico; None/NaN se ignoran) sin pasar muestra a muestra por
+    update_and_predict: buffer, contadores y EWMA/EWVAR quedan iguales a
+    los del replay. El IsolationForest se entrena una vez con el buffer y
+    los detectores P² se recalientan solo con el buffer.
+    """
+    dev = DeviceML(device_id)
+    for name, series in (("temperature", temps), ("humidity", hums)):
+        x = np.asarray(series, dtype=np.float64)
+        x = x[~np.isnan(x)]
+        if len(x) == 0:
+            continue
+
+        st = dev.vars[name]
+        tail = x[-MAX_BUF:]
+        st.buf[:len(tail)] = tail
+        st.count = len(tail)
+        st.pos = len(tail) % MAX_BUF
+        st.samples = len(x)
+
+        means, variances = ewma_batch(x)
+        st.ewma, st.ewvar = float(means[-1]), float(variances[-1])
+
+        det = st.detector
+        if isinstance(det, EWMADetector):
+            det.mean, det.var, det.n = st.ewma, st.ewvar, len(x)
+        elif not isinstance(det, IForestDetector):
+            for v in tail.tolist():
+                det.update(v)
+
+    dev.dirty = True
+    registry.put(dev)
+    for name in VARIABLES:
+        schedule_retrain(dev, name, "rebuild")
+    return dev
+
+
+###############################################################
+# Proceso por variable
+###############################################################
+def _update_var(dev: DeviceML, name: str, x: float):
+    st = dev.vars[name]
+    st.append(x)
+    dev.dirty = True
+
+    # Estadístico incremental
+    mean, std = ewma_update(st, x)
+
+    det = st.detector
+    if isinstance(det, IForestDetector):
+        # Reentrenar solo ante drift o al vencer el intervalo máximo (fuera del loop)
+        reason = retrain_reason(st)
+        if reason:
+            schedule_retrain(dev, name, reason)
+        anom, score = predict_anomaly(det, x)
+    else:
+        # Streaming: se puntúa contra el estado previo y luego se incorpora x
+        anom, score = predict_anomaly(det, x)
+        det.update(x)
+    return anom, score, mean, std
 
 ###############################################################
 # Proceso Principal
 ###############################################################
-def update_and_predict(temp: float, hum: float):
-    result = {}
+def update_and_predict(device_id: str, temp: float, hum: float):
+    dev = registry.get(device_id)
 
     ###########################################################
     # Temperatura
     ###########################################################
     if temp is not None:
-        buf = buffers["temperature"]
-        buf.append(temp)
-        buffers["temperature"] = buf[-MAX_BUF:]
-
-        # Estadístico incremental
-        mean_t, std_t = ewma_update("temperature", temp)
+        ml_anom_t, ml_score_t, mean_t, std_t = _update_var(dev, "temperature", temp)
         dyn_min_t = mean_t - 3 * std_t
         dyn_max_t = mean_t + 3 * std_t
-
-        # Reentrenar IF cada 20 muestras
-        if len(buf) % RETRAIN_EVERY == 0 or models["temperature"] is None:
-            train_iforest("temperature", buf)
-
-        ml_anom_t, ml_score_t = predict_anomaly("temperature", temp)
     else:
         ml_anom_t = False
         ml_score_t = 0.0
@@ -104,18 +1104,9 @@ def update_and_predict(temp: float, hum: float):
     # Humedad
     ###########################################################
     if hum is not None:
-        buf = buffers["humidity"]
-        buf.append(hum)
-        buffers["humidity"] = buf[-MAX_BUF:]
-
-        mean_h, std_h = ewma_update("humidity", hum)
+        ml_anom_h, ml_score_h, mean_h, std_h = _update_var(dev, "humidity", hum)
         dyn_min_h = mean_h - 3 * std_h
         dyn_max_h = mean_h + 3 * std_h
-
-        if len(buf) % RETRAIN_EVERY == 0 or models["humidity"] is None:
-            train_iforest("humidity", buf)
-
-        ml_anom_h, ml_score_h = predict_anomaly("humidity", hum)
     else:
         ml_anom_h = False
         ml_score_h = 0.0
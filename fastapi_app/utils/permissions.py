@@ -1,6 +1,53 @@
 # utils/permissions.py
 from fastapi import HTTPException, status
 
+def has_permission(perms: dict, permission_key: str) -> bool:
+    """
+    Evalúa una clave de permiso sobre el dict `permissions` de un dispositivo.
+    Acepta claves equivalentes (led_rojo / led_verde / led_red / led_green).
+    """
+    # Normalización de claves
+    key_map = {"led_rojo": "led_red", "led_verde": "led_green"}
+    inv_map = {v: k for k, v in key_map.items()}
+    possible_keys = {permission_key, inv_map.get(permission_key, permission_key)}
+
+    # Buscar por cualquiera de las claves equivalentes
+    for key in possible_keys:
+        val = (perms or {}).get(key)
+
+        # Si DynamoDB devolvió {"BOOL": True}, lo convertimos
+        if isinstance(val, dict) and "BOOL" in val:
+            val = val["BOOL"]
+
+        if val is True:
+            return True
+
+    return False
+
+
+def filter_permitted_devices(user: dict, device_ids, permission_key: str):
+    """
+    Chequeo de permisos en una sola pasada para muchos dispositivos.
+    Devuelve (permitidos, denegados) sin lanzar excepciones.
+    """
+    if user.get("role") == "admin":
+        return list(device_ids), []
+
+    perms_by_device = {
+        d.get("device_id"): d.get("permissions", {})
+        for d in user.get("allowed_devices", [])
+        if d.get("device_id")
+    }
+
+    allowed, denied = [], []
+    for dev_id in device_ids:
+        if dev_id in perms_by_device and has_permission(perms_by_device[dev_id], permission_key):
+            allowed.append(dev_id)
+        else:
+            denied.append(dev_id)
+    return allowed, denied
+
+
 def check_device_permission(user: dict, device_id: str, permission_key: str):
     """
     Verifica si el usuario tiene permiso para realizar una acción específica en un dispositivo.
@@ -18,28 +65,15 @@ def check_device_permission(user: dict, device_id: str, permission_key: str):
     devices = user.get("allowed_devices", [])
     print(f"📋 allowed_devices = {devices}")
 
-    # Normalización de claves (acepta led_rojo / led_verde / led_red / led_green)
-    key_map = {"led_rojo": "led_red", "led_verde": "led_green"}
-    inv_map = {v: k for k, v in key_map.items()}
-    possible_keys = {permission_key, inv_map.get(permission_key, permission_key)}
-
     # Buscar dispositivo
     for d in devices:
         if d.get("device_id") == device_id:
             perms = d.get("permissions", {})
             print(f"🔎 Permisos encontrados: {perms}")
 
-            # Buscar por cualquiera de las claves equivalentes
-            for key in possible_keys:
-                val = perms.get(key)
-
-                # Si DynamoDB devolvió {"BOOL": True}, lo convertimos
-                if isinstance(val, dict) and "BOOL" in val:
-                    val = val["BOOL"]
-
-                if val is True:
-                    print(f"✅ Permiso concedido: {key} → {val}")
-                    return True
+            if has_permission(perms, permission_key):
+                print(f"✅ Permiso concedido: {permission_key}")
+                return True
 
     # Si no encontró permisos válidos:
     print(f"⛔ Acceso denegado a {device_id} para {permission_key}")
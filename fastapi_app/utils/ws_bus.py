@@ -0,0 +1,206 @@
+# utils/ws_bus.py
+"""
+Bus de broadcast entre procesos para los WebSockets.
+
+Cada worker de uvicorn (o cada nodo) tiene sus propios sockets. Para que
+un evento generado en un proceso (ej: el listener MQTT) llegue a todos
+los dashboards, `manager.broadcast()` publica en el bus y CADA worker,
+suscripto al bus, reparte el evento a sus clientes locales.
+
+Implementaciones:
+  · InProcessBus → un solo proceso (default, sin dependencias)
+  · RedisBus     → pub/sub sobre Redis o cualquier servidor compatible
+                   (Valkey, KeyDB, un redis-server local para pruebas)
+
+Se elige con WS_BUS_URL:  vacío → InProcessBus,  redis://host:6379/0 → RedisBus
+
+El bus también decide qué worker corre las tareas que deben ser únicas
+(ej: el listener MQTT): `run_exclusive()`.
+"""
+import os
+import json
+import uuid
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+WS_BUS_URL = os.getenv("WS_BUS_URL", "")
+WS_BUS_CHANNEL = os.getenv("WS_BUS_CHANNEL", "remotemon:ws")
+WS_LEADER_TTL = float(os.getenv("WS_LEADER_TTL", "15"))   # segundos de validez del lock de líder
+
+Handler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# Renovar / liberar el lock solo si sigue siendo nuestro (atómico en Redis)
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class BroadcastBus(ABC):
+    """Interfaz común: publish(envelope) / start(handler) / stop() / run_exclusive()."""
+
+    def __init__(self, handler: Optional[Handler] = None) -> None:
+        self._handler = handler
+
+    async def start(self, handler: Handler) -> None:
+        self._handler = handler
+
+    async def stop(self) -> None:
+        pass
+
+    @abstractmethod
+    async def publish(self, envelope: Dict[str, Any]) -> None:
+        ...
+
+    async def run_exclusive(self, name: str, factory: Callable[[], Awaitable[None]]) -> None:
+        """Corre `factory()` en un único proceso. Sin bus compartido, este es el único."""
+        await factory()
+
+
+# ============================================================
+#   En proceso
+# ============================================================
+class InProcessBus(BroadcastBus):
+    """Entrega directa al handler local (un solo worker)."""
+
+    async def publish(self, envelope: Dict[str, Any]) -> None:
+        if self._handler:
+            await self._handler(envelope)
+
+
+# ============================================================
+#   Redis (o compatible)
+# ============================================================
+class RedisBus(BroadcastBus):
+    """
+    Pub/sub sobre un canal Redis. Cada worker recibe también sus propios
+    mensajes, así todos reparten exactamente lo mismo y en el mismo orden.
+    Si Redis no responde al publicar, el evento se entrega al menos a los
+    clientes de este worker.
+    """
+
+    def __init__(self, url: str, channel: str = WS_BUS_CHANNEL, client=None) -> None:
+        super().__init__()
+        self.url = url
+        self.channel = channel
+        self._redis = client     # cliente ya creado (ej: un stand-in en tests)
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, handler: Handler) -> None:
+        if self._redis is None:
+            try:
+                import redis.asyncio as aioredis
+            except ImportError as e:
+                raise RuntimeError("WS_BUS_URL configurado pero falta el paquete 'redis'") from e
+            self._redis = aioredis.from_url(self.url)
+
+        self._handler = handler
+        self._task = asyncio.create_task(self._reader())
+        print(f"🚌 Bus WS Redis → {self.url} ({self.channel})")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._redis:
+            await self._redis.aclose()
+
+    async def publish(self, envelope: Dict[str, Any]) -> None:
+        data = json.dumps(envelope, default=str, separators=(",", ":"))
+        try:
+            await self._redis.publish(self.channel, data)
+        except Exception as e:
+            print(f"⚠️ Bus WS: no se pudo publicar en Redis ({e}), entrega solo local")
+            await self._handler(json.loads(data))
+
+    async def _reader(self) -> None:
+        """Suscripción con reconexión automática."""
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                async for item in pubsub.listen():
+                    if item.get("type") != "message":
+                        continue
+                    try:
+                        await self._handler(json.loads(item["data"]))
+                    except Exception as e:
+                        print(f"⚠️ Bus WS: error entregando evento: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Bus WS desconectado: {e} → reintento en 2s")
+                await asyncio.sleep(2)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    async def run_exclusive(self, name: str, factory: Callable[[], Awaitable[None]]) -> None:
+        """
+        Elección de líder con un lock en Redis (SET NX + TTL, renovado cada
+        TTL/3): solo el worker que lo tiene corre `factory()`. Si pierde el
+        lock (Redis caído, proceso colgado) cancela la tarea y otro worker
+        la toma cuando vence el TTL.
+        """
+        key = f"{self.channel}:leader:{name}"
+        token = uuid.uuid4().hex
+        ttl_ms = int(WS_LEADER_TTL * 1000)
+        interval = WS_LEADER_TTL / 3
+
+        while True:
+            try:
+                acquired = await self._redis.set(key, token, nx=True, px=ttl_ms)
+            except Exception as e:
+                print(f"⚠️ Bus WS: no se pudo tomar el lock '{name}': {e}")
+                acquired = False
+            if not acquired:
+                await asyncio.sleep(interval)
+                continue
+
+            print(f"👑 Este worker corre '{name}'")
+            task = asyncio.create_task(factory())
+            try:
+                while not task.done():
+                    await asyncio.wait({task}, timeout=interval)
+                    if task.done():
+                        break
+                    if not await self._redis.eval(_RENEW_SCRIPT, 1, key, token, ttl_ms):
+                        print(f"⚠️ Lock '{name}' perdido, se cede a otro worker")
+                        break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Bus WS: error renovando el lock '{name}': {e}")
+            finally:
+                task.cancel()
+                try:
+                    await task
+                except BaseException:
+                    pass
+                try:
+                    await self._redis.eval(_RELEASE_SCRIPT, 1, key, token)
+                except Exception:
+                    pass
+            if task.done() and not task.cancelled() and task.exception() is None:
+                return   # terminó sola: no se vuelve a lanzar
+            await asyncio.sleep(interval)
+
+
+def create_bus(url: str = WS_BUS_URL) -> BroadcastBus:
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBus(url)
+    return InProcessBus()
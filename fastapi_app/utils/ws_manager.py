@@ -1,25 +1,285 @@
 # utils/ws_manager.py
 from __future__ import annotations
-from typing import Optional, Set, Dict, Any, List
+from typing import Optional, Set, Dict, Any, List, Callable
 from dataclasses import dataclass
+from collections import deque
+import os
+import uuid
 import json
+import time
 import asyncio
 from fastapi import WebSocket
 
+from utils.ws_bus import BroadcastBus, InProcessBus, create_bus
 
-@dataclass
+try:
+    import msgpack   # formato binario opcional
+except ImportError:
+    msgpack = None
+
+# Cola de salida por cliente
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "256"))
+# Qué hacer si la cola se llena: "drop_oldest" | "disconnect"
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")
+
+# Formatos de cable soportados (se negocian al conectar con ?format=)
+WS_FORMATS = ("json", "msgpack")
+
+# Tipos que se pueden fusionar por dispositivo cuando el cliente pide throttle.
+# Solo frames con el estado COMPLETO: quedarse con el último no pierde nada.
+# `device_update` (diff parcial, ej: {led_red: x}) y las alarmas nunca se demoran.
+COALESCE_TYPES = {"data", "status"}
+MAX_THROTTLE_MS = 10_000
+
+# Heartbeat: cada cliente recibe un ping cada WS_PING_INTERVAL segundos y
+# se expulsa si no envía nada (pong incluido) en WS_IDLE_TIMEOUT segundos
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "30"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "90"))
+HEARTBEAT_SLOTS = 30    # ranuras de la rueda (una se procesa por tick)
+
+# Eventos recientes que se guardan para reenviar a clientes que se reconectan
+WS_REPLAY_SIZE = int(os.getenv("WS_REPLAY_SIZE", "1000"))
+REPLAY_BATCH = 100      # mensajes por frame al reenviar
+
+
+# ---------------------------------------------------------
+# CODIFICACIÓN
+# ---------------------------------------------------------
+def encode_message(msg: Dict[str, Any], fmt: str):
+    """JSON compacto (texto) o MessagePack (binario)."""
+    if fmt == "msgpack":
+        return msgpack.packb(msg, default=str)
+    return json.dumps(msg, default=str, separators=(",", ":"))
+
+
+def encode_batch(frames: List[Any], fmt: str):
+    """
+    Arma {"type": "batch", "messages": [...]} reutilizando frames ya
+    serializados (no se vuelve a codificar cada mensaje).
+    """
+    if fmt == "msgpack":
+        packer = msgpack.Packer()
+        return (
+            packer.pack_map_header(2)
+            + packer.pack("type") + packer.pack("batch")
+            + packer.pack("messages") + packer.pack_array_header(len(frames))
+            + b"".join(frames)
+        )
+    return '{"type":"batch","messages":[' + ",".join(frames) + "]}"
+
+
+class EncodedMessage:
+    """
+    Un evento serializado como mucho una vez por formato, sin importar
+    a cuántos clientes se envíe.
+    """
+    __slots__ = ("msg", "_frames")
+
+    def __init__(self, msg: Dict[str, Any]) -> None:
+        self.msg = msg
+        self._frames: Dict[str, Any] = {}
+
+    def frame(self, fmt: str):
+        f = self._frames.get(fmt)
+        if f is None:
+            f = self._frames[fmt] = encode_message(self.msg, fmt)
+        return f
+
+
+PING = EncodedMessage({"type": "ping"})
+
+
+@dataclass(eq=False)   # identidad por objeto → usable en sets
 class Client:
     ws: WebSocket
     filter_devices: Optional[Set[str]] = None       # filtros enviados por ?devices=
     allowed_devices: Optional[Set[str]] = None      # permisos del token
     email: Optional[str] = None
     role: Optional[str] = None
+    fmt: str = "json"                               # formato de cable negociado
+    throttle_ms: int = 0                            # 0 = sin throttle
+
+    # Updates pendientes por (type, device_id) → último frame (latest-value-wins)
+    pending: Optional[Dict[tuple, Any]] = None
+    flush_handle: Optional[asyncio.TimerHandle] = None
+    last_flush: float = 0.0
+
+    # Cola de salida acotada, drenada por su propia tarea `sender`
+    queue: Optional[asyncio.Queue] = None
+    sender: Optional[asyncio.Task] = None
+
+    # Heartbeat (rueda de tiempos compartida)
+    last_seen: float = 0.0
+    hb_slot: int = 0
+
+    # Métricas
+    sent: int = 0
+    dropped: int = 0
+    max_depth: int = 0
+    avg_send_ms: float = 0.0
+    max_send_ms: float = 0.0
+
+    def device_scope(self) -> Optional[Set[str]]:
+        """
+        Dispositivos que este cliente debe recibir.
+        None = todos (admin o cliente sin filtro ni restricción).
+        """
+        if self.filter_devices is None and self.allowed_devices is None:
+            return None
+        if self.filter_devices is None:
+            return set(self.allowed_devices)
+        if self.allowed_devices is None:
+            return set(self.filter_devices)
+        return self.filter_devices & self.allowed_devices
 
 
 class ConnectionManager:
-    def __init__(self) -> None:
-        self._clients: List[Client] = []
-        self._lock = asyncio.Lock()
+    """
+    Mantiene un índice device_id → clientes suscriptos, más un set aparte
+    para clientes que reciben todo (admin / sin filtro). Así un broadcast
+    solo recorre los clientes interesados en ese dispositivo.
+
+    Las mutaciones del índice son síncronas (sin await en el medio), por lo
+    que no necesitan lock dentro del event loop.
+
+    Cada cliente tiene una cola de salida acotada y una tarea que la drena:
+    broadcast solo encola, así un navegador lento nunca frena al listener
+    MQTT. Si la cola se llena se aplica WS_OVERFLOW_POLICY.
+
+    Además se indexa por email (y aparte los admins) para los eventos
+    dirigidos a un usuario, como sus alarmas (`send_to_user`).
+
+    Ping e inactividad los maneja UNA sola tarea para todas las conexiones:
+    una rueda de HEARTBEAT_SLOTS ranuras que da una vuelta completa cada
+    WS_PING_INTERVAL; en cada tick se revisa solo la ranura actual. Sin
+    timers ni tareas extra por cliente.
+
+    Cada evento repartido lleva `seq`, creciente dentro del `stream` de este
+    proceso (se anuncia en el frame `hello` al conectar). Los últimos
+    WS_REPLAY_SIZE eventos quedan en un anillo: un cliente que se reconecta
+    con ?stream=&last_seq= recibe solo lo que se perdió (`replay`).
+
+    Los broadcasts pasan por un bus (ver utils/ws_bus.py): con varios
+    workers cada proceso recibe el evento del bus y lo reparte solo a
+    SUS sockets, a través de `_deliver`.
+    """
+
+    def __init__(self, queue_size: int = WS_QUEUE_SIZE, overflow_policy: str = WS_OVERFLOW_POLICY) -> None:
+        self._clients: Dict[WebSocket, Client] = {}
+        self._by_device: Dict[str, Set[Client]] = {}
+        self._wildcard: Set[Client] = set()
+        self._by_email: Dict[str, Set[Client]] = {}
+        self._admins: Set[Client] = set()
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.evicted = 0
+        self.bus: BroadcastBus = InProcessBus(self._deliver)
+
+        self._wheel: List[Set[Client]] = [set() for _ in range(HEARTBEAT_SLOTS)]
+        self._next_slot = 0
+        self._hb_task: Optional[asyncio.Task] = None
+        self.idle_evicted = 0
+
+        # Secuencia + anillo de reenvío: (seq, device_id, user, admins, EncodedMessage)
+        self.stream_id = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._ring: deque = deque(maxlen=WS_REPLAY_SIZE)
+        self.replayed = 0
+
+        # Funciones que ven cada evento repartido (ej: cache de estado vivo)
+        self._observers: List[Callable[[Dict[str, Any]], None]] = []
+
+    def add_observer(self, fn: Callable[[Dict[str, Any]], None]) -> None:
+        self._observers.append(fn)
+
+    # ---------------------------------------------------------
+    # BUS ENTRE WORKERS
+    # ---------------------------------------------------------
+    async def start(self, bus: Optional[BroadcastBus] = None) -> None:
+        """Se suscribe al bus configurado (WS_BUS_URL) o al indicado."""
+        self.bus = bus or create_bus()
+        await self.bus.start(self._deliver)
+        self._ensure_heartbeat()
+        print(f"🚌 Bus WS: {type(self.bus).__name__}")
+
+    async def stop(self) -> None:
+        if self._hb_task:
+            self._hb_task.cancel()
+            self._hb_task = None
+        await self.bus.stop()
+
+    # ---------------------------------------------------------
+    # HEARTBEAT (rueda de tiempos)
+    # ---------------------------------------------------------
+    def _ensure_heartbeat(self) -> None:
+        if self._hb_task is None or self._hb_task.done():
+            self._hb_task = asyncio.create_task(self._heartbeat_loop())
+
+    def touch(self, client: Client) -> None:
+        """El cliente mandó algo (mensaje o pong): sigue vivo."""
+        client.last_seen = asyncio.get_running_loop().time()
+
+    async def _heartbeat_loop(self) -> None:
+        tick = WS_PING_INTERVAL / HEARTBEAT_SLOTS
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(tick)
+            try:
+                self._heartbeat_tick(loop.time())
+            except Exception as e:
+                print(f"⚠️ Error en heartbeat WS: {e}")
+
+    def _heartbeat_tick(self, now: float) -> None:
+        """Procesa una ranura: ping a los vivos, expulsión de los inactivos."""
+        slot = self._wheel[self._next_slot]
+        self._next_slot = (self._next_slot + 1) % HEARTBEAT_SLOTS
+        for c in list(slot):
+            if now - c.last_seen > WS_IDLE_TIMEOUT:
+                self.idle_evicted += 1
+                self._evict(c, "inactivo")
+            else:
+                self._enqueue(c, PING.frame(c.fmt))
+
+    # ---------------------------------------------------------
+    # ÍNDICE
+    # ---------------------------------------------------------
+    def _index_add(self, client: Client) -> None:
+        scope = client.device_scope()
+        if scope is None:
+            self._wildcard.add(client)
+            return
+        for dev in scope:
+            self._by_device.setdefault(dev, set()).add(client)
+
+    def _index_remove(self, client: Client) -> None:
+        scope = client.device_scope()
+        if scope is None:
+            self._wildcard.discard(client)
+            return
+        for dev in scope:
+            subs = self._by_device.get(dev)
+            if subs is None:
+                continue
+            subs.discard(client)
+            if not subs:
+                del self._by_device[dev]
+
+    def _set_filter(self, client: Client, filter_devices: Optional[Set[str]]) -> None:
+        """Cambia el filtro del cliente manteniendo el índice sincronizado."""
+        self._index_remove(client)
+        client.filter_devices = filter_devices
+        self._index_add(client)
+
+    def _targets(self, device_id: Optional[str]) -> List[Client]:
+        if device_id is None:
+            return list(self._clients.values())
+        subs = self._by_device.get(device_id)
+        if not subs:
+            return list(self._wildcard)
+        return [*subs, *self._wildcard]
+
+    def get_client(self, websocket: WebSocket) -> Optional[Client]:
+        return self._clients.get(websocket)
 
     # ---------------------------------------------------------
     # CONNECT
@@ -31,48 +291,182 @@ class ConnectionManager:
         allowed_devices: Optional[Set[str]] = None,
         email: Optional[str] = None,
         role: Optional[str] = None,
-    ) -> None:
+        fmt: str = "json",
+        throttle_ms: int = 0,
+    ) -> Client:
+
+        if fmt not in WS_FORMATS or (fmt == "msgpack" and msgpack is None):
+            print(f"⚠️ Formato WS '{fmt}' no disponible, usando json")
+            fmt = "json"
 
         await websocket.accept()
-        async with self._lock:
-            self._clients.append(
-                Client(
-                    ws=websocket,
-                    filter_devices=filter_devices,
-                    allowed_devices=allowed_devices,
-                    email=email,
-                    role=role,
-                )
-            )
+        client = Client(
+            ws=websocket,
+            filter_devices=filter_devices,
+            allowed_devices=allowed_devices,
+            email=email,
+            role=role,
+            fmt=fmt,
+        )
+        self.set_throttle(client, throttle_ms)
+        self.touch(client)
+        # Ranura anterior a la actual → primer ping ~un intervalo completo después
+        client.hb_slot = (self._next_slot - 1) % HEARTBEAT_SLOTS
+        self._wheel[client.hb_slot].add(client)
+        self._ensure_heartbeat()
+        client.queue = asyncio.Queue(maxsize=self.queue_size)
+        client.sender = asyncio.create_task(self._sender(client))
+        self._clients[websocket] = client
+        self._index_add(client)
+        if email:
+            self._by_email.setdefault(email, set()).add(client)
+        if role == "admin":
+            self._admins.add(client)
+
+        # Identifica el stream y la posición actual (para reanudar luego)
+        self.send_to_client(client, {"type": "hello", "stream": self.stream_id, "seq": self._seq})
 
-        print(f"🔗 Cliente conectado | email={email} | filtros={filter_devices} | allowed={allowed_devices}")
+        print(f"🔗 Cliente conectado | email={email} | filtros={filter_devices} | allowed={allowed_devices} | formato={fmt}")
+        return client
 
     # ---------------------------------------------------------
     # DISCONNECT
     # ---------------------------------------------------------
     def disconnect(self, websocket: WebSocket) -> None:
-        for i, c in enumerate(self._clients):
-            if c.ws is websocket:
-                print(f"❌ Cliente desconectado | email={c.email}")
-                self._clients.pop(i)
-                break
+        c = self._clients.pop(websocket, None)
+        if c is None:
+            return
+        self._index_remove(c)
+        self._wheel[c.hb_slot].discard(c)
+        self._admins.discard(c)
+        tabs = self._by_email.get(c.email)
+        if tabs is not None:
+            tabs.discard(c)
+            if not tabs:
+                del self._by_email[c.email]
+        if c.sender and c.sender is not asyncio.current_task():
+            c.sender.cancel()
+        if c.flush_handle:
+            c.flush_handle.cancel()
+        print(f"❌ Cliente desconectado | email={c.email}")
+
+    def _evict(self, client: Client, reason: str) -> None:
+        """Desconecta un cliente que no consume lo suficientemente rápido."""
+        self.evicted += 1
+        self.disconnect(client.ws)
+        print(f"🐢 Cliente expulsado ({reason}) | email={client.email}")
+        asyncio.create_task(self._close(client.ws, code=1013))   # 1013 = try again later
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int) -> None:
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
 
     # ---------------------------------------------------------
-    # MATCH RULES
+    # COLA DE SALIDA POR CLIENTE
     # ---------------------------------------------------------
-    def _matches(self, client: Client, device_id: Optional[str]) -> bool:
-        if device_id is None:
-            return True
+    def _enqueue(self, client: Client, frame) -> None:
+        q = client.queue
+        if q.full():
+            if self.overflow_policy == "disconnect":
+                self._evict(client, "cola llena")
+                return
+            # drop_oldest: se descarta lo más viejo, gana lo más nuevo
+            try:
+                q.get_nowait()
+                client.dropped += 1
+            except asyncio.QueueEmpty:
+                pass
 
-        # filtro explícito enviado por el cliente
-        if client.filter_devices is not None and device_id not in client.filter_devices:
-            return False
+        q.put_nowait(frame)
+        if q.qsize() > client.max_depth:
+            client.max_depth = q.qsize()
 
-        # permisos del token
-        if client.allowed_devices is not None and device_id not in client.allowed_devices:
-            return False
+    # ---------------------------------------------------------
+    # THROTTLE (coalescing por dispositivo)
+    # ---------------------------------------------------------
+    def set_throttle(self, client: Client, throttle_ms) -> None:
+        try:
+            throttle_ms = int(throttle_ms or 0)
+        except (TypeError, ValueError):
+            throttle_ms = 0
+        client.throttle_ms = max(0, min(throttle_ms, MAX_THROTTLE_MS))
+        if client.pending is None:
+            client.pending = {}
 
-        return True
+    def _coalesce(self, client: Client, key: tuple, frame) -> None:
+        """Guarda el último frame por (type, device_id) y agenda un flush."""
+        client.pending.pop(key, None)
+        client.pending[key] = frame
+        if client.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            delay = client.last_flush + client.throttle_ms / 1000 - loop.time()
+            client.flush_handle = loop.call_later(max(0.0, delay), self._flush, client)
+
+    def _flush(self, client: Client) -> None:
+        """Envía lo pendiente como UN frame (batch si hay más de un update)."""
+        client.flush_handle = None
+        client.last_flush = asyncio.get_running_loop().time()
+        if client.ws not in self._clients or not client.pending:
+            return
+
+        frames = list(client.pending.values())
+        client.pending.clear()
+        self._enqueue(client, frames[0] if len(frames) == 1 else encode_batch(frames, client.fmt))
+
+    async def _sender(self, client: Client) -> None:
+        """Drena la cola del cliente; mide la latencia de cada envío."""
+        try:
+            while True:
+                frame = await client.queue.get()
+                t0 = time.perf_counter()
+                if isinstance(frame, bytes):
+                    await client.ws.send_bytes(frame)
+                else:
+                    await client.ws.send_text(frame)
+                ms = (time.perf_counter() - t0) * 1000
+
+                client.sent += 1
+                client.avg_send_ms = ms if client.sent == 1 else 0.9 * client.avg_send_ms + 0.1 * ms
+                if ms > client.max_send_ms:
+                    client.max_send_ms = ms
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # Conexión rota
+            self.disconnect(client.ws)
+
+    def stats(self) -> dict:
+        """Profundidad de cola y latencia de envío por cliente."""
+        return {
+            "bus": type(self.bus).__name__,
+            "clients": len(self._clients),
+            "users": len(self._by_email),
+            "admins": len(self._admins),
+            "evicted": self.evicted,
+            "idle_evicted": self.idle_evicted,
+            "stream": self.stream_id,
+            "seq": self._seq,
+            "replay_ring": len(self._ring),
+            "replayed": self.replayed,
+            "overflow_policy": self.overflow_policy,
+            "per_client": [
+                {
+                    "email": c.email,
+                    "format": c.fmt,
+                    "throttle_ms": c.throttle_ms,
+                    "queue_depth": c.queue.qsize() if c.queue else 0,
+                    "max_depth": c.max_depth,
+                    "sent": c.sent,
+                    "dropped": c.dropped,
+                    "avg_send_ms": round(c.avg_send_ms, 2),
+                    "max_send_ms": round(c.max_send_ms, 2),
+                }
+                for c in self._clients.values()
+            ],
+        }
 
     # ---------------------------------------------------------
     # CLIENT → BACKEND
@@ -81,7 +475,8 @@ class ConnectionManager:
         """
         Procesa los mensajes enviados por el frontend vía WebSocket.
         Ejemplo:
-            {"type": "subscribe", "devices": ["esp32_01"]}
+            {"type": "subscribe", "devices": ["esp32_01"], "throttle_ms": 250}
+            {"type": "throttle", "throttle_ms": 500}
         """
         try:
             msg = json.loads(data)
@@ -91,6 +486,10 @@ class ConnectionManager:
 
         msg_type = msg.get("type")
 
+        # Heartbeat: ya se actualizó last_seen al recibirlo
+        if msg_type in ("pong", "ping"):
+            return
+
         # ---------------------------------------
         # SUBSCRIBE
         # ---------------------------------------
@@ -98,79 +497,180 @@ class ConnectionManager:
             devs = msg.get("devices", [])
             devs = {str(d) for d in devs}
 
-            async with self._lock:
-                client.filter_devices = devs
+            self._set_filter(client, devs)
+            if "throttle_ms" in msg:
+                self.set_throttle(client, msg.get("throttle_ms"))
 
             print(f"📡 Cliente update SUBSCRIBE → {devs}")
             return
 
+        # ---------------------------------------
+        # THROTTLE (máximo un frame cada X ms)
+        # ---------------------------------------
+        if msg_type == "throttle":
+            self.set_throttle(client, msg.get("throttle_ms"))
+            print(f"📡 Cliente THROTTLE → {client.throttle_ms} ms")
+            return
+
         # ---------------------------------------
         # UNSUBSCRIBE
         # ---------------------------------------
         if msg_type == "unsubscribe":
-            async with self._lock:
-                client.filter_devices = None
+            self._set_filter(client, None)
             print("📡 Cliente UNSUBSCRIBE (ver todos los permitidos)")
             return
 
         print(f"ℹ️ Mensaje WS desconocido: {msg}")
 
+    # ---------------------------------------------------------
+    # SECUENCIA Y REENVÍO
+    # ---------------------------------------------------------
+    def _sequence(self, message: Dict[str, Any], device_id, user=None, admins=True) -> EncodedMessage:
+        """Asigna el próximo seq, guarda el evento en el anillo y lo devuelve codificable."""
+        self._seq += 1
+        msg = {**message, "seq": self._seq}
+        if "type" not in msg:
+            msg["type"] = "device_update"
+        encoded = EncodedMessage(msg)
+        self._ring.append((self._seq, device_id, user, admins, encoded))
+        return encoded
+
+    @staticmethod
+    def _wants(client: Client, device_id, user, admins) -> bool:
+        if user is not None:
+            if client.email != user and not (admins and client.role == "admin"):
+                return False
+        if device_id is None:
+            return True
+        scope = client.device_scope()
+        return scope is None or device_id in scope
+
+    def replay(self, client: Client, stream: Optional[str], last_seq: int) -> bool:
+        """
+        Reenvía al cliente los eventos posteriores a `last_seq`.
+        Devuelve False si no se puede (otro stream o el hueco ya salió del
+        anillo): en ese caso el llamador manda un snapshot.
+        """
+        if stream != self.stream_id or last_seq > self._seq:
+            return False
+        if last_seq == self._seq:
+            return True
+        if not self._ring or self._ring[0][0] > last_seq + 1:
+            return False
+
+        frames = [
+            enc.frame(client.fmt)
+            for seq, dev, user, admins, enc in self._ring
+            if seq > last_seq and self._wants(client, dev, user, admins)
+        ]
+        for i in range(0, len(frames), REPLAY_BATCH):
+            chunk = frames[i:i + REPLAY_BATCH]
+            self._enqueue(client, chunk[0] if len(chunk) == 1 else encode_batch(chunk, client.fmt))
+
+        self.replayed += len(frames)
+        print(f"⏪ Replay de {len(frames)} eventos (desde seq {last_seq}) | email={client.email}")
+        return True
+
     # ---------------------------------------------------------
     # BROADCAST PÚBLICO
     # ---------------------------------------------------------
     async def broadcast(self, message: Dict[str, Any]) -> None:
         """
         Broadcast normal. Puede venir con o sin device_id.
+        Se publica en el bus → llega a los clientes de todos los workers.
         """
-        await self._broadcast_internal(message, message.get("device_id"))
+        await self.bus.publish({"message": message, "device_id": message.get("device_id")})
 
     async def broadcast_device_update(self, device_id: str, data: Dict[str, Any]) -> None:
         """
         Utility para mandar un update de dispositivo con device_id garantizado.
         """
         payload = {"device_id": device_id, **data}
-        await self._broadcast_internal(payload, device_id)
+        await self.bus.publish({"message": payload, "device_id": device_id})
+
+    async def send_to_user(
+        self,
+        email: str,
+        message: Dict[str, Any],
+        device_id: Optional[str] = None,
+        include_admins: bool = True,
+    ) -> None:
+        """
+        Evento dirigido: solo a las pestañas de `email` (y a los admins si
+        include_admins). Nunca llega a otros usuarios que miran el device.
+        """
+        await self.bus.publish({
+            "message": message,
+            "device_id": device_id if device_id is not None else message.get("device_id"),
+            "user": email,
+            "admins": include_admins,
+        })
+
+    async def _deliver(self, envelope: Dict[str, Any]) -> None:
+        """Handler del bus: reparte el evento a los clientes de ESTE proceso."""
+        if envelope.get("user"):
+            self._deliver_to_user(
+                envelope["message"],
+                envelope["user"],
+                envelope.get("device_id"),
+                envelope.get("admins", True),
+            )
+            return
+        for fn in self._observers:
+            try:
+                fn(envelope["message"])
+            except Exception as e:
+                print(f"⚠️ Error en observer WS: {e}")
+        await self._broadcast_internal(envelope["message"], envelope.get("device_id"))
+
+    def send_to_client(self, client: Client, message: Dict[str, Any]) -> None:
+        """Mensaje directo a UNA conexión (ej: snapshot inicial)."""
+        self._enqueue(client, encode_message(message, client.fmt))
+
+    def _deliver_to_user(
+        self,
+        message: Dict[str, Any],
+        email: str,
+        device_id: Optional[str],
+        include_admins: bool,
+    ) -> None:
+        encoded = self._sequence(message, device_id, email, include_admins)
+
+        targets = set(self._by_email.get(email, ()))
+        if include_admins:
+            targets |= self._admins
+
+        for c in targets:
+            # Se respeta el filtro de la pestaña (ej: vista de un solo device)
+            if self._wants(c, device_id, email, include_admins):
+                self._enqueue(c, encoded.frame(c.fmt))
 
     # ---------------------------------------------------------
     # BROADCAST INTERNO (con filtrado y type automático)
     # ---------------------------------------------------------
     async def _broadcast_internal(self, message: Dict[str, Any], device_id: Optional[str]) -> None:
         """
-        Envío interno del mensaje, agregando 'type' si no está presente.
-        Maneja filtrado por clientes y elimina desconectados.
+        Envío interno del mensaje, agregando 'type' si no está presente y su seq.
+        Filtra clientes por índice y encola en cada uno.
         """
 
         # -----------------------------
         # 🔥 Normalizar mensaje
         # -----------------------------
-        msg = message.copy()
-
-        # Asegurar que todos los mensajes tengan type
-        if "type" not in msg:
-            msg["type"] = "device_update"
+        # type por defecto + seq; se serializa una vez por formato, no por cliente
+        encoded = self._sequence(message, device_id)
+        msg = encoded.msg
 
-        txt = json.dumps(msg, default=str)
-        dead: List[Client] = []
+        # Los clientes con throttle reciben el último valor por dispositivo
+        coalesce_key = (msg["type"], device_id) if device_id and msg["type"] in COALESCE_TYPES else None
 
-        # Filtrar clientes
-        async with self._lock:
-            targets = [c for c in self._clients if self._matches(c, device_id)]
-
-        # Enviar a cada cliente sin bloquear el lock
-        for c in targets:
-            try:
-                await c.ws.send_text(txt)
-            except Exception:
-                dead.append(c)
-
-        # Limpiar conexiones rotas
-        if dead:
-            async with self._lock:
-                for d in dead:
-                    try:
-                        self._clients.remove(d)
-                    except ValueError:
-                        pass
+        # Solo los clientes suscriptos a este device (+ los que reciben todo).
+        # No se espera a ningún socket: cada cliente tiene su propia cola.
+        for c in self._targets(device_id):
+            if c.throttle_ms and coalesce_key:
+                self._coalesce(c, coalesce_key, encoded.frame(c.fmt))
+            else:
+                self._enqueue(c, encoded.frame(c.fmt))
 
 
 # Instancia global